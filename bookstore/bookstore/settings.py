@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 import config
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -20,8 +21,9 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.8/howto/deployment/checklist/
 
-# SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 't4ry&ox(&x=5pc_4vv%u3i&g$_2ak%ddkg&(mx-u+r=-8f&e83'
+# SECURITY WARNING: keep the secret key used in production secret! Set
+# DJANGO_SECRET_KEY there; the fallback is only for development.
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', 't4ry&ox(&x=5pc_4vv%u3i&g$_2ak%ddkg&(mx-u+r=-8f&e83')
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -50,7 +52,10 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'store.metrics.MetricsMiddleware',
+    'store.routers.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'store.session_cart.SessionCartMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -65,7 +70,7 @@ ROOT_URLCONF = 'bookstore.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'store.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -96,9 +101,48 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Seconds a connection is kept open for the next request; 0 closes
+        # it after every request, None keeps it forever.
+        'CONN_MAX_AGE': 60,
+        # A file rather than :memory: so tests can use several connections.
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
+    },
+    # Stand-in read replica: a second SQLite file that nothing replicates
+    # to, used by the routing tests. Point it at a real replica and list it
+    # in DATABASE_REPLICAS to take catalog reads off the primary.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_replica.sqlite3'),
+        'CONN_MAX_AGE': 60,
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db_replica.sqlite3'),
+        },
+    },
+}
+
+# Search, book pages and the sales dashboard read store models from one of
+# these aliases (see store/routers.py); everything else uses 'default'.
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['store.routers.PrimaryReplicaRouter']
+
+
+# Cache
+# File based so every worker on the host shares it and sees cache versions
+# bumped by the others (see store/versions.py). It lives outside the
+# checkout; set BOOKSTORE_CACHE_DIR to move it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('BOOKSTORE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'bookstore-cache')),
     }
 }
 
+# Runs the tests against a private in-memory cache instead of the one above.
+TEST_RUNNER = 'store.testrunner.TestRunner'
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -128,6 +172,73 @@ STATICFILES_FINDERS = (
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 MEDIA_URL = '/media/'
+DEFAULT_FILE_STORAGE = 'store.assets.HashedMediaStorage'
+
+# Media files are served by store.assets.serve with far-future caching. Set
+# SENDFILE_HEADER to 'X-Sendfile' (Apache, lighttpd), which is sent the
+# file's path, or to 'X-Accel-Redirect' (nginx), which is sent
+# SENDFILE_PREFIX, an internal location aliased to MEDIA_ROOT, followed by
+# the file's name, to let the front-end server send the file itself.
+# Static files are only served by Django with DEBUG on; in production the
+# front-end server serves STATIC_ROOT, with far-future caching for the
+# compressor's CACHE/ directory, whose names change with their contents.
+HASHED_ASSET_URLS = not DEBUG
+ASSET_MAX_AGE = 60 * 60 * 24 * 365
+SENDFILE_HEADER = None
+SENDFILE_PREFIX = ''
+
+# Store
+STORE_PAGE_SIZE = 24
+API_CACHE_TIMEOUT = 60 * 5
+
+# Book page snapshots (see store/snapshots.py): the latest reviews shown,
+# and how long an outdated snapshot is served while it is rebuilt.
+BOOK_DETAIL_REVIEWS = 50
+BOOK_DETAIL_STALE_SECONDS = 60
+BOOK_DETAIL_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Payments (see store/payments.py). Use 'store.payments.FakeGateway' to run
+# checkouts without network access.
+PAYMENT_GATEWAYS = {
+    'paypal': {
+        'BACKEND': 'store.payments.PayPalGateway',
+        'OPTIONS': {
+            'mode': 'sandbox',
+            'client_id': config.PAYPAL_SANDBOX_CLIENT_ID,
+            'client_secret': config.PAYPAL_SANDBOX_SECRET,
+            'timeout': 10,
+            'retries': 2,
+        },
+    },
+    'stripe': {
+        'BACKEND': 'store.payments.StripeGateway',
+        'OPTIONS': {
+            'api_key': config.STRIPE_TEST_SECRET_KEY,
+            'timeout': 10,
+            'retries': 2,
+        },
+    },
+}
+
+
+# Authorized payments are captured by the reconcile_payments worker.
+PAYMENT_BATCH_SIZE = 20
+PAYMENT_MAX_ATTEMPTS = 5
+PAYMENT_RETRY_DELAY = 30
+
+
+# "Customers also bought" lists (see store/recommendations.py), kept up to
+# date by the build_recommendations command.
+RECOMMENDATIONS_PER_BOOK = 6
+RECOMMENDATIONS_BATCH_SIZE = 500
+
+
+# Request metrics (see store/metrics.py), served at /metrics/ to these
+# addresses. Requests running more queries than METRICS_QUERY_LIMIT are
+# logged and counted.
+METRICS_ALLOWED_IPS = ('127.0.0.1',)
+METRICS_QUERY_LIMIT = 50
 
 
 # Registration
@@ -136,13 +247,16 @@ REGISTRATION_AUTO_LOGIN = True
 LOGIN_REDIRECT_URL = '/store/'
 
 # Email settings
-EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+EMAIL_BACKEND = "store.outbox.EmailBackend"
 EMAIL_HOST = "smtp.mailgun.org"
 EMAIL_HOST_USER = config.MAILGUN_EMAIL_HOST_USER
 EMAIL_HOST_PASSWORD = config.MAILGUN_EMAIL_HOST_PASSWORD
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 DEFAULT_FROM_EMAIL = "books@mysterbooks.com"
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_DELAY = 60
 
 # Social Auth - Facebook
 SOCIAL_AUTH_FACEBOOK_KEY = config.FACEBOOK_APP_ID
@@ -150,6 +264,8 @@ SOCIAL_AUTH_FACEBOOK_SECRET = config.FACEBOOK_APP_SECRET
 
 # GIS
 GEOIP_PATH = 'geo/'
+GEOIP_CACHE_SIZE = 10000
+GEOIP_CACHE_TTL = 60 * 60
 
 # Logs
 
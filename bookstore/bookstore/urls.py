@@ -1,11 +1,13 @@
 from django.conf.urls import include, url
 from django.contrib import admin
 from django.conf import settings
-from django.conf.urls.static import static
 from tastypie.api import Api
-from store.api import ReviewResource
+from store.api import BookResource, ReviewResource
+from store.assets import serve_media, serve_static
+from store.metrics import metrics
 
 v1_api = Api(api_name='v1')
+v1_api.register(BookResource())
 v1_api.register(ReviewResource())
 
 urlpatterns = [
@@ -14,4 +16,12 @@ urlpatterns = [
     url('', include('social.apps.django_app.urls', namespace='social')),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^api/', include(v1_api.urls)),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    url(r'^metrics/$', metrics, name='metrics'),
+    url(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), serve_media),
+]
+
+# In production the front-end server serves STATIC_ROOT itself.
+if settings.DEBUG:
+    urlpatterns += [
+        url(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), serve_static),
+    ]
@@ -1 +1,3 @@
-import signals
\ No newline at end of file
+import signals
+
+default_app_config = 'store.apps.StoreConfig'
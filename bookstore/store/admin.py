@@ -1,9 +1,18 @@
+import datetime
+
+from django.conf.urls import url
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
+from django.utils import timezone
 
-from .models import Book, Author, BookOrder, Cart, Review
+from .forms import SalesReportForm
+from .models import Book, Author, BookOrder, Cart, Review, OutboundEmail, DailyBookSales, DailyPaymentSales
+from .rollups import sales_report
+from .routers import replica_reads
 
 class BookAdmin(admin.ModelAdmin):
-  list_display = ('title', 'author', 'price', 'stock')
+  list_display = ('title', 'author', 'price', 'stock', 'review_count')
 
 class AuthorAdmin(admin.ModelAdmin):
   list_display = ('last_name', 'first_name')
@@ -12,13 +21,73 @@ class BookOrderAdmin(admin.ModelAdmin):
   list_display = ('book', 'cart', 'quantity')
 
 class CartAdmin(admin.ModelAdmin):
-  list_display = ('user', 'active', 'order_date')
+  list_display = ('user', 'active', 'order_date', 'payment_type', 'payment_status', 'payment_attempts')
+  list_filter = ('payment_status',)
 
 class ReviewAdmin(admin.ModelAdmin):
   list_display = ('book', 'user', 'publish_date')
 
+class OutboundEmailAdmin(admin.ModelAdmin):
+  list_display = ('subject', 'to', 'status', 'attempts', 'next_attempt', 'sent_date')
+  list_filter = ('status',)
+
+class RollupAdmin(admin.ModelAdmin):
+  # Rollups are written by store.rollups only, so they can be listed and
+  # looked at but not added, edited or deleted here.
+  date_hierarchy = 'date'
+  actions = None
+
+  def get_readonly_fields(self, request, obj=None):
+    return [field.name for field in self.model._meta.fields]
+
+  def has_add_permission(self, request):
+    return False
+
+  def has_delete_permission(self, request, obj=None):
+    return False
+
+  def save_model(self, request, obj, form, change):
+    pass
+
+class DailyBookSalesAdmin(RollupAdmin):
+  list_display = ('date', 'book', 'units', 'revenue')
+  list_select_related = ('book',)
+  change_list_template = 'admin/store/dailybooksales/change_list.html'
+
+  def get_urls(self):
+    return [
+      url(r'^dashboard/$', self.admin_site.admin_view(replica_reads(self.dashboard_view)), name='store_sales_dashboard'),
+    ] + super(DailyBookSalesAdmin, self).get_urls()
+
+  def dashboard_view(self, request):
+    # Reads only the daily rollups, so any date range costs about the same.
+    # Revenue is for whoever may see the rollups, not every staff user.
+    if not self.has_change_permission(request):
+      raise PermissionDenied
+    form = SalesReportForm(request.GET or None)
+    today = timezone.localtime(timezone.now()).date()
+    start, end = today - datetime.timedelta(days=29), today
+    if form.is_valid():
+      start = form.cleaned_data['start'] or start
+      end = form.cleaned_data['end'] or end
+    context = dict(
+      self.admin_site.each_context(request),
+      title='Sales dashboard',
+      opts=self.model._meta,
+      form=form,
+      report=sales_report(start, end),
+    )
+    return TemplateResponse(request, 'admin/store/sales_dashboard.html', context)
+
+class DailyPaymentSalesAdmin(RollupAdmin):
+  list_display = ('date', 'payment_type', 'orders', 'units', 'revenue')
+  list_filter = ('payment_type',)
+
 admin.site.register(Book, BookAdmin)
 admin.site.register(Author, AuthorAdmin)
 admin.site.register(BookOrder, BookOrderAdmin)
 admin.site.register(Cart, CartAdmin)
 admin.site.register(Review, ReviewAdmin)
+admin.site.register(OutboundEmail, OutboundEmailAdmin)
+admin.site.register(DailyBookSales, DailyBookSalesAdmin)
+admin.site.register(DailyPaymentSales, DailyPaymentSalesAdmin)
@@ -1,8 +1,67 @@
+import hashlib
+
 from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
 from tastypie.authentication import SessionAuthentication
+from tastypie.exceptions import BadRequest
+from tastypie.utils import trailing_slash
 from tastypie import fields
 from .models import Review, Book
+from .clusters import cluster, parse_bbox, MAX_ZOOM
+from .pagination import CursorPaginator
+from .search import search
+from .versions import get_version, last_modified
+from django.conf import settings
+from django.conf.urls import url
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+
+class ConditionalResource(ModelResource):
+  # GETs are answered from version counters (see store.versions) before any
+  # serialization happens: a matching If-None-Match / If-Modified-Since gets
+  # a 304, and an unchanged representation is served from the cache. The
+  # representation is built from the primary, never a replica: it is cached
+  # under the current versions, and a lagging replica's rows would be served
+  # as current until the next change.
+  def cache_versions(self, request, **kwargs):
+    return [get_version(self._meta.resource_name)]
+
+  def conditional(self, view, request, **kwargs):
+    versions = self.cache_versions(request, **kwargs)
+    tag = hashlib.md5('%s|%s|%s' % (
+      ','.join(str(version) for version in versions),
+      request.get_full_path(),
+      request.META.get('HTTP_ACCEPT', ''),
+    )).hexdigest()
+    modified = last_modified(max(versions))
+
+    def cached_view(request, **kwargs):
+      key = 'api:%s' % tag
+      cached = cache.get(key)
+      if cached is not None:
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+      response = view(request, **kwargs)
+      if response.status_code == 200:
+        cache.set(key, (response.content, response['Content-Type']), settings.API_CACHE_TIMEOUT)
+      return response
+
+    response = condition(
+      etag_func=lambda request, **kwargs: tag,
+      last_modified_func=lambda request, **kwargs: modified,
+    )(cached_view)(request, **kwargs)
+    patch_vary_headers(response, ['Accept', 'Cookie'])
+    patch_cache_control(response, private=True, max_age=0)
+    return response
+
+  def get_list(self, request, **kwargs):
+    return self.conditional(super(ConditionalResource, self).get_list, request, **kwargs)
+
+  def get_detail(self, request, **kwargs):
+    return self.conditional(super(ConditionalResource, self).get_detail, request, **kwargs)
 
 class UserResource(ModelResource):
   class Meta:
@@ -11,21 +70,132 @@ class UserResource(ModelResource):
     authentication= SessionAuthentication()
 
 
-class BookResource(ModelResource):
+class BookResource(ConditionalResource):
   class Meta:
     queryset= Book.objects.all()
+    resource_name= 'book'
     allowed_methods= ['get']
     authentication= SessionAuthentication()
 
+  def prepend_urls(self):
+    return [
+      url(r"^(?P<resource_name>%s)/search%s$" % (self._meta.resource_name, trailing_slash()),
+        self.wrap_view('get_search'), name='api_book_search'),
+    ]
+
+  def get_search(self, request, **kwargs):
+    # Backs the storefront's search box, so it is open to anonymous users
+    # like the catalog itself.
+    self.method_check(request, allowed=['get'])
+    self.throttle_check(request)
+    self.log_throttled_access(request)
+    return self.conditional(self.search_response, request, **kwargs)
+
+  def search_response(self, request, **kwargs):
+    try:
+      page = max(int(request.GET.get('page', 1)), 1)
+      limit = min(max(int(request.GET.get('limit', self._meta.limit)), 1), 100)
+    except ValueError as e:
+      raise BadRequest(str(e))
+
+    results = search(request.GET.get('q', ''), page, limit, autocomplete=True)
+    return self.create_response(request, {
+      'meta': {
+        'page': page,
+        'next': results.next_page_number,
+      },
+      'objects': [{
+        'id': book.id,
+        'title': book.title,
+        'author': unicode(book.author),
+        'resource_uri': self.get_resource_uri(book),
+      } for book in results.object_list],
+    })
+
 
-class ReviewResource(ModelResource):
+def only_when_requested(bundle):
+  return False
+
+
+class ReviewResource(ConditionalResource):
   book= fields.ToOneField(BookResource, 'book')
   user= fields.ToOneField(UserResource, 'user', full=True)
+  # Flat alternative to the nested user, only sent when asked for through
+  # ?fields=..., e.g. ?fields=latitude,longitude,username for map markers.
+  username= fields.CharField('user__username', readonly=True, use_in=only_when_requested)
 
   class Meta:
-    queryset= Review.objects.all()
+    queryset= Review.objects.select_related('user', 'book').only(
+      'id', 'publish_date', 'text', 'latitude', 'longitude',
+      'book', 'book__id', 'user', 'user__id', 'user__username',
+    )
+    excludes= ['geo_cell']
+    resource_name= 'review'
     allowed_methods= ['get']
     authentication= SessionAuthentication()
+    paginator_class= CursorPaginator
     filtering= {
       'book' : ALL_WITH_RELATIONS
-    }
\ No newline at end of file
+    }
+
+  def cache_versions(self, request, **kwargs):
+    book = request.GET.get('book') or request.GET.get('book__id')
+    if book:
+      return [get_version('review', book)]
+    return [get_version('review')]
+
+  def sparse_fields(self, request):
+    requested = request.GET.get('fields') if request else None
+    if not requested:
+      return None
+    return set(requested.split(',')) & set(self.fields)
+
+  def full_dehydrate(self, bundle, for_list=False):
+    requested = self.sparse_fields(bundle.request)
+    if requested is None:
+      return super(ReviewResource, self).full_dehydrate(bundle, for_list=for_list)
+
+    for field_name in requested:
+      field_object = self.fields[field_name]
+      if field_object.dehydrated_type == 'related':
+        field_object.api_name = self._meta.api_name
+        field_object.resource_name = self._meta.resource_name
+      bundle.data[field_name] = field_object.dehydrate(bundle, for_list=for_list)
+    return self.dehydrate(bundle)
+
+  def prepend_urls(self):
+    return [
+      url(r"^(?P<resource_name>%s)/clusters%s$" % (self._meta.resource_name, trailing_slash()),
+        self.wrap_view('get_clusters'), name='api_review_clusters'),
+    ]
+
+  def get_clusters(self, request, **kwargs):
+    # Map markers pre-aggregated on the server: one entry per grid cell in
+    # the requested bounding box, so the payload grows with what fits on
+    # screen rather than with the number of reviews.
+    self.method_check(request, allowed=['get'])
+    self.is_authenticated(request)
+    self.throttle_check(request)
+    self.log_throttled_access(request)
+    return self.conditional(self.cluster_response, request, **kwargs)
+
+  def cluster_response(self, request, **kwargs):
+    try:
+      bbox = parse_bbox(request.GET.get('bbox', '-90,-180,90,180'))
+      zoom = min(max(int(request.GET.get('zoom', 0)), 0), MAX_ZOOM)
+    except ValueError as e:
+      raise BadRequest(str(e))
+
+    lookups = {}
+    if request.GET.get('book'):
+      try:
+        lookups['book'] = int(request.GET['book'])
+      except ValueError:
+        raise BadRequest('Invalid book: %s' % request.GET['book'])
+
+    clusters = cluster(Review.objects.all(), bbox, zoom, **lookups)
+    return self.create_response(request, {
+      'zoom': zoom,
+      'total': sum(c['count'] for c in clusters),
+      'clusters': clusters,
+    })
\ No newline at end of file
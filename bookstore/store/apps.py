@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+class StoreConfig(AppConfig):
+  name = 'store'
+
+  def ready(self):
+    from . import geo, metrics, payments
+    # Times every query run over connections opened from here on.
+    connection_created.connect(metrics.time_queries)
+    geo.warm()
+    payments.warm()
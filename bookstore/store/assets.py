@@ -0,0 +1,182 @@
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.http import (
+  FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse,
+)
+from django.utils.http import http_date, parse_etags, quote_etag
+from django.views.static import was_modified_since
+
+# Media URLs carry a hash of the file's contents
+# (books/1/hitchhiker.jpeg -> books/1/hitchhiker.3f2a9c0d51be.jpeg), so a URL
+# always names the same bytes and can be cached forever. Files stay on disk
+# under their plain names; serve() strips the hash again. Static CSS and JS
+# go through compressor, whose output (CACHE/css/<hash>.css) is already
+# named after its contents.
+HASH_LENGTH = 12
+HASHED_NAME = re.compile(r'^(?P<root>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^./]+)$' % HASH_LENGTH)
+RANGE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+_hashes = {}
+
+
+def file_hash(path):
+  # Memoized on (mtime, size), so building a URL usually costs one stat().
+  stat = os.stat(path)
+  key = (stat.st_mtime, stat.st_size)
+  cached = _hashes.get(path)
+  if cached is not None and cached[0] == key:
+    return cached[1]
+  digest = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      digest.update(chunk)
+  digest = digest.hexdigest()[:HASH_LENGTH]
+  _hashes[path] = (key, digest)
+  return digest
+
+
+def hashed_name(name, digest):
+  root, ext = os.path.splitext(name)
+  return '%s.%s%s' % (root, digest, ext)
+
+
+def split_hashed_name(name):
+  match = HASHED_NAME.match(name)
+  if match is None:
+    return name, None
+  return match.group('root') + match.group('ext'), match.group('hash')
+
+
+class ContentHashMixin(object):
+  def url(self, name):
+    if not settings.HASHED_ASSET_URLS:
+      return super(ContentHashMixin, self).url(name)
+    try:
+      digest = file_hash(self.path(name))
+    except (OSError, IOError):
+      # Not collected or not uploaded yet; fall back to the plain URL.
+      return super(ContentHashMixin, self).url(name)
+    return super(ContentHashMixin, self).url(hashed_name(name, digest))
+
+
+class HashedMediaStorage(ContentHashMixin, FileSystemStorage):
+  pass
+
+
+def _immutable(path, document_root):
+  compressed = os.path.join(document_root, getattr(settings, 'COMPRESS_OUTPUT_DIR', 'CACHE')) + os.sep
+  return path.startswith(compressed)
+
+
+def _byte_range(request, size, etag):
+  header = request.META.get('HTTP_RANGE')
+  if not header:
+    return None
+  if_range = request.META.get('HTTP_IF_RANGE')
+  if if_range and if_range != etag:
+    return None
+  match = RANGE.match(header.strip())
+  if match is None or match.group('start') == match.group('end') == '':
+    # Malformed or multiple ranges: send the whole file.
+    return None
+  if match.group('start') == '':
+    start = max(size - int(match.group('end')), 0)
+    end = size - 1
+  else:
+    start = int(match.group('start'))
+    end = min(int(match.group('end') or size - 1), size - 1)
+  if start > end or start >= size:
+    return False
+  return start, end
+
+
+def _read_range(path, start, length):
+  with open(path, 'rb') as f:
+    f.seek(start)
+    while length > 0:
+      chunk = f.read(min(CHUNK_SIZE, length))
+      if not chunk:
+        break
+      length -= len(chunk)
+      yield chunk
+
+
+def serve(request, path, document_root):
+  # Stands in for django.views.static.serve for MEDIA_URL and STATIC_URL.
+  # A request whose hash matches the file on disk is cached as immutable;
+  # anything else must revalidate against the ETag.
+  name = os.path.normpath(path).lstrip('/')
+  if name.startswith('..'):
+    raise Http404
+  full_path = os.path.join(document_root, name)
+  requested_hash = None
+  if not os.path.isfile(full_path):
+    name, requested_hash = split_hashed_name(name)
+    full_path = os.path.join(document_root, name)
+    if requested_hash is None or not os.path.isfile(full_path):
+      raise Http404
+
+  stat = os.stat(full_path)
+  digest = file_hash(full_path)
+  etag = quote_etag(digest)
+  if (requested_hash is not None and requested_hash == digest) or _immutable(full_path, document_root):
+    cache_control = 'public, max-age=%d, immutable' % settings.ASSET_MAX_AGE
+  else:
+    cache_control = 'public, max-age=0, must-revalidate'
+
+  if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+  if if_none_match:
+    not_modified = '*' in if_none_match or digest in parse_etags(if_none_match)
+  else:
+    not_modified = not was_modified_since(
+      request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size)
+  if not_modified:
+    response = HttpResponseNotModified()
+  elif settings.SENDFILE_HEADER:
+    # The front-end server sends the body (and handles Range) itself.
+    # nginx takes a URI under an internal location rather than a path.
+    response = HttpResponse()
+    if settings.SENDFILE_HEADER == 'X-Accel-Redirect':
+      response[settings.SENDFILE_HEADER] = settings.SENDFILE_PREFIX + name
+    else:
+      response[settings.SENDFILE_HEADER] = full_path
+  else:
+    byte_range = _byte_range(request, stat.st_size, etag)
+    if byte_range is False:
+      response = HttpResponse(status=416)
+      response['Content-Range'] = 'bytes */%d' % stat.st_size
+    elif byte_range:
+      start, end = byte_range
+      response = StreamingHttpResponse(_read_range(full_path, start, end - start + 1), status=206)
+      response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+      response['Content-Length'] = end - start + 1
+    else:
+      # FileResponse lets the WSGI server use wsgi.file_wrapper (sendfile).
+      response = FileResponse(open(full_path, 'rb'))
+      response['Content-Length'] = stat.st_size
+
+  if response.status_code != 304:
+    content_type, encoding = mimetypes.guess_type(full_path)
+    response['Content-Type'] = content_type or 'application/octet-stream'
+    if encoding:
+      response['Content-Encoding'] = encoding
+  response['ETag'] = etag
+  response['Last-Modified'] = http_date(stat.st_mtime)
+  response['Cache-Control'] = cache_control
+  response['Accept-Ranges'] = 'bytes'
+  return response
+
+
+def serve_media(request, path):
+  return serve(request, path, settings.MEDIA_ROOT)
+
+
+def serve_static(request, path):
+  # Only routed with DEBUG on; see bookstore/urls.py.
+  return serve(request, path, settings.STATIC_ROOT)
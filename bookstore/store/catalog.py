@@ -0,0 +1,288 @@
+import csv
+import json
+import time
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Max, Value, When
+from django.utils.dateparse import parse_date
+from django.utils.encoding import force_text
+
+from .models import Author, Book
+from .search import index_books
+from .versions import bump_version
+
+# Bulk catalog import and export (see the import_catalog and export_catalog
+# commands). Rows are read and written one at a time, so memory stays flat
+# however big the feed is, and written in batches: one transaction per
+# batch, with new books inserted by bulk_create and changes to existing
+# ones made with one CASE update per group of columns.
+#
+# A row with an id updates that book, and only the columns it has, so a
+# stock feed only needs id and stock. A row without an id adds a book.
+
+COLUMNS = ('id', 'title', 'author_first_name', 'author_last_name', 'description', 'price', 'stock', 'publish_date')
+BATCH_SIZE = 1000
+# Ids per IN (...) lookup, within SQLite's limit on query parameters.
+CHUNK_SIZE = 500
+# Rejected rows past this many are counted but not described.
+MAX_ERRORS = 100
+# Changing these shows on the book page and in search results; stock and
+# price updates only need the catalog-wide versions bumped.
+DISPLAY_FIELDS = frozenset(['title', 'author', 'description'])
+
+
+def read_csv(stream):
+  # Yields (line number, row); empty cells are left out of the row. Cells
+  # stay UTF-8 bytes, for parse_row to decode, so a badly encoded line is
+  # rejected on its own.
+  reader = csv.DictReader(stream)
+  for row in reader:
+    yield reader.line_num, dict((key, value) for key, value in row.items() if key and value)
+
+
+def read_jsonl(stream):
+  # Lines that are not JSON objects are passed on as they are, for
+  # parse_row to reject.
+  for line_number, line in enumerate(stream, 1):
+    if line.strip():
+      try:
+        row = json.loads(line)
+      except ValueError:
+        row = line
+      if isinstance(row, dict):
+        row = dict((key, value) for key, value in row.items() if value is not None)
+      yield line_number, row
+
+
+def write_csv(rows, stream):
+  writer = csv.writer(stream)
+  writer.writerow(COLUMNS)
+  for row in rows:
+    writer.writerow([force_text(row[column]).encode('utf-8') for column in COLUMNS])
+
+
+def write_jsonl(rows, stream):
+  for row in rows:
+    row['price'] = str(row['price'])
+    row['publish_date'] = row['publish_date'].isoformat()
+    stream.write(json.dumps(row) + '\n')
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+
+def parse_row(row):
+  # Returns (book id or None, field values, (first, last) author name or
+  # None). Raises ValueError for anything that would not save.
+  if not isinstance(row, dict):
+    raise ValueError('not a JSON object')
+  decoded = {}
+  for key, value in row.items():
+    # JSON lines can nest; no column does.
+    if isinstance(value, (list, dict)):
+      raise ValueError('%s must not be a list or object' % key)
+    if isinstance(value, bytes):
+      try:
+        value = value.decode('utf-8')
+      except UnicodeDecodeError:
+        raise ValueError('%s is not valid UTF-8' % key)
+    decoded[key] = value
+  try:
+    return _parse_row(decoded)
+  except (TypeError, ArithmeticError) as e:
+    # Anything else of the wrong type, such as a None stock.
+    raise ValueError('invalid value: %s' % e)
+
+
+def _integer(row, key):
+  # int() would truncate a JSON 1.7.
+  value = row[key]
+  if isinstance(value, float) and not value.is_integer():
+    raise ValueError('%s must be a whole number, not %r' % (key, value))
+  return int(value)
+
+
+def _parse_row(row):
+  values = {}
+  if 'title' in row:
+    values['title'] = force_text(row['title']).strip()
+    if not values['title'] or len(values['title']) > Book._meta.get_field('title').max_length:
+      raise ValueError('title must be 1-200 characters')
+  if 'description' in row:
+    values['description'] = force_text(row['description'])
+  if 'price' in row:
+    try:
+      values['price'] = Decimal(force_text(row['price']))
+      if not values['price'].is_finite():
+        raise InvalidOperation
+      values['price'] = values['price'].quantize(Decimal('0.01'))
+    except InvalidOperation:
+      raise ValueError('invalid price %r' % row['price'])
+    if not Decimal('0') <= values['price'] < Decimal('1000000'):
+      raise ValueError('price out of range: %s' % values['price'])
+  if 'stock' in row:
+    values['stock'] = _integer(row, 'stock')
+    if values['stock'] < 0:
+      raise ValueError('stock can not be negative')
+  if 'publish_date' in row:
+    values['publish_date'] = parse_date(force_text(row['publish_date']))
+    if values['publish_date'] is None:
+      raise ValueError('invalid publish_date %r' % row['publish_date'])
+
+  author = None
+  if 'author_first_name' in row or 'author_last_name' in row:
+    author = (force_text(row.get('author_first_name', '')).strip(), force_text(row.get('author_last_name', '')).strip())
+    if not all(author):
+      raise ValueError('both author_first_name and author_last_name are needed')
+
+  book_id = _integer(row, 'id') if 'id' in row else None
+  if book_id is None and (author is None or 'title' not in values or 'price' not in values):
+    raise ValueError('new books need a title, author and price')
+  return book_id, values, author
+
+
+class AuthorMap(object):
+  # Every author's id by (first_name, last_name), loaded once per import.
+  def __init__(self):
+    self.ids = dict(
+      ((first_name, last_name), pk)
+      for pk, first_name, last_name in Author.objects.values_list('pk', 'first_name', 'last_name').iterator()
+    )
+
+  def resolve(self, name):
+    if name not in self.ids:
+      self.ids[name] = Author.objects.create(first_name=name[0], last_name=name[1]).pk
+    return self.ids[name]
+
+
+def bulk_update(changes):
+  # changes maps book ids to {field: value}. Books changing the same
+  # columns are updated together, one UPDATE per slice that fits the
+  # backend's limit on query parameters.
+  groups = {}
+  for pk, values in changes.items():
+    groups.setdefault(frozenset(values), []).append(pk)
+  for fields, pks in groups.items():
+    size = connection.ops.bulk_batch_size(['pk'] * (2 * len(fields) + 1), pks)
+    for i in range(0, len(pks), size):
+      chunk = pks[i:i + size]
+      Book.objects.filter(pk__in=chunk).update(**dict(
+        (field, Case(
+          *[When(pk=pk, then=Value(changes[pk][field])) for pk in chunk],
+          output_field=IntegerField() if field == 'author' else Book._meta.get_field(field)
+        )) for field in fields
+      ))
+
+
+class ImportStats(object):
+  def __init__(self):
+    self.started = time.time()
+    self.created = 0
+    self.updated = 0
+    self.skipped = 0
+    self.errors = []
+
+  def reject(self, line_number, error):
+    self.skipped += 1
+    if len(self.errors) < MAX_ERRORS:
+      self.errors.append('line %d: %s' % (line_number, error))
+
+  @property
+  def rows(self):
+    return self.created + self.updated + self.skipped
+
+  @property
+  def rate(self):
+    return self.rows / max(time.time() - self.started, 0.001)
+
+
+def _chunks(ids):
+  for i in range(0, len(ids), CHUNK_SIZE):
+    yield ids[i:i + CHUNK_SIZE]
+
+
+def _import_batch(batch, authors, stats):
+  new_books = []
+  changes = {}
+  reindex = set()
+  with transaction.atomic():
+    existing = set()
+    for ids in _chunks([book_id for _, book_id, _ in batch if book_id is not None]):
+      existing.update(Book.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    for line_number, book_id, values in batch:
+      if 'author' in values:
+        values['author'] = authors.resolve(values['author'])
+      if book_id is None:
+        values['author_id'] = values.pop('author')
+        new_books.append(Book(**values))
+      elif book_id in existing:
+        changes.setdefault(book_id, {}).update(values)
+        if DISPLAY_FIELDS.intersection(values):
+          reindex.add(book_id)
+      else:
+        stats.reject(line_number, 'no book with id %d' % book_id)
+
+    if new_books:
+      # bulk_create does not return ids on every backend; the new rows are
+      # the ones past the current highest id.
+      last_id = Book.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+      Book.objects.bulk_create(new_books)
+      reindex.update(Book.objects.filter(pk__gt=last_id).values_list('pk', flat=True))
+    bulk_update(changes)
+    for ids in _chunks(sorted(reindex)):
+      index_books(Book.objects.select_related('author').filter(pk__in=ids))
+
+  for book_id in reindex.intersection(changes):
+    bump_version('book', book_id)
+  bump_version('book')
+  bump_version('catalog')
+  stats.created += len(new_books)
+  stats.updated += len(changes)
+
+
+def import_rows(rows, batch_size=None, report=None):
+  # rows are (line number, row dict) pairs, as from read_csv or read_jsonl.
+  # report, if given, is called with the ImportStats after every batch.
+  batch_size = batch_size or BATCH_SIZE
+  stats = ImportStats()
+  authors = AuthorMap()
+  batch = []
+  for line_number, row in rows:
+    try:
+      book_id, values, author = parse_row(row)
+    except ValueError as e:
+      stats.reject(line_number, e)
+      continue
+    if author is not None:
+      values['author'] = author
+    batch.append((line_number, book_id, values))
+    if len(batch) >= batch_size:
+      _import_batch(batch, authors, stats)
+      batch = []
+      if report:
+        report(stats)
+  if batch:
+    _import_batch(batch, authors, stats)
+    if report:
+      report(stats)
+  return stats
+
+
+def export_rows(batch_size=None):
+  # Yields every book as a row of COLUMNS. Reads go by primary key ranges:
+  # iterator() alone still fetches the whole result up front on SQLite.
+  batch_size = batch_size or BATCH_SIZE
+  fields = ('pk', 'title', 'author__first_name', 'author__last_name', 'description', 'price', 'stock', 'publish_date')
+  last_id = 0
+  while True:
+    books = Book.objects.filter(pk__gt=last_id).order_by('pk').values_list(*fields)[:batch_size]
+    count = 0
+    for book in books.iterator():
+      count += 1
+      last_id = book[0]
+      yield OrderedDict(zip(COLUMNS, book))
+    if count < batch_size:
+      return
@@ -0,0 +1,128 @@
+from django.db.models import F, Q, Avg, Count, ExpressionWrapper, BigIntegerField
+
+# Reviews are indexed on a 2^16 x 2^16 lat/lng grid. Each review stores its
+# cell as a Morton (Z-order) code, interleaving the longitude and latitude
+# bits, so dropping the low 2k bits of the code gives the enclosing cell k
+# levels up. Clustering at any zoom level is then a GROUP BY on an integer
+# division of one indexed column.
+GRID_BITS = 16
+GRID_SIZE = 1 << GRID_BITS
+MAX_ZOOM = 21
+
+
+def _quantize(value, low, high):
+  cell = int((value - low) / (high - low) * GRID_SIZE)
+  return min(max(cell, 0), GRID_SIZE - 1)
+
+
+def _interleave(x, y, bits=GRID_BITS):
+  code = 0
+  for bit in range(bits):
+    code |= ((x >> bit) & 1) << (2 * bit)
+    code |= ((y >> bit) & 1) << (2 * bit + 1)
+  return code
+
+
+def cell_for(latitude, longitude):
+  x = _quantize(float(longitude), -180.0, 180.0)
+  y = _quantize(float(latitude), -90.0, 90.0)
+  return _interleave(x, y)
+
+
+def precision_for(zoom):
+  # A map at zoom z is 256 * 2^z pixels wide; 2^(z + 2) cells across keeps
+  # clusters roughly 64 pixels apart on screen.
+  return min(max(zoom + 2, 1), GRID_BITS)
+
+
+def parse_bbox(value):
+  south, west, north, east = [float(part) for part in value.split(',')]
+  if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+    raise ValueError('Invalid bounding box: %s' % value)
+  return south, west, north, east
+
+
+def _cover(x0, x1, y0, y1, max_ranges):
+  # Walks down the quadtree, keeping the cells inside the box and splitting
+  # those on its edge, for as long as the split keeps within max_ranges.
+  # Edge cells left over are kept whole. Yields (level, x, y) cells.
+  level = 0
+  edge = [(0, 0)]
+  inside = []
+  while edge and level < GRID_BITS and len(inside) + 4 * len(edge) <= max_ranges:
+    level += 1
+    size = 1 << (GRID_BITS - level)
+    split = []
+    for x, y in edge:
+      for cx in (2 * x, 2 * x + 1):
+        for cy in (2 * y, 2 * y + 1):
+          low_x, low_y = cx * size, cy * size
+          high_x, high_y = low_x + size - 1, low_y + size - 1
+          if high_x < x0 or low_x > x1 or high_y < y0 or low_y > y1:
+            continue
+          if x0 <= low_x and high_x <= x1 and y0 <= low_y and high_y <= y1:
+            inside.append((level, cx, cy))
+          else:
+            split.append((cx, cy))
+    edge = split
+  return inside + [(level, x, y) for x, y in edge]
+
+
+def cell_ranges(bbox, max_ranges=32):
+  # The box as a short list of inclusive (low, high) geo_cell ranges. They
+  # may cover a little more than the box but never less.
+  south, west, north, east = bbox
+  y0, y1 = _quantize(south, -90.0, 90.0), _quantize(north, -90.0, 90.0)
+  x0, x1 = _quantize(west, -180.0, 180.0), _quantize(east, -180.0, 180.0)
+  if west <= east:
+    spans = [(x0, x1)]
+  else:
+    spans = [(x0, GRID_SIZE - 1), (0, x1)]
+  ranges = []
+  for low_x, high_x in spans:
+    for level, x, y in _cover(low_x, high_x, y0, y1, max_ranges // len(spans)):
+      shift = 2 * (GRID_BITS - level)
+      prefix = _interleave(x, y, level)
+      ranges.append((prefix << shift, ((prefix + 1) << shift) - 1))
+  merged = []
+  for low, high in sorted(ranges):
+    if merged and low <= merged[-1][1] + 1:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+    else:
+      merged.append((low, high))
+  return merged
+
+
+def in_bbox(queryset, bbox, **lookups):
+  # The cell ranges narrow the rows through the geo_cell indexes; the
+  # coordinates then trim the ranges' overlap at the edges of the box.
+  # Lookups such as book=... go into every range so each one can be read
+  # from the (book, geo_cell) index.
+  cells = Q()
+  for low, high in cell_ranges(bbox):
+    cells |= Q(geo_cell__gte=low, geo_cell__lte=high, **lookups)
+  south, west, north, east = bbox
+  queryset = queryset.filter(cells).filter(latitude__gte=south, latitude__lte=north)
+  if west <= east:
+    return queryset.filter(longitude__gte=west, longitude__lte=east)
+  # The box crosses the antimeridian.
+  return queryset.filter(Q(longitude__gte=west) | Q(longitude__lte=east))
+
+
+def cluster(queryset, bbox, zoom, **lookups):
+  divisor = 4 ** (GRID_BITS - precision_for(zoom))
+  rows = in_bbox(queryset, bbox, **lookups).annotate(
+    cell=ExpressionWrapper(F('geo_cell') / divisor, output_field=BigIntegerField())
+  ).values('cell').annotate(
+    count=Count('id'),
+    latitude=Avg('latitude'),
+    longitude=Avg('longitude'),
+  ).order_by()
+  return [
+    {
+      'count': row['count'],
+      'latitude': round(row['latitude'], 6),
+      'longitude': round(row['longitude'], 6),
+    }
+    for row in rows
+  ]
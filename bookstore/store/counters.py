@@ -0,0 +1,28 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count
+
+from .models import Book, Review, ReviewerStats
+
+CHUNK_SIZE = 500
+
+
+def rebuild_review_counts():
+  # Recomputes Book.review_count and ReviewerStats from the Review table.
+  # Books sharing a count are updated together, so the number of UPDATEs
+  # grows with the number of distinct counts rather than with the catalog.
+  with transaction.atomic():
+    Book.objects.update(review_count=0)
+    books_by_count = defaultdict(list)
+    for book_id, count in Review.objects.order_by().values_list('book').annotate(Count('id')):
+      books_by_count[count].append(book_id)
+    for count, book_ids in books_by_count.items():
+      for i in range(0, len(book_ids), CHUNK_SIZE):
+        Book.objects.filter(pk__in=book_ids[i:i + CHUNK_SIZE]).update(review_count=count)
+
+    ReviewerStats.objects.all().delete()
+    ReviewerStats.objects.bulk_create([
+      ReviewerStats(user_id=user_id, review_count=count)
+      for user_id, count in Review.objects.order_by().values_list('user').annotate(Count('id'))
+    ], batch_size=CHUNK_SIZE)
@@ -1,4 +1,16 @@
 from django import forms
 
 class ReviewForm(forms.Form):
-  text= forms.CharField(widget=forms.Textarea, label='')
\ No newline at end of file
+  text= forms.CharField(widget=forms.Textarea, label='')
+
+
+class SalesReportForm(forms.Form):
+  start= forms.DateField(required=False)
+  end= forms.DateField(required=False)
+
+  def clean(self):
+    cleaned_data = super(SalesReportForm, self).clean()
+    start, end = cleaned_data.get('start'), cleaned_data.get('end')
+    if start and end and start > end:
+      raise forms.ValidationError('The start date must not be after the end date.')
+    return cleaned_data
@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.gis.geoip import GeoIP, GeoIPException
+
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_IP = '66.241.90.200'
+
+_MISSING = object()
+
+
+class LookupCache(object):
+  # Bounded LRU of lookup results with a per-entry time to live. Empty
+  # results are cached too, so private and unknown addresses don't hit the
+  # database on every request either.
+  def __init__(self, lookup, max_size, ttl, clock=time.time):
+    self.lookup = lookup
+    self.max_size = max_size
+    self.ttl = ttl
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    now = self.clock()
+    with self._lock:
+      value, expires = self._entries.pop(key, (_MISSING, None))
+      if value is not _MISSING and expires > now:
+        self._entries[key] = (value, expires)
+        self.hits += 1
+        return value
+      self.misses += 1
+
+    value = self.lookup(key)
+
+    with self._lock:
+      self._entries[key] = (value, now + self.ttl)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+    return value
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+
+_reader = None
+_reader_lock = threading.Lock()
+_fallback = _MISSING
+
+
+def get_reader():
+  # One memory-mapped reader per process; every worker maps the same file,
+  # so the database pages live once in the OS page cache.
+  global _reader
+  if _reader is None:
+    with _reader_lock:
+      if _reader is None:
+        _reader = GeoIP(cache=GeoIP.GEOIP_MMAP_CACHE)
+  return _reader
+
+
+def _lookup_city(ip):
+  with timed('geoip'):
+    return get_reader().city(ip)
+
+
+city_cache = LookupCache(
+  _lookup_city,
+  max_size=settings.GEOIP_CACHE_SIZE,
+  ttl=settings.GEOIP_CACHE_TTL,
+)
+
+
+def fallback_city():
+  global _fallback
+  if _fallback is _MISSING:
+    _fallback = _lookup_city(FALLBACK_IP)
+  return _fallback
+
+
+def city(ip):
+  return (ip and city_cache.get(ip)) or fallback_city()
+
+
+def warm():
+  try:
+    fallback_city()
+  except GeoIPException:
+    logger.exception('Could not open the GeoIP database')
@@ -0,0 +1,44 @@
+import time
+
+from django.contrib.gis.geoip import GeoIP
+from django.core.management.base import BaseCommand
+
+from store import geo
+
+
+def old_lookup(ip):
+  geo_info = GeoIP().city(ip)
+  if not geo_info:
+    geo_info = GeoIP().city(geo.FALLBACK_IP)
+  return geo_info
+
+
+def timed(lookup, addresses):
+  start = time.time()
+  for ip in addresses:
+    lookup(ip)
+  return time.time() - start
+
+
+class Command(BaseCommand):
+  help = 'Compares the per-request GeoIP() lookup with the cached per-process reader.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--distinct', type=int, default=500,
+      help='Number of distinct client addresses to cycle through.')
+
+  def handle(self, *args, **options):
+    iterations = options['iterations']
+    pool = ['66.%d.%d.%d' % (i // 65536 % 256, i // 256 % 256, i % 256) for i in range(options['distinct'])]
+    addresses = [pool[i % len(pool)] for i in range(iterations)]
+
+    geo.city_cache.clear()
+    old = timed(old_lookup, addresses)
+    new = timed(geo.city, addresses)
+
+    self.stdout.write('lookups:        %d (%d distinct)' % (iterations, len(pool)))
+    self.stdout.write('GeoIP() per hit: %8.2f us/lookup' % (old / iterations * 1e6))
+    self.stdout.write('cached reader:   %8.2f us/lookup' % (new / iterations * 1e6))
+    self.stdout.write('speedup:         %8.1fx' % (old / new if new else float('inf')))
+    self.stdout.write('cache hits/misses: %d/%d' % (geo.city_cache.hits, geo.city_cache.misses))
@@ -0,0 +1,70 @@
+import json
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.clusters import cell_for, cluster
+from store.models import Author, Book, Review
+
+
+class Rollback(Exception):
+  pass
+
+
+class Command(BaseCommand):
+  help = 'Times review clustering against raw marker payloads on synthetic reviews. Nothing is kept.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--reviews', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+
+  def handle(self, *args, **options):
+    try:
+      with transaction.atomic():
+        self.run(options['reviews'], random.Random(options['seed']))
+        raise Rollback
+    except Rollback:
+      pass
+
+  def run(self, count, rng):
+    user = User.objects.create(username='benchmark-reviewer')
+    author = Author.objects.create(first_name='Bench', last_name='Mark')
+    book = Book.objects.create(title='Benchmark', author=author, description='', price=1)
+
+    # Reviews bunch up around a few hundred "cities", like real traffic.
+    centres = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for _ in range(300)]
+    start = time.time()
+    reviews = []
+    for _ in range(count):
+      centre_lat, centre_lng = rng.choice(centres)
+      lat = min(max(centre_lat + rng.gauss(0, 0.5), -90), 90)
+      lng = min(max(centre_lng + rng.gauss(0, 0.5), -180), 180)
+      reviews.append(Review(book=book, user=user, text='', latitude=lat, longitude=lng, geo_cell=cell_for(lat, lng)))
+    Review.objects.bulk_create(reviews, batch_size=500)
+    self.stdout.write('Seeded %d reviews in %.1fs' % (count, time.time() - start))
+
+    reviews = Review.objects.filter(book=book)
+    start = time.time()
+    points = [
+      {'latitude': latitude, 'longitude': longitude, 'user': {'username': username}}
+      for latitude, longitude, username in reviews.values_list('latitude', 'longitude', 'user__username')
+    ]
+    raw_bytes = len(json.dumps(points))
+    self.stdout.write('one marker per review: %8.1f ms, %10d bytes (%d markers)' % (
+      (time.time() - start) * 1000, raw_bytes, len(points)))
+
+    lat, lng = centres[0]
+    views = [
+      ('world', (-90, -180, 90, 180), 2),
+      ('continent', (max(lat - 15, -90), max(lng - 30, -180), min(lat + 15, 90), min(lng + 30, 180)), 5),
+      ('region', (lat - 2, max(lng - 3, -180), lat + 2, min(lng + 3, 180)), 9),
+    ]
+    for name, bbox, zoom in views:
+      start = time.time()
+      clusters = cluster(reviews, bbox, zoom)
+      elapsed = (time.time() - start) * 1000
+      self.stdout.write('clusters, %-9s z=%-2d: %8.1f ms, %10d bytes (%d clusters, %d reviews)' % (
+        name, zoom, elapsed, len(json.dumps(clusters)), len(clusters), sum(c['count'] for c in clusters)))
@@ -0,0 +1,88 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from store.models import Author, Book
+from store.search import ranked_ids, rebuild_index, search
+
+
+class Rollback(Exception):
+  pass
+
+
+class Command(BaseCommand):
+  help = 'Times indexed catalog search against a LIKE scan on synthetic books. Nothing is kept.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=20)
+
+  def handle(self, *args, **options):
+    try:
+      with transaction.atomic():
+        self.run(options['books'], options['repeat'], random.Random(options['seed']))
+        raise Rollback
+    except Rollback:
+      pass
+
+  def word(self, rng, length):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(length))
+
+  def run(self, count, repeat, rng):
+    # A few thousand words drawn with a skewed distribution, so some terms
+    # are in a large share of the catalog and most are rare.
+    vocabulary = [self.word(rng, rng.randint(3, 10)) for _ in range(5000)]
+    pick = lambda: vocabulary[min(int(rng.paretovariate(1.2)) - 1, len(vocabulary) - 1)]
+    rare = lambda: rng.choice(vocabulary)
+
+    start = time.time()
+    authors = [
+      Author.objects.create(first_name=self.word(rng, 6).title(), last_name=self.word(rng, 8).title())
+      for _ in range(500)
+    ]
+    Book.objects.bulk_create([
+      Book(
+        title=' '.join(rare() for _ in range(rng.randint(1, 5))).title(),
+        description=' '.join(pick() if rng.random() < 0.5 else rare() for _ in range(rng.randint(20, 80))),
+        author=rng.choice(authors),
+        price=rng.randint(1, 50),
+      ) for _ in range(count)
+    ], batch_size=500)
+    self.stdout.write('Seeded %d books in %.1fs' % (count, time.time() - start))
+
+    start = time.time()
+    rebuild_index()
+    self.stdout.write('Built the index in %.1fs' % (time.time() - start))
+
+    queries = [
+      ('common term', lambda: vocabulary[0], False),
+      ('rare term', rare, False),
+      ('two terms', lambda: '%s %s' % (vocabulary[rng.randint(0, 20)], rare()), False),
+      ('prefix', lambda: rare()[:3], True),
+      ('term+prefix', lambda: '%s %s' % (vocabulary[rng.randint(0, 20)], rare()[:3]), True),
+    ]
+    for name, make_query, autocomplete in queries:
+      samples = [make_query() for _ in range(repeat)]
+      start = time.time()
+      for query in samples:
+        ranked_ids(query, 0, 20, autocomplete)
+      ranking = (time.time() - start) * 1000 / repeat
+
+      start = time.time()
+      hits = sum(len(search(query, autocomplete=autocomplete).object_list) for query in samples)
+      page = (time.time() - start) * 1000 / repeat
+
+      # Ranking needs every match, so the scan has to read them all too.
+      start = time.time()
+      for query in samples:
+        condition = Q()
+        for term in query.split():
+          condition &= Q(title__icontains=term) | Q(description__icontains=term)
+        list(Book.objects.filter(condition).values_list('pk', flat=True))
+      scan = (time.time() - start) * 1000 / repeat
+      self.stdout.write('%-12s: ranking %7.2f ms, page %7.2f ms, LIKE scan %8.2f ms per query (%.1f results)' % (
+        name, ranking, page, scan, float(hits) / repeat))
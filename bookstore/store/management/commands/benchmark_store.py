@@ -0,0 +1,230 @@
+import json
+import math
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+
+from store import geo, metrics
+from store.clusters import cell_for
+from store.counters import rebuild_review_counts
+from store.models import Author, Book, BookOrder, Cart, Review
+from store.orders import capture_authorized
+
+PASSWORD = 'benchmark'
+FLOWS = ('storefront', 'book_detail', 'add_remove', 'cart', 'checkout', 'review_api')
+
+
+class Rollback(Exception):
+  pass
+
+
+class StubReader(object):
+  # Stands in for the GeoIP database, which may not be installed.
+  def city(self, ip):
+    return {'city': 'Benchmark', 'country_name': 'Nowhere', 'latitude': 51.5, 'longitude': -0.1}
+
+
+def percentile(samples, p):
+  # Nearest rank, on sorted samples.
+  return samples[max(int(math.ceil(p / 100.0 * len(samples))) - 1, 0)]
+
+
+class Command(BaseCommand):
+  help = ('Seeds a synthetic store and times its main pages through the test client, with stub '
+    'payment, GeoIP and mail backends. Nothing is kept. Compares against --baseline if given.')
+  # The pages are rendered in the site's language.
+  leave_locale_alone = True
+
+  def add_arguments(self, parser):
+    parser.add_argument('--scale', type=float, default=1,
+      help='1 is 1000 books, 200 users, 5000 reviews and 1000 completed orders.')
+    parser.add_argument('--requests', type=int, default=200, help='Timed iterations per flow.')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--flow', action='append', choices=FLOWS, help='Only run these flows.')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with.')
+    parser.add_argument('--save-baseline', help='Write this run\'s results here.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+      help='How much slower p50 and p95 may get before the run fails (0.25 is 25%%).')
+
+  def handle(self, *args, **options):
+    baseline = None
+    if options['baseline']:
+      with open(options['baseline']) as f:
+        baseline = json.load(f)
+      if (baseline['scale'], baseline['seed']) != (options['scale'], options['seed']):
+        raise CommandError('The baseline was recorded with --scale %s --seed %s' % (baseline['scale'], baseline['seed']))
+
+    stubs = override_settings(
+      ALLOWED_HOSTS=['testserver'],
+      CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}},
+      EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+      PAYMENT_GATEWAYS={
+        'paypal': {'BACKEND': 'store.payments.FakeGateway'},
+        'stripe': {'BACKEND': 'store.payments.FakeGateway'},
+      },
+    )
+    reader = geo._reader
+    geo._reader = StubReader()
+    geo.city_cache.clear()
+    results = {}
+    try:
+      with stubs, transaction.atomic():
+        cache.clear()
+        self.seed(options['scale'], random.Random(options['seed']))
+        for flow in options['flow'] or FLOWS:
+          # Each flow draws its own books, so running a subset of the flows
+          # gives each the same requests as a full run.
+          rng = random.Random('%s-%s' % (options['seed'], flow))
+          results[flow] = self.run(flow, options['requests'], options['warmup'], rng)
+        raise Rollback
+    except Rollback:
+      pass
+    finally:
+      geo._reader = reader
+      geo.city_cache.clear()
+
+    run = {'scale': options['scale'], 'seed': options['seed'], 'flows': results}
+    if options['save_baseline']:
+      with open(options['save_baseline'], 'w') as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+      self.stdout.write('Saved the results to %s' % options['save_baseline'])
+    if baseline is not None:
+      regressions = self.compare(results, baseline['flows'], options['tolerance'])
+      if regressions:
+        raise CommandError('Slower than the baseline:\n  %s' % '\n  '.join(regressions))
+      self.stdout.write('No regressions against %s' % options['baseline'])
+
+  def seed(self, scale, rng):
+    start = time.time()
+    book_count = max(int(1000 * scale), 10)
+    user_count = max(int(200 * scale), 10)
+
+    authors = Author.objects.bulk_create([
+      Author(first_name='First%d' % i, last_name='Last%d' % i) for i in range(max(book_count // 10, 1))
+    ])
+    authors = list(Author.objects.order_by('-pk')[:len(authors)])
+    Book.objects.bulk_create([
+      Book(title='Book %d' % i, author=rng.choice(authors), description='A mystery. ' * 20,
+        price=rng.randint(5, 40), stock=10 ** 6)
+      for i in range(book_count)
+    ], batch_size=500)
+    self.books = list(Book.objects.order_by('-pk').values_list('pk', flat=True)[:book_count])
+
+    password = make_password(PASSWORD)
+    User.objects.bulk_create([
+      User(username='benchmark%d' % i, email='benchmark%d@example.com' % i, password=password)
+      for i in range(user_count)
+    ], batch_size=500)
+    users = list(User.objects.filter(username__startswith='benchmark').values_list('pk', flat=True))
+
+    reviews = []
+    for _ in range(int(5000 * scale)):
+      lat, lng = rng.uniform(-60, 70), rng.uniform(-180, 180)
+      reviews.append(Review(book_id=rng.choice(self.books), user_id=rng.choice(users), text='Gripping. ' * 10,
+        latitude=lat, longitude=lng, geo_cell=cell_for(lat, lng)))
+    Review.objects.bulk_create(reviews, batch_size=500)
+    rebuild_review_counts()
+
+    # Completed orders for everyone, and an open cart for a quarter of the
+    # users.
+    Cart.objects.bulk_create([
+      Cart(user_id=rng.choice(users), active=False, order_date=time.strftime('%Y-%m-%d'), payment_type='Stripe',
+        payment_status=Cart.CAPTURED, stock_committed=True)
+      for _ in range(int(1000 * scale))
+    ] + [Cart(user_id=user_id) for user_id in users[:user_count // 4]], batch_size=500)
+    BookOrder.objects.bulk_create([
+      BookOrder(cart_id=cart_id, book_id=book_id, quantity=rng.randint(1, 2))
+      for cart_id in Cart.objects.filter(user__in=users).values_list('pk', flat=True).iterator()
+      for book_id in rng.sample(self.books, 3)
+    ], batch_size=500)
+
+    # A few signed-in shoppers, each with an open cart.
+    self.clients = []
+    for username in User.objects.filter(pk__in=users[:5]).values_list('username', flat=True):
+      client = Client()
+      client.login(username=username, password=PASSWORD)
+      self.clients.append(client)
+    self.stdout.write('Seeded %d books, %d users and %d reviews in %.1fs' % (
+      len(self.books), len(users), len(reviews), time.time() - start))
+
+  def requests(self, flow, rng):
+    # The requests of one pass through the flow, as (method, path, data).
+    book = rng.choice(self.books)
+    if flow == 'storefront':
+      return [('get', reverse('index'), None)]
+    if flow == 'book_detail':
+      return [('get', reverse('book_details', args=[book]), None)]
+    if flow == 'add_remove':
+      return [('get', reverse('add_to_cart', args=[book]), None), ('get', reverse('remove_from_cart', args=[book]), None)]
+    if flow == 'cart':
+      return [('get', reverse('cart'), None)]
+    if flow == 'checkout':
+      return [
+        ('get', reverse('add_to_cart', args=[book]), None),
+        ('post', reverse('checkout', args=['stripe']), {'stripeToken': 'tok_benchmark'}),
+        ('post', reverse('process_order', args=['stripe']), None),
+        ('get', reverse('complete_order', args=['stripe']), None),
+      ]
+    if flow == 'review_api':
+      return [('get', '/api/v1/review/', {'book': book, 'format': 'json'})]
+
+  def run(self, flow, count, warmup, rng):
+    latencies = []
+    elapsed = 0
+    for metric in metrics.REGISTRY:
+      metric.clear()
+    for i in range(warmup + count):
+      client = self.clients[i % len(self.clients)]
+      if i == warmup:
+        for metric in metrics.REGISTRY:
+          metric.clear()
+      for method, path, data in self.requests(flow, rng):
+        start = time.time()
+        response = getattr(client, method)(path, data)
+        took = time.time() - start
+        if response.status_code >= 400:
+          raise CommandError('%s %s answered %d' % (method.upper(), path, response.status_code))
+        if i >= warmup:
+          latencies.append(took * 1000)
+          elapsed += took
+      if flow == 'checkout':
+        # Off the request path, like the reconcile_payments worker.
+        capture_authorized()
+
+    latencies.sort()
+    requests, queries = metrics.REQUEST_QUERIES.totals()
+    result = {
+      'requests': len(latencies),
+      'p50': percentile(latencies, 50),
+      'p95': percentile(latencies, 95),
+      'p99': percentile(latencies, 99),
+      'queries': float(queries) / max(requests, 1),
+      'throughput': len(latencies) / max(elapsed, 0.001),
+    }
+    self.stdout.write('%-12s: p50 %7.2f ms, p95 %7.2f ms, p99 %7.2f ms, %5.1f queries, %7.1f requests/s' % (
+      flow, result['p50'], result['p95'], result['p99'], result['queries'], result['throughput']))
+    return result
+
+  def compare(self, results, baseline, tolerance):
+    # Latency may wander by the tolerance; query counts are deterministic
+    # for a given scale and seed, so any increase is a regression.
+    regressions = []
+    for flow, result in sorted(results.items()):
+      before = baseline.get(flow)
+      if before is None:
+        continue
+      for key in ('p50', 'p95'):
+        if result[key] > before[key] * (1 + tolerance):
+          regressions.append('%s %s: %.2f ms, was %.2f ms' % (flow, key, result[key], before[key]))
+      if result['queries'] > before['queries'] + 0.01:
+        regressions.append('%s queries per request: %.1f, was %.1f' % (flow, result['queries'], before['queries']))
+    return regressions
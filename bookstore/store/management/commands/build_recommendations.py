@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.recommendations import rebuild_recommendations, update_recommendations
+
+
+class Command(BaseCommand):
+  help = 'Updates the "customers also bought" lists from newly completed orders.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--rebuild', action='store_true',
+      help='Recompute every list from all completed orders.')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--loop', action='store_true',
+      help='Keep polling for new orders instead of exiting once there are none.')
+    parser.add_argument('--interval', type=float, default=60,
+      help='Seconds to sleep between polls when --loop is set.')
+
+  def handle(self, *args, **options):
+    if options['rebuild']:
+      count = rebuild_recommendations()
+      self.stdout.write('Recommendations rebuilt for %d books.' % count)
+      if not options['loop']:
+        return
+
+    while True:
+      count = update_recommendations(options['batch_size'])
+      if count:
+        self.stdout.write('Counted %d orders' % count)
+      else:
+        if not options['loop']:
+          break
+        time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.catalog import WRITERS, export_rows
+
+
+class Command(BaseCommand):
+  help = 'Exports every book as CSV or JSON lines, in the format import_catalog reads.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--output', default='-', help='File to write; defaults to stdout.')
+    parser.add_argument('--format', choices=sorted(WRITERS),
+      help='Defaults to the file extension, or csv for stdout.')
+    parser.add_argument('--batch-size', type=int, default=None)
+
+  def handle(self, *args, **options):
+    path = options['output']
+    file_format = options['format']
+    if not file_format:
+      file_format = 'csv' if path == '-' else os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in WRITERS:
+      raise CommandError('Unknown format %r; use --format' % file_format)
+
+    try:
+      stream = self.stdout if path == '-' else open(path, 'wb')
+    except IOError as e:
+      raise CommandError(e)
+    try:
+      WRITERS[file_format](export_rows(options['batch_size']), stream)
+    finally:
+      if stream is not self.stdout:
+        stream.close()
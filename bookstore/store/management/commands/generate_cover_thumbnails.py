@@ -0,0 +1,47 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.models import Book
+from store.thumbnails import generate_derivatives, has_derivatives
+
+
+def build(name):
+  try:
+    return name, len(generate_derivatives(name)), None
+  except IOError as e:
+    return name, 0, str(e)
+
+
+class Command(BaseCommand):
+  help = 'Builds the cover thumbnails of existing books across a process pool.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--force', action='store_true',
+      help='Rebuild thumbnails that already exist.')
+
+  def handle(self, *args, **options):
+    names = set(Book.objects.values_list('cover_image', flat=True).distinct())
+    names = sorted(name for name in names if name and (options['force'] or not has_derivatives(name)))
+    if not names:
+      self.stdout.write('All covers already have thumbnails.')
+      return
+
+    start = time.time()
+    pool = multiprocessing.Pool(options['processes'])
+    written = failed = 0
+    try:
+      for name, count, error in pool.imap_unordered(build, names):
+        if error:
+          failed += 1
+          self.stderr.write('%s: %s' % (name, error))
+        else:
+          written += count
+    finally:
+      pool.close()
+      pool.join()
+
+    self.stdout.write('%d covers, %d thumbnails written, %d failed in %.1fs' % (
+      len(names), written, failed, time.time() - start))
@@ -0,0 +1,44 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.catalog import READERS, import_rows
+
+
+class Command(BaseCommand):
+  help = ('Imports books and stock from a CSV or JSON lines file ("-" for stdin). '
+    'Rows with an id update that book; rows without one add a book.')
+
+  def add_arguments(self, parser):
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=sorted(READERS),
+      help='Defaults to the file extension, or csv for stdin.')
+    parser.add_argument('--batch-size', type=int, default=None)
+
+  def handle(self, *args, **options):
+    path = options['path']
+    file_format = options['format']
+    if not file_format:
+      file_format = 'csv' if path == '-' else os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in READERS:
+      raise CommandError('Unknown format %r; use --format' % file_format)
+
+    try:
+      stream = sys.stdin if path == '-' else open(path, 'rb')
+    except IOError as e:
+      raise CommandError(e)
+
+    def report(stats):
+      self.stdout.write('%d rows: %d created, %d updated, %d skipped (%.0f rows/s)' % (
+        stats.rows, stats.created, stats.updated, stats.skipped, stats.rate))
+
+    try:
+      stats = import_rows(READERS[file_format](stream), options['batch_size'], report)
+    finally:
+      if stream is not sys.stdin:
+        stream.close()
+    for error in stats.errors:
+      self.stderr.write(error)
+    if stats.skipped > len(stats.errors):
+      self.stderr.write('... and %d more rejected rows' % (stats.skipped - len(stats.errors)))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from store.counters import rebuild_review_counts
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the denormalized per-book and per-user review counters.'
+
+  def handle(self, *args, **options):
+    rebuild_review_counts()
+    self.stdout.write('Review counters rebuilt.')
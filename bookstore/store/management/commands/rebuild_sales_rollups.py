@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from store.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the daily sales rollups from completed orders.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--since', help='Only rebuild days from this date (YYYY-MM-DD) on.')
+
+  def handle(self, *args, **options):
+    since = None
+    if options['since']:
+      since = parse_date(options['since'])
+      if since is None:
+        raise CommandError('Invalid date: %s' % options['since'])
+    count = rebuild_rollups(since)
+    self.stdout.write('Sales rollups rebuilt from %d orders.' % count)
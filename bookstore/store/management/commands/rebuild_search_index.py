@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from store.search import rebuild_index
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the catalog search index from scratch.'
+
+  def handle(self, *args, **options):
+    count = rebuild_index()
+    self.stdout.write('Search index rebuilt for %d books.' % count)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.orders import capture_authorized
+
+
+class Command(BaseCommand):
+  help = 'Captures authorized payments in batches and closes their carts.'
+  # Closing a cart renders the purchase email, which localizes prices.
+  leave_locale_alone = True
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--max-attempts', type=int, default=None)
+    parser.add_argument('--loop', action='store_true',
+      help='Keep polling for authorized payments instead of exiting once there are none.')
+    parser.add_argument('--interval', type=float, default=2,
+      help='Seconds to sleep between polls when --loop is set.')
+
+  def handle(self, *args, **options):
+    while True:
+      captured, failed = capture_authorized(options['batch_size'], options['max_attempts'])
+      if captured or failed:
+        self.stdout.write('Captured %d, failed %d' % (captured, failed))
+      else:
+        if not options['loop']:
+          break
+        time.sleep(options['interval'])
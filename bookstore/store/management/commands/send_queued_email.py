@@ -0,0 +1,49 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from store.outbox import send_queued
+
+
+class Command(BaseCommand):
+  help = 'Sends queued outbound email in batches over a single mail connection.'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--max-attempts', type=int, default=None)
+    parser.add_argument('--loop', action='store_true',
+      help='Keep draining the outbox instead of exiting once it is empty.')
+    parser.add_argument('--interval', type=float, default=5,
+      help='Seconds to sleep between polls when --loop is set.')
+
+  def handle(self, *args, **options):
+    # One connection for every batch and every poll. It is reopened after
+    # failures, in case the server dropped it.
+    connection = get_connection()
+    is_open = False
+    try:
+      while True:
+        try:
+          if not is_open:
+            connection.open()
+            is_open = True
+          sent, failed = send_queued(options['batch_size'], options['max_attempts'], connection)
+        except Exception as e:
+          if not options['loop']:
+            raise
+          self.stderr.write('Mail connection failed: %s' % e)
+          sent = failed = 0
+          connection.close()
+          is_open = False
+        if sent or failed:
+          self.stdout.write('Sent %d, failed %d' % (sent, failed))
+        if failed and is_open:
+          connection.close()
+          is_open = False
+        if not (sent or failed):
+          if not options['loop']:
+            break
+          time.sleep(options['interval'])
+    finally:
+      connection.close()
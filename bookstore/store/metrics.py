@@ -0,0 +1,271 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+# Per-view request metrics, kept in this process and exposed in the
+# Prometheus text format by the metrics view. MetricsMiddleware starts a
+# RequestStats for each request in a thread local; database cursors,
+# templates and timed() blocks around GeoIP, SMTP and payment calls add to
+# it, and the middleware files the totals under the resolved URL name.
+# Every worker process keeps its own figures, so scrape each one (or sum
+# them at the collector).
+
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+REGISTRY = []
+
+
+def _escape(value):
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+  pairs = list(zip(names, values)) + list(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+class Metric(object):
+  kind = None
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self._series = {}
+    self._lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def clear(self):
+    with self._lock:
+      self._series.clear()
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+    with self._lock:
+      series = [(key, self.copy(value)) for key, value in sorted(self._series.items())]
+    for key, value in series:
+      lines.extend(self.samples(key, value))
+    return lines
+
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, *labels):
+    with self._lock:
+      self._series[labels] = self._series.get(labels, 0) + 1
+
+  def value(self, *labels):
+    return self._series.get(labels, 0)
+
+  def copy(self, value):
+    return value
+
+  def samples(self, key, value):
+    yield '%s%s %d' % (self.name, _labels(self.labels, key), value)
+
+
+class Histogram(Metric):
+  # Fixed buckets: an observation is one bisect and two additions under
+  # the lock.
+  kind = 'histogram'
+
+  def __init__(self, name, help, buckets, labels=()):
+    super(Histogram, self).__init__(name, help, labels)
+    self.buckets = buckets
+
+  def observe(self, value, *labels):
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      series = self._series.get(labels)
+      if series is None:
+        series = self._series[labels] = [0.0] + [0] * (len(self.buckets) + 1)
+      series[0] += value
+      series[index + 1] += 1
+
+  def count(self, *labels):
+    series = self._series.get(labels)
+    return sum(series[1:]) if series else 0
+
+  def totals(self):
+    # (observations, sum) over every series.
+    with self._lock:
+      series = list(self._series.values())
+    return sum(sum(values[1:]) for values in series), sum(values[0] for values in series)
+
+  def copy(self, series):
+    return list(series)
+
+  def samples(self, key, series):
+    total = 0
+    for bound, count in zip(self.buckets + ('+Inf',), series[1:]):
+      total += count
+      yield '%s_bucket%s %d' % (self.name, _labels(self.labels, key, [('le', str(bound))]), total)
+    yield '%s_sum%s %r' % (self.name, _labels(self.labels, key), series[0])
+    yield '%s_count%s %d' % (self.name, _labels(self.labels, key), total)
+
+
+REQUEST_SECONDS = Histogram('store_request_seconds',
+  'Wall time per request.', TIME_BUCKETS, ('view',))
+REQUEST_QUERIES = Histogram('store_request_queries',
+  'Database queries per request.', COUNT_BUCKETS, ('view',))
+QUERY_SECONDS = Histogram('store_request_query_seconds',
+  'Time per request spent in database queries.', TIME_BUCKETS, ('view',))
+TEMPLATE_SECONDS = Histogram('store_request_template_seconds',
+  'Time per request spent rendering templates, queries run from them included.', TIME_BUCKETS, ('view',))
+EXTERNAL_SECONDS = Histogram('store_request_external_seconds',
+  'Time per request spent calling GeoIP, SMTP and payment services.', TIME_BUCKETS, ('view', 'service'))
+QUERY_LIMIT_EXCEEDED = Counter('store_query_limit_exceeded_total',
+  'Requests that ran more than METRICS_QUERY_LIMIT queries.', ('view',))
+
+
+class RequestStats(object):
+  __slots__ = ('started', 'queries', 'query_seconds', 'template_seconds', 'rendering', 'external')
+
+  def __init__(self):
+    self.started = time.time()
+    self.queries = 0
+    self.query_seconds = 0.0
+    self.template_seconds = 0.0
+    self.rendering = False
+    self.external = {}
+
+
+_local = threading.local()
+
+
+def current():
+  # The RequestStats of the request this thread is serving, if any.
+  return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def timed(service):
+  # Adds the time spent in the block to the current request's external
+  # call time for service ('geoip', 'smtp' or 'payment').
+  stats = current()
+  if stats is None:
+    yield
+    return
+  start = time.time()
+  try:
+    yield
+  finally:
+    stats.external[service] = stats.external.get(service, 0.0) + time.time() - start
+
+
+class TimedCursor(object):
+  def execute(self, sql, params=None):
+    stats = current()
+    if stats is None:
+      return super(TimedCursor, self).execute(sql, params)
+    start = time.time()
+    try:
+      return super(TimedCursor, self).execute(sql, params)
+    finally:
+      stats.queries += 1
+      stats.query_seconds += time.time() - start
+
+  def executemany(self, sql, param_list):
+    stats = current()
+    if stats is None:
+      return super(TimedCursor, self).executemany(sql, param_list)
+    start = time.time()
+    try:
+      return super(TimedCursor, self).executemany(sql, param_list)
+    finally:
+      stats.queries += 1
+      stats.query_seconds += time.time() - start
+
+
+class TimedCursorWrapper(TimedCursor, CursorWrapper):
+  pass
+
+
+class TimedCursorDebugWrapper(TimedCursor, CursorDebugWrapper):
+  pass
+
+
+def time_queries(sender, connection, **kwargs):
+  connection.make_cursor = lambda cursor: TimedCursorWrapper(cursor, connection)
+  connection.make_debug_cursor = lambda cursor: TimedCursorDebugWrapper(cursor, connection)
+
+
+class TimedTemplate(Template):
+  def render(self, context=None, request=None):
+    stats = current()
+    # Included and inherited templates are rendered inside the outer one
+    # and are only counted once.
+    if stats is None or stats.rendering:
+      return super(TimedTemplate, self).render(context, request)
+    stats.rendering = True
+    start = time.time()
+    try:
+      return super(TimedTemplate, self).render(context, request)
+    finally:
+      stats.rendering = False
+      stats.template_seconds += time.time() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+  # DjangoTemplates whose templates time their rendering.
+  def from_string(self, template_code):
+    return TimedTemplate(super(TimedDjangoTemplates, self).from_string(template_code).template)
+
+  def get_template(self, *args, **kwargs):
+    return TimedTemplate(super(TimedDjangoTemplates, self).get_template(*args, **kwargs).template)
+
+
+def view_name(request):
+  match = getattr(request, 'resolver_match', None)
+  return match.view_name if match is not None and match.view_name else '<unresolved>'
+
+
+class MetricsMiddleware(object):
+  # First in MIDDLEWARE_CLASSES, so the time of every other middleware is
+  # counted too.
+  def process_request(self, request):
+    _local.stats = RequestStats()
+
+  def process_response(self, request, response):
+    stats = current()
+    if stats is None:
+      return response
+    _local.stats = None
+    view = view_name(request)
+    REQUEST_SECONDS.observe(time.time() - stats.started, view)
+    REQUEST_QUERIES.observe(stats.queries, view)
+    QUERY_SECONDS.observe(stats.query_seconds, view)
+    TEMPLATE_SECONDS.observe(stats.template_seconds, view)
+    for service, seconds in stats.external.items():
+      EXTERNAL_SECONDS.observe(seconds, view, service)
+    if stats.queries > settings.METRICS_QUERY_LIMIT:
+      QUERY_LIMIT_EXCEEDED.inc(view)
+      logger.warning('%s %s (%s) ran %d queries in %.1f ms', request.method, request.path, view,
+        stats.queries, stats.query_seconds * 1000)
+    return response
+
+
+def render_metrics():
+  lines = []
+  for metric in REGISTRY:
+    lines.extend(metric.render())
+  return '\n'.join(lines) + '\n'
+
+
+def metrics(request):
+  if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+    return HttpResponseForbidden()
+  return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_auto_20180613_2107'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='book',
+            index_together=set([('publish_date', 'id')]),
+        ),
+    ]
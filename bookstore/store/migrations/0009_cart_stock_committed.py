@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def mark_completed_carts(apps, schema_editor):
+    # Completed carts already had their stock taken by the old receiver.
+    Cart = apps.get_model('store', 'Cart')
+    Cart.objects.filter(active=False).update(stock_committed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_auto_20261018_2035'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='stock_committed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_completed_carts, migrations.RunPython.noop),
+    ]
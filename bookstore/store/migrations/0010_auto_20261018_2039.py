@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+from django.db.models import Count
+
+
+def count_reviews(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    Review = apps.get_model('store', 'Review')
+    ReviewerStats = apps.get_model('store', 'ReviewerStats')
+    for book_id, count in Review.objects.order_by().values_list('book').annotate(Count('id')):
+        Book.objects.filter(pk=book_id).update(review_count=count)
+    ReviewerStats.objects.bulk_create([
+        ReviewerStats(user_id=user_id, review_count=count)
+        for user_id, count in Review.objects.order_by().values_list('user').annotate(Count('id'))
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0006_require_contenttypes_0002'),
+        ('store', '0009_cart_stock_committed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReviewerStats',
+            fields=[
+                ('user', models.OneToOneField(primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('review_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='review_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_reviews, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Case, Value, When
+
+GRID_BITS = 16
+BATCH_SIZE = 300
+
+
+# A copy of store.clusters.cell_for as it was when this migration was
+# written, so later changes to the app can't change what it does.
+def cell_for(latitude, longitude):
+    def quantize(value, low, high):
+        cell = int((value - low) / (high - low) * (1 << GRID_BITS))
+        return min(max(cell, 0), (1 << GRID_BITS) - 1)
+    x = quantize(float(longitude), -180.0, 180.0)
+    y = quantize(float(latitude), -90.0, 90.0)
+    code = 0
+    for bit in range(GRID_BITS):
+        code |= ((x >> bit) & 1) << (2 * bit)
+        code |= ((y >> bit) & 1) << (2 * bit + 1)
+    return code
+
+
+def index_reviews(apps, schema_editor):
+    Review = apps.get_model('store', 'Review')
+    rows = Review.objects.order_by('pk').values_list('pk', 'latitude', 'longitude')
+    last = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last)[:BATCH_SIZE])
+        if not batch:
+            break
+        # One UPDATE per batch; the batch size keeps the query under
+        # SQLite's limit of 999 parameters.
+        Review.objects.filter(pk__in=[pk for pk, _, _ in batch]).update(geo_cell=Case(
+            *[When(pk=pk, then=Value(cell_for(latitude, longitude))) for pk, latitude, longitude in batch],
+            output_field=models.BigIntegerField()
+        ))
+        last = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_auto_20261018_2039'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='geo_cell',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='review',
+            index_together=set([('book', 'geo_cell')]),
+        ),
+        migrations.RunPython(index_reviews, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count, Sum
+
+from ._partial_indexes import create_active_cart_index, drop_active_cart_index
+
+
+def merge_duplicates(apps, schema_editor):
+    # Fold each user's extra active carts into one, then merge repeated
+    # (cart, book) lines so the unique constraints can be added. The cart
+    # kept is the newest one carrying a payment, so a buyer coming back from
+    # PayPal still finds their cart and its lines; without a payment it is
+    # the newest cart. Older payments were abandoned for the newer checkout.
+    Cart = apps.get_model('store', 'Cart')
+    BookOrder = apps.get_model('store', 'BookOrder')
+    duplicated = Cart.objects.filter(active=True).values('user').annotate(carts=Count('id')).filter(carts__gt=1)
+    for row in duplicated:
+        carts = list(Cart.objects.filter(user=row['user'], active=True).order_by('-id'))
+        paid = [cart for cart in carts if cart.payment_id]
+        keep = paid[0] if paid else carts[0]
+        others = [cart.pk for cart in carts if cart.pk != keep.pk]
+        BookOrder.objects.filter(cart__in=others).update(cart=keep)
+        Cart.objects.filter(pk__in=others).delete()
+
+    lines = BookOrder.objects.values('cart', 'book').annotate(lines=Count('id'), total=Sum('quantity')).filter(lines__gt=1)
+    for row in lines:
+        orders = BookOrder.objects.filter(cart=row['cart'], book=row['book']).order_by('id')
+        keep = orders[0]
+        orders.exclude(pk=keep.pk).delete()
+        BookOrder.objects.filter(pk=keep.pk).update(quantity=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_auto_20261018_2040'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cart',
+            name='payment_id',
+            field=models.CharField(max_length=100, null=True, db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='bookorder',
+            unique_together=set([('cart', 'book')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cart',
+            index_together=set([('user', 'active')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='review',
+            index_together=set([('book', 'geo_cell'), ('user', 'book')]),
+        ),
+        migrations.RunPython(create_active_cart_index, drop_active_cart_index),
+    ]
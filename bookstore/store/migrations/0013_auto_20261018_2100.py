@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from ._partial_indexes import create_active_cart_index
+
+
+def mark_completed_carts(apps, schema_editor):
+    Cart = apps.get_model('store', 'Cart')
+    Cart.objects.filter(active=False).update(payment_status='captured')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_auto_20261018_2052'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='payment_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='payment_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='payment_next_attempt',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='payment_status',
+            field=models.CharField(default=b'pending', max_length=10, choices=[(b'pending', b'Pending'), (b'authorized', b'Authorized'), (b'captured', b'Captured'), (b'failed', b'Failed')]),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='payment_token',
+            field=models.CharField(max_length=100, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='cart',
+            index_together=set([('payment_status', 'payment_next_attempt'), ('user', 'active')]),
+        ),
+        migrations.RunPython(mark_completed_carts, migrations.RunPython.noop),
+        migrations.RunPython(create_active_cart_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+import re
+import unicodedata
+from collections import Counter
+
+# A copy of store.search's tokenizer as it was when this migration was
+# written, so later changes to it (or to the models it imports) leave the
+# migration alone.
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have in is it its of on or that the this to was with'.split()
+)
+MAX_TERM_LENGTH = 40
+MAX_DESCRIPTION_WEIGHT = 5
+TITLE_WEIGHT = 10
+AUTHOR_WEIGHT = 5
+# Books read and indexed per round, so the terms of the whole catalog are
+# never held at once.
+BATCH_SIZE = 500
+
+
+def normalize(text):
+    try:
+        return text.encode('ascii').lower().decode('ascii')
+    except UnicodeEncodeError:
+        pass
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+    return [
+        token[:MAX_TERM_LENGTH] for token in TOKEN.findall(normalize(text))
+        if len(token) > 1 and token not in STOPWORDS
+    ]
+
+
+def book_terms(title, description, author_names):
+    weights = Counter()
+    for term in set(tokenize(title)):
+        weights[term] += TITLE_WEIGHT
+    for term in set(tokenize(author_names)):
+        weights[term] += AUTHOR_WEIGHT
+    for term, count in Counter(tokenize(description)).items():
+        weights[term] += min(count, MAX_DESCRIPTION_WEIGHT)
+    return weights
+
+
+def index_books(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    SearchTerm = apps.get_model('store', 'SearchTerm')
+    fields = ('pk', 'title', 'description', 'author__first_name', 'author__last_name')
+    last_id = 0
+    while True:
+        books = list(Book.objects.filter(pk__gt=last_id).order_by('pk').values_list(*fields)[:BATCH_SIZE])
+        if not books:
+            return
+        terms = []
+        for pk, title, description, first_name, last_name in books:
+            author_names = '%s %s' % (first_name, last_name)
+            for term, weight in book_terms(title, description, author_names).items():
+                terms.append(SearchTerm(term=term, book_id=pk, weight=weight))
+        SearchTerm.objects.bulk_create(terms, batch_size=500)
+        last_id = books[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_auto_20261018_2100'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('term', models.CharField(max_length=40)),
+                ('weight', models.IntegerField()),
+                ('book', models.ForeignKey(to='store.Book')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchterm',
+            unique_together=set([('term', 'book')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='searchterm',
+            index_together=set([('term', 'weight', 'book')]),
+        ),
+        migrations.RunPython(index_books, migrations.RunPython.noop),
+    ]
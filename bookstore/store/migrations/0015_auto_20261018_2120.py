@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from ._partial_indexes import create_active_cart_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_auto_20261018_2106'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Recommendation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.IntegerField()),
+                ('book', models.ForeignKey(related_name='recommendations', to='store.Book')),
+                ('recommended', models.ForeignKey(related_name='+', to='store.Book')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='in_recommendations',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='cart',
+            index_together=set([('payment_status', 'payment_next_attempt'), ('active', 'in_recommendations'), ('user', 'active')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recommendation',
+            unique_together=set([('book', 'rank')]),
+        ),
+        migrations.RunPython(create_active_cart_index, migrations.RunPython.noop),
+    ]
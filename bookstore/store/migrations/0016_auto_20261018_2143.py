@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0015_auto_20261018_2120'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyBookSales',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('book', models.ForeignKey(to='store.Book')),
+            ],
+            options={
+                'verbose_name_plural': 'daily book sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyPaymentSales',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('payment_type', models.CharField(max_length=100)),
+                ('orders', models.IntegerField(default=0)),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+            ],
+            options={
+                'verbose_name_plural': 'daily payment sales',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailypaymentsales',
+            unique_together=set([('date', 'payment_type')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailybooksales',
+            unique_together=set([('date', 'book')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='dailybooksales',
+            index_together=set([('book', 'date')]),
+        ),
+    ]
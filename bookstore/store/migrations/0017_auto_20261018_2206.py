@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_auto_20261018_2143'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='review',
+            name='geo_cell',
+            field=models.BigIntegerField(default=0, editable=False, db_index=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from ._partial_indexes import create_active_cart_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0017_auto_20261018_2206'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='cart',
+            index_together=set([('payment_status', 'payment_next_attempt'), ('active', 'in_recommendations')]),
+        ),
+        migrations.RunPython(create_active_cart_index, migrations.RunPython.noop),
+    ]
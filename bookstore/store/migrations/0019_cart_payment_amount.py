@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from ._partial_indexes import create_active_cart_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_auto_20261018_2211'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='payment_amount',
+            field=models.DecimalField(null=True, max_digits=10, decimal_places=2),
+        ),
+        migrations.RunPython(create_active_cart_index, migrations.RunPython.noop),
+    ]
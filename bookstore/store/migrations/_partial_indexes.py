@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# The partial unique index allowing one active cart per user. Django can't
+# declare it, so it is written by hand, and SQLite drops it whenever a
+# migration rebuilds store_cart: such migrations end with
+# RunPython(create_active_cart_index). The name starts with an underscore
+# so the migration loader skips this module.
+
+ACTIVE_CART_INDEX = 'store_cart_one_active_per_user'
+PARTIAL_INDEX_VENDORS = ('sqlite', 'postgresql')
+
+
+def create_active_cart_index(apps, schema_editor):
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS %s ON store_cart (user_id) WHERE active' % ACTIVE_CART_INDEX
+        )
+
+
+def drop_active_cart_index(apps, schema_editor):
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % ACTIVE_CART_INDEX)
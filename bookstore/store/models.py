@@ -1,6 +1,11 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Sum, Case, When, Value, ExpressionWrapper
 from django.utils import timezone
 from django.contrib.auth.models import User
+from decimal import Decimal
+import operator
+
+from .clusters import cell_for
 
 class Author(models.Model):
   first_name = models.CharField(max_length=100)
@@ -22,6 +27,10 @@ class Book(models.Model):
   price = models.DecimalField(decimal_places=2, max_digits=8)
   stock = models.IntegerField(default=0)
   cover_image = models.ImageField(upload_to=cover_upload_path, default='books/empty_cover.jpg')
+  review_count = models.IntegerField(default=0, editable=False)
+
+  class Meta:
+    index_together = [['publish_date', 'id']]
 
   def __unicode__(self):
     return self.title
@@ -33,41 +42,281 @@ class Review(models.Model):
   text = models.TextField()
   latitude = models.FloatField(max_length=20, default='42.208823')
   longitude = models.FloatField(max_length=20, default='-122.731823')
+  geo_cell = models.BigIntegerField(default=0, editable=False, db_index=True)
+
+  class Meta:
+    index_together = [['book', 'geo_cell'], ['user', 'book']]
+
+  def save(self, *args, **kwargs):
+    self.geo_cell = cell_for(self.latitude, self.longitude)
+    super(Review, self).save(*args, **kwargs)
+
+class ReviewerStats(models.Model):
+  # Per-user review counters, kept up to date by the Review signal receivers.
+  user = models.OneToOneField(User, primary_key=True)
+  review_count = models.IntegerField(default=0)
+
+  @classmethod
+  def review_count_for(cls, user):
+    return cls.objects.filter(user=user).values_list('review_count', flat=True).first() or 0
+
+  @classmethod
+  def adjust(cls, user_id, delta):
+    updated = cls.objects.filter(user_id=user_id).update(review_count=F('review_count') + delta)
+    if not updated and delta > 0:
+      cls.objects.create(user_id=user_id, review_count=delta)
+
+class SearchTerm(models.Model):
+  # Inverted index of book titles, descriptions and author names, kept in
+  # sync by the Book and Author signal receivers; see store.search.
+  term = models.CharField(max_length=40)
+  book = models.ForeignKey(Book)
+  weight = models.IntegerField()
+
+  class Meta:
+    unique_together = [['term', 'book']]
+    index_together = [['term', 'weight', 'book']]
+
+class Recommendation(models.Model):
+  # "Customers also bought": the top books bought in the same orders as
+  # book, precomputed by the build_recommendations command; see
+  # store.recommendations.
+  book = models.ForeignKey(Book, related_name='recommendations')
+  recommended = models.ForeignKey(Book, related_name='+')
+  rank = models.PositiveSmallIntegerField()
+  # Number of completed orders containing both books.
+  score = models.IntegerField()
+
+  class Meta:
+    unique_together = [['book', 'rank']]
+
+class DailyBookSales(models.Model):
+  # Units sold and revenue per book per day, added to as carts complete;
+  # see store.rollups.
+  date = models.DateField()
+  book = models.ForeignKey(Book)
+  units = models.IntegerField(default=0)
+  revenue = models.DecimalField(decimal_places=2, max_digits=12, default=0)
+
+  class Meta:
+    unique_together = [['date', 'book']]
+    index_together = [['book', 'date']]
+    verbose_name_plural = 'daily book sales'
+
+class DailyPaymentSales(models.Model):
+  # Orders, units and revenue per payment type per day; see store.rollups.
+  date = models.DateField()
+  payment_type = models.CharField(max_length=100)
+  orders = models.IntegerField(default=0)
+  units = models.IntegerField(default=0)
+  revenue = models.DecimalField(decimal_places=2, max_digits=12, default=0)
+
+  class Meta:
+    unique_together = [['date', 'payment_type']]
+    verbose_name_plural = 'daily payment sales'
+
+class OutOfStock(Exception):
+  pass
+
+
+class CartSummary(object):
+  # Lines, item count and total of one or more carts, built from a single
+  # query that joins each order to its book and author and prices the line
+  # in the database.
+  def __init__(self, orders):
+    self.lines = orders.select_related('book__author').annotate(
+      line_total=ExpressionWrapper(
+        F('book__price') * F('quantity'),
+        output_field=models.DecimalField(decimal_places=2, max_digits=12)
+      )
+    ).order_by('id')
+    self.count = 0
+    self.total = Decimal('0.00')
+    for line in self.lines:
+      self.count += line.quantity
+      self.total += line.line_total
+
+
+class CartQuerySet(models.QuerySet):
+  def summary(self):
+    return CartSummary(BookOrder.objects.filter(cart__in=self))
+
 
 class Cart(models.Model):
+  # Payment states, moved along by store.orders and the reconcile_payments
+  # worker: the buyer authorizes a payment, the worker captures it.
+  PENDING = 'pending'
+  AUTHORIZED = 'authorized'
+  CAPTURED = 'captured'
+  FAILED = 'failed'
+  PAYMENT_STATUS_CHOICES = (
+    (PENDING, 'Pending'),
+    (AUTHORIZED, 'Authorized'),
+    (CAPTURED, 'Captured'),
+    (FAILED, 'Failed'),
+  )
+
+  objects = CartQuerySet.as_manager()
+
   user = models.ForeignKey(User)
   active = models.BooleanField(default=True)
   order_date = models.DateField(null=True)
   payment_type = models.CharField(max_length=100, null=True)
-  payment_id = models.CharField(max_length=100, null=True)
+  payment_id = models.CharField(max_length=100, null=True, db_index=True)
+  stock_committed = models.BooleanField(default=False)
+  payment_status = models.CharField(max_length=10, choices=PAYMENT_STATUS_CHOICES, default=PENDING)
+  payment_token = models.CharField(max_length=100, blank=True)
+  payment_attempts = models.IntegerField(default=0)
+  payment_next_attempt = models.DateTimeField(null=True)
+  payment_error = models.TextField(blank=True)
+  # The total the buyer approved; the payment is not captured for a cart
+  # whose total has changed since.
+  payment_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+  # Set once the build_recommendations job has counted this order.
+  in_recommendations = models.BooleanField(default=False)
+
+  class Meta:
+    # A partial unique index (store/migrations/_partial_indexes.py) allows
+    # only one active cart per user and serves the active cart lookup.
+    index_together = [
+      ['payment_status', 'payment_next_attempt'],
+      ['active', 'in_recommendations'],
+    ]
+
+  def summary(self):
+    return CartSummary(BookOrder.objects.filter(cart=self))
+
+  def commit_stock(self):
+    # Takes every line of the cart out of stock with one conditional UPDATE.
+    # Returns False if this cart's stock was already taken, and raises
+    # OutOfStock (rolling back) if any book can't cover its line.
+    with transaction.atomic():
+      claimed = Cart.objects.filter(pk=self.pk, stock_committed=False).update(stock_committed=True)
+      if not claimed:
+        return False
+      self.stock_committed = True
+
+      quantities = dict(BookOrder.objects.filter(cart=self).values_list('book').annotate(Sum('quantity')))
+      if quantities:
+        in_stock = reduce(operator.or_, [Q(pk=pk, stock__gte=quantity) for pk, quantity in quantities.items()])
+        updated = Book.objects.filter(in_stock).update(stock=F('stock') - Case(
+          *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+          output_field=models.IntegerField()
+        ))
+        if updated != len(quantities):
+          self.stock_committed = False
+          raise OutOfStock('Not enough stock for cart %s' % self.pk)
+    return True
+
+  def release_stock(self):
+    # Puts back what commit_stock took, for an order that failed. Returns
+    # False if this cart holds no stock.
+    with transaction.atomic():
+      released = Cart.objects.filter(pk=self.pk, stock_committed=True).update(stock_committed=False)
+      if not released:
+        return False
+      self.stock_committed = False
+
+      quantities = dict(BookOrder.objects.filter(cart=self).values_list('book').annotate(Sum('quantity')))
+      if quantities:
+        Book.objects.filter(pk__in=quantities).update(stock=F('stock') + Case(
+          *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+          output_field=models.IntegerField()
+        ))
+    return True
 
   def add_to_cart(self, book_id):
-    book = Book.objects.get(pk=book_id)
+    # One UPDATE when the book is already in the cart. The (cart, book)
+    # unique constraint turns a concurrent first add into an increment.
+    lines = BookOrder.objects.filter(cart=self, book=book_id)
+    if lines.update(quantity=F('quantity') + 1):
+      return
+    if not Book.objects.filter(pk=book_id).exists():
+      raise Book.DoesNotExist
     try:
-      preexisting_order = BookOrder.objects.get(book=book, cart=self)
-      preexisting_order.quantity += 1
-      preexisting_order.save()
-    except BookOrder.DoesNotExist:
-      new_order = BookOrder.objects.create(
-        book=book,
-        cart=self,
-        quantity=1
-      )
-      new_order.save()
+      with transaction.atomic():
+        BookOrder.objects.create(cart=self, book_id=book_id, quantity=1)
+    except IntegrityError:
+      lines.update(quantity=F('quantity') + 1)
 
   def remove_from_cart(self, book_id):
-    book = Book.objects.get(pk=book_id)
-    try:
-      preexisting_order = BookOrder.objects.get(book=book, cart=self)
-      if preexisting_order.quantity > 1:
-        preexisting_order.quantity -= 1
-        preexisting_order.save()
-      else:
-        preexisting_order.delete()
-    except BookOrder.DoesNotExist:
-      pass
+    lines = BookOrder.objects.filter(cart=self, book=book_id)
+    if not lines.filter(quantity__gt=1).update(quantity=F('quantity') - 1):
+      lines.filter(quantity__lte=1).delete()
+
+  def set_quantities(self, quantities):
+    # quantities maps book ids to the new quantity; zero or less removes the
+    # line. Existing lines are updated with a single CASE statement.
+    self._write_quantities(quantities, increment=False)
+
+  def add_quantities(self, quantities):
+    # Like set_quantities, but adds to the quantities already in the cart.
+    self._write_quantities(quantities, increment=True)
+
+  def _write_quantities(self, quantities, increment):
+    quantities = dict((int(book_id), quantity) for book_id, quantity in quantities.items())
+    removed = [] if increment else [book_id for book_id, quantity in quantities.items() if quantity <= 0]
+    kept = dict((book_id, quantity) for book_id, quantity in quantities.items() if quantity > 0)
+    lines = BookOrder.objects.filter(cart=self)
+    for attempt in range(2):
+      try:
+        with transaction.atomic():
+          if removed:
+            lines.filter(book__in=removed).delete()
+          if not kept:
+            return
+          existing = set(lines.filter(book__in=kept).values_list('book_id', flat=True))
+          if existing:
+            quantity = Case(
+              *[When(book=book_id, then=Value(kept[book_id])) for book_id in existing],
+              output_field=models.IntegerField()
+            )
+            lines.filter(book__in=existing).update(quantity=F('quantity') + quantity if increment else quantity)
+          missing = Book.objects.filter(pk__in=set(kept) - existing).values_list('pk', flat=True)
+          BookOrder.objects.bulk_create([
+            BookOrder(cart=self, book_id=book_id, quantity=kept[book_id]) for book_id in missing
+          ])
+        return
+      except IntegrityError:
+        # Another request added one of the books first; the second pass
+        # updates it instead.
+        if attempt:
+          raise
+
 
 class BookOrder(models.Model):
   book = models.ForeignKey(Book)
   cart = models.ForeignKey(Cart)
   quantity = models.IntegerField()
+
+  class Meta:
+    unique_together = [['cart', 'book']]
+
+
+class OutboundEmail(models.Model):
+  PENDING = 'pending'
+  SENT = 'sent'
+  FAILED = 'failed'
+  STATUS_CHOICES = (
+    (PENDING, 'Pending'),
+    (SENT, 'Sent'),
+    (FAILED, 'Failed'),
+  )
+
+  subject = models.CharField(max_length=255)
+  from_email = models.CharField(max_length=254)
+  to = models.TextField()
+  text_body = models.TextField()
+  html_body = models.TextField(blank=True)
+  status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+  attempts = models.IntegerField(default=0)
+  next_attempt = models.DateTimeField(default=timezone.now)
+  last_error = models.TextField(blank=True)
+  created = models.DateTimeField(default=timezone.now)
+  sent_date = models.DateTimeField(null=True)
+
+  class Meta:
+    index_together = [['status', 'next_attempt']]
+
+  def __unicode__(self):
+    return "%s -> %s" % (self.subject, self.to)
@@ -0,0 +1,212 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.template import Context
+from django.utils import timezone
+
+from .models import Cart, OutOfStock
+from .outbox import queue_email
+from .payments import get_gateway, PaymentDeclined, PaymentError
+from .rollups import record_sale
+from .versions import bump_version
+
+logger = logging.getLogger(__name__)
+
+# Checkout only records what the buyer approved (Cart.AUTHORIZED); the
+# reconcile_payments worker then captures payments in batches, off the
+# request path, and the order page polls order_status until the cart is
+# CAPTURED or FAILED. Captures reuse the gateway idempotency keys, so a
+# worker that dies between capturing and closing the cart simply captures
+# again on the next run and gets the same payment back.
+#
+# The worker takes the stock before it captures and puts it back if the
+# payment fails, so a buyer is never charged for books that are gone. An
+# authorized cart is frozen (see views), and a cart whose total no longer
+# matches what the buyer approved is failed without being charged.
+
+PROCESSORS = {
+  'PayPal': 'paypal',
+  'Stripe': 'stripe',
+}
+
+OUT_OF_STOCK_MESSAGE = 'Sorry, some of the books in your order are no longer in stock. Your order has not been completed.'
+CART_CHANGED_MESSAGE = 'Your cart changed after you approved the payment. You have not been charged; please check out again.'
+PAYMENT_ERROR_MESSAGE = 'There was a problem with the transaction. Error: %s'
+SUCCESS_MESSAGE = 'Success! Your order has been completed and is being processed. Payment ID: %s'
+PROCESSING_MESSAGE = 'Your payment is being processed.'
+
+
+def status_message(status, payment_id, error):
+  if status == Cart.CAPTURED:
+    return SUCCESS_MESSAGE % payment_id
+  if status == Cart.FAILED:
+    return error
+  return PROCESSING_MESSAGE
+
+
+def authorize(cart, payment_type, token):
+  # token is the PayPal payer id or the Stripe card token. Only a pending or
+  # failed cart is authorized, so reloading the page does not reset a
+  # capture in progress. Returns whether the cart was authorized.
+  if cart.payment_amount is None:
+    cart.payment_amount = cart.summary().total
+  fields = {
+    'payment_type': payment_type,
+    'payment_token': token,
+    'payment_status': Cart.AUTHORIZED,
+    'payment_attempts': 0,
+    'payment_next_attempt': timezone.now(),
+    'payment_error': '',
+    'payment_amount': cart.payment_amount,
+  }
+  authorized = Cart.objects.filter(
+    pk=cart.pk, active=True, payment_status__in=[Cart.PENDING, Cart.FAILED],
+  ).update(**fields)
+  if authorized:
+    for name, value in fields.items():
+      setattr(cart, name, value)
+  return bool(authorized)
+
+
+def close_cart(cart):
+  # Completes the order in one transaction: takes the cart's lines out of
+  # stock (unless that was already done), marks the cart as ordered,
+  # records the sale and queues the receipt. Returns False, leaving the
+  # cart active and the stock untouched, if a book can't cover its line.
+  # Closing a closed cart again does nothing and returns True.
+  try:
+    with transaction.atomic():
+      cart.commit_stock()
+      if not Cart.objects.filter(pk=cart.pk, active=True).update(active=False):
+        cart.active = False
+        return True
+      cart.active = False
+      cart.payment_status = Cart.CAPTURED
+      cart.order_date = cart.order_date or timezone.now()
+      cart.save()
+      lines = cart.summary().lines
+      record_sale(cart, lines)
+      send_receipt(cart, lines)
+  except OutOfStock:
+    cart.active = True
+    return False
+  # After the commit, so no reader caches the stock from before it.
+  bump_version('book')
+  for line in lines:
+    bump_version('book', line.book_id)
+  return True
+
+
+def send_receipt(cart, lines):
+  email_context = Context({
+    'username': cart.user.username,
+    'orders': lines,
+  })
+  queue_email('Thanks for shopping with Mystery Books!', 'email/purchase_email', email_context,
+    'librarian@mysterybooks.com', [cart.user.email])
+
+
+def retry_delay(attempts):
+  return datetime.timedelta(seconds=settings.PAYMENT_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def capture(cart, summary):
+  gateway = get_gateway(PROCESSORS[cart.payment_type])
+  if cart.payment_type == 'PayPal':
+    return gateway.execute_payment(cart.payment_id, cart.payment_token)
+  return gateway.charge(cart, summary, cart.payment_token)
+
+
+def _fail(cart, error):
+  # Gives back any stock the cart was holding.
+  if cart.release_stock():
+    bump_version('book')
+  cart.payment_status = Cart.FAILED
+  cart.payment_error = error
+  cart.save(update_fields=['payment_status', 'payment_error', 'payment_id'])
+
+
+def _retry_or_fail(cart, error, max_attempts):
+  if cart.payment_attempts >= max_attempts:
+    _fail(cart, PAYMENT_ERROR_MESSAGE % error)
+  else:
+    cart.payment_error = str(error)
+    cart.save(update_fields=['payment_error'])
+
+
+def capture_authorized(batch_size=None, max_attempts=None):
+  # Captures one batch of due payments. Returns the number captured and the
+  # number that failed or were put back for a retry.
+  batch_size = batch_size or settings.PAYMENT_BATCH_SIZE
+  max_attempts = max_attempts or settings.PAYMENT_MAX_ATTEMPTS
+  now = timezone.now()
+  batch = list(Cart.objects.filter(
+    payment_status=Cart.AUTHORIZED,
+    payment_next_attempt__lte=now,
+  ).select_related('user').order_by('payment_next_attempt', 'id')[:batch_size])
+
+  captured = failed = 0
+  for cart in batch:
+    # Claim the cart so a second worker skips it until the retry delay.
+    attempts = cart.payment_attempts + 1
+    claimed = Cart.objects.filter(
+      pk=cart.pk,
+      payment_status=Cart.AUTHORIZED,
+      payment_attempts=cart.payment_attempts,
+    ).update(
+      payment_attempts=attempts,
+      payment_next_attempt=now + retry_delay(attempts),
+    )
+    if not claimed:
+      continue
+    cart.payment_attempts = attempts
+
+    charged = False
+    try:
+      summary = cart.summary()
+      if cart.payment_amount is not None and summary.total != cart.payment_amount:
+        failed += 1
+        _fail(cart, CART_CHANGED_MESSAGE)
+        continue
+      try:
+        cart.commit_stock()
+      except OutOfStock:
+        failed += 1
+        _fail(cart, OUT_OF_STOCK_MESSAGE)
+        continue
+
+      try:
+        payment_id = capture(cart, summary)
+      except PaymentDeclined as e:
+        failed += 1
+        _fail(cart, PAYMENT_ERROR_MESSAGE % e)
+        continue
+      except PaymentError as e:
+        logger.warning('Capturing cart %s failed (attempt %d): %s', cart.pk, cart.payment_attempts, e)
+        failed += 1
+        _retry_or_fail(cart, e, max_attempts)
+        continue
+      charged = True
+
+      cart.payment_id = payment_id
+      if close_cart(cart):
+        captured += 1
+      else:
+        # Can't happen while the cart holds its stock. The cart stays
+        # authorized, so the next run captures again and retries.
+        logger.error('Cart %s was charged (%s) but could not be closed', cart.pk, payment_id)
+        failed += 1
+        cart.save(update_fields=['payment_id'])
+    except Exception as e:
+      # Anything else is a bug or an error the gateway did not wrap. It
+      # counts as an attempt like a PaymentError, so the cart is failed and
+      # its stock given back in the end; the rest of the batch goes on. A
+      # cart that was already charged stays authorized, to be captured
+      # (idempotently) and closed on the next run.
+      logger.exception('Capturing cart %s failed (attempt %d)', cart.pk, cart.payment_attempts)
+      failed += 1
+      if not charged:
+        _retry_or_fail(cart, e, max_attempts)
+  return captured, failed
@@ -0,0 +1,97 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends import smtp
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .metrics import timed
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+
+class EmailBackend(smtp.EmailBackend):
+  # The SMTP backend, with connecting and sending counted as external call
+  # time in the request metrics.
+  def open(self):
+    with timed('smtp'):
+      return super(EmailBackend, self).open()
+
+  def send_messages(self, email_messages):
+    with timed('smtp'):
+      return super(EmailBackend, self).send_messages(email_messages)
+
+
+def queue_email(subject, template_name, context, from_email, to_email):
+  # Renders '<template_name>.txt' and '<template_name>.html' and stores the
+  # message for the send_queued_email worker instead of talking SMTP inline.
+  return OutboundEmail.objects.create(
+    subject=subject,
+    from_email=from_email,
+    to=','.join(to_email),
+    text_body=render_to_string('%s.txt' % template_name, context),
+    html_body=render_to_string('%s.html' % template_name, context),
+  )
+
+
+def build_message(email, connection=None):
+  msg = EmailMultiAlternatives(email.subject, email.text_body, email.from_email,
+    email.to.split(','), connection=connection)
+  if email.html_body:
+    msg.attach_alternative(email.html_body, 'text/html')
+    msg.content_subtype = 'html'
+  return msg
+
+
+def retry_delay(attempts):
+  return datetime.timedelta(seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def send_queued(batch_size=None, max_attempts=None, connection=None):
+  # Sends one batch of due messages. Returns the number of messages sent and
+  # the number that failed. A connection passed in is expected to be open
+  # and is left open for the next batch; otherwise one is opened and closed
+  # around this batch.
+  batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+  max_attempts = max_attempts or settings.EMAIL_OUTBOX_MAX_ATTEMPTS
+  now = timezone.now()
+  batch = list(OutboundEmail.objects.filter(
+    status=OutboundEmail.PENDING,
+    next_attempt__lte=now,
+  ).order_by('next_attempt', 'id')[:batch_size])
+  if not batch:
+    return 0, 0
+
+  if connection is None:
+    connection = get_connection()
+    connection.open()
+    try:
+      return _send_batch(batch, connection, now, max_attempts)
+    finally:
+      connection.close()
+  return _send_batch(batch, connection, now, max_attempts)
+
+
+def _send_batch(batch, connection, now, max_attempts):
+  sent = failed = 0
+  for email in batch:
+    email.attempts += 1
+    try:
+      build_message(email, connection).send()
+    except Exception as e:
+      logger.warning('Sending email %s failed (attempt %d): %s', email.pk, email.attempts, e)
+      failed += 1
+      email.last_error = '%s: %s' % (type(e).__name__, e)
+      if email.attempts >= max_attempts:
+        email.status = OutboundEmail.FAILED
+      else:
+        email.next_attempt = now + retry_delay(email.attempts)
+    else:
+      sent += 1
+      email.status = OutboundEmail.SENT
+      email.sent_date = timezone.now()
+    email.save(update_fields=['attempts', 'status', 'next_attempt', 'last_error', 'sent_date'])
+  return sent, failed
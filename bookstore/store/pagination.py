@@ -0,0 +1,133 @@
+import datetime
+
+from django.db.models import Q
+from django.utils import six
+from django.utils.functional import cached_property
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+# Keyset (seek) pagination over (publish_date, id), newest first. The cursor
+# is the position of the last row on the previous page, so every page is a
+# bounded index range scan no matter how deep into the catalog it is.
+
+def encode_cursor(book):
+  return '%s.%d' % (book.publish_date.isoformat(), book.id)
+
+
+def decode_cursor(cursor):
+  try:
+    date_part, id_part = cursor.split('.')
+    publish_date = datetime.datetime.strptime(date_part, '%Y-%m-%d').date()
+    return publish_date, int(id_part)
+  except (AttributeError, ValueError):
+    return None
+
+
+def seek(queryset, cursor):
+  position = decode_cursor(cursor)
+  if position is None:
+    return queryset
+  publish_date, pk = position
+  return queryset.filter(
+    Q(publish_date__lt=publish_date) | Q(publish_date=publish_date, id__lt=pk)
+  )
+
+
+class KeysetPage(object):
+  # Nothing is queried until the page's books or next_cursor are used, so a
+  # page rendered from a cached fragment costs no queries at all. The page
+  # reads one row more than it shows, which tells whether there is a next
+  # page. Iterating, indexing or counting the page goes over its books.
+  def __init__(self, queryset, cursor, page_size):
+    self.queryset = queryset.order_by('-publish_date', '-id')
+    self.cursor = cursor
+    self.page_size = page_size
+
+  @cached_property
+  def rows(self):
+    return list(seek(self.queryset, self.cursor)[:self.page_size + 1])
+
+  @property
+  def object_list(self):
+    return self.rows[:self.page_size]
+
+  def __len__(self):
+    return len(self.object_list)
+
+  def __iter__(self):
+    return iter(self.object_list)
+
+  def __getitem__(self, index):
+    # Like Paginator's Page: templates try page['cache_key'] before the
+    # attribute, and that must not run the query.
+    if not isinstance(index, (slice,) + six.integer_types):
+      raise TypeError
+    return self.object_list[index]
+
+  def count(self):
+    return len(self.object_list)
+
+  @property
+  def cache_key(self):
+    # The cursor spelled one way, for keying cached pages: '' for the first
+    # page and for a cursor that can't be read, which shows the first page.
+    position = decode_cursor(self.cursor)
+    if position is None:
+      return ''
+    return '%s.%d' % (position[0].isoformat(), position[1])
+
+  @property
+  def next_cursor(self):
+    if len(self.rows) > self.page_size:
+      return encode_cursor(self.rows[self.page_size - 1])
+    return None
+
+
+def keyset_page(queryset, cursor, page_size):
+  return KeysetPage(queryset, cursor, page_size)
+
+
+class CursorPaginator(Paginator):
+  # Tastypie paginator that seeks on the primary key, newest first, instead
+  # of using OFFSET. Clients follow meta.next; there is no total_count, since
+  # counting the whole table is what made deep pages slow.
+  def get_cursor(self):
+    cursor = self.request_data.get('cursor')
+    if not cursor:
+      return None
+    try:
+      return int(cursor)
+    except ValueError:
+      raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+  def page(self):
+    limit = self.get_limit()
+    cursor = self.get_cursor()
+    objects = self.objects.order_by('-pk')
+    if cursor is not None:
+      objects = objects.filter(pk__lt=cursor)
+
+    rows = list(objects[:limit + 1]) if limit else list(objects)
+    next_uri = None
+    if limit and len(rows) > limit:
+      rows = rows[:limit]
+      next_uri = self._generate_cursor_uri(limit, rows[-1].pk)
+
+    return {
+      self.collection_name: rows,
+      'meta': {
+        'limit': limit,
+        'cursor': cursor,
+        'next': next_uri,
+      },
+    }
+
+  def _generate_cursor_uri(self, limit, cursor):
+    if self.resource_uri is None:
+      return None
+    params = self.request_data.copy()
+    for key in ('limit', 'offset', 'cursor'):
+      params.pop(key, None)
+    params.update({'limit': limit, 'cursor': cursor})
+    return '%s?%s' % (self.resource_uri, params.urlencode())
@@ -0,0 +1,278 @@
+import hashlib
+import itertools
+import threading
+import time
+
+import paypalrestsdk
+import requests
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from paypalrestsdk import exceptions as paypal_exceptions
+from paypalrestsdk.resource import Resource
+from requests.adapters import HTTPAdapter
+from stripe.api_requestor import APIRequestor
+from stripe.http_client import RequestsClient
+
+from .metrics import timed
+
+# Payment processors behind one interface. Each processor in
+# settings.PAYMENT_GATEWAYS gets a single gateway per process, holding a
+# pooled keep-alive HTTP session. Every call has an overall deadline (the
+# timeout option); failed connections and 5xx answers are retried within
+# it using the same idempotency key, so a retry can never charge twice.
+
+
+class PaymentError(Exception):
+  pass
+
+
+class PaymentDeclined(PaymentError):
+  pass
+
+
+class PaymentTimeout(PaymentError):
+  pass
+
+
+def idempotency_key(*parts):
+  return hashlib.sha1(':'.join(str(part) for part in parts)).hexdigest()
+
+
+def cart_key(operation, cart, summary):
+  # Stable while the cart's contents are, so a double-submitted checkout
+  # reuses the first payment, but an edited cart gets a new one.
+  lines = ','.join('%d:%d' % (line.book_id, line.quantity) for line in summary.lines)
+  return idempotency_key(operation, cart.pk, lines, summary.total)
+
+
+def pooled_session(pool_size):
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+
+class Gateway(object):
+  retryable = ()
+
+  def __init__(self, timeout=10, retries=2, backoff=0.2, pool_size=10):
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.session = pooled_session(pool_size)
+    self._local = threading.local()
+
+  def remaining(self):
+    deadline = getattr(self._local, 'deadline', None)
+    if deadline is None:
+      return self.timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      raise PaymentTimeout('Payment call exceeded %ss' % self.timeout)
+    return remaining
+
+  def http_request(self, method, url, **kwargs):
+    kwargs['timeout'] = self.remaining()
+    return self.session.request(method, url, **kwargs)
+
+  def call(self, func, *args, **kwargs):
+    self._local.deadline = time.time() + self.timeout
+    try:
+      with timed('payment'):
+        for attempt in itertools.count():
+          try:
+            return func(*args, **kwargs)
+          except self.retryable as e:
+            delay = self.backoff * 2 ** attempt
+            if attempt >= self.retries or delay >= self.remaining():
+              raise PaymentError('Payment call failed after %d attempts: %s' % (attempt + 1, e))
+            time.sleep(delay)
+    finally:
+      self._local.deadline = None
+
+  def unsupported(self, operation):
+    return PaymentError('%s does not support %s' % (type(self).__name__, operation))
+
+  def create_payment(self, cart, summary, return_url, cancel_url):
+    # Returns (payment_id, redirect_url) for processors that send the buyer
+    # off-site to approve the payment.
+    raise self.unsupported('create_payment')
+
+  def execute_payment(self, payment_id, payer_id):
+    raise self.unsupported('execute_payment')
+
+  def charge(self, cart, summary, token):
+    # Returns the charge id.
+    raise self.unsupported('charge')
+
+
+class PooledPayPalApi(paypalrestsdk.Api):
+  def __init__(self, gateway, **kwargs):
+    self.gateway = gateway
+    super(PooledPayPalApi, self).__init__(**kwargs)
+
+  def http_call(self, url, method, **kwargs):
+    response = self.gateway.http_request(method, url, proxies=self.proxies, **kwargs)
+    return self.handle_response(response, response.content.decode('utf-8'))
+
+
+class PayPalGateway(Gateway):
+  retryable = (requests.exceptions.RequestException, paypal_exceptions.ServerError)
+
+  def __init__(self, client_id, client_secret, mode='sandbox', **kwargs):
+    super(PayPalGateway, self).__init__(**kwargs)
+    self.api = PooledPayPalApi(self, mode=mode, client_id=client_id, client_secret=client_secret)
+
+  def call(self, func, *args, **kwargs):
+    # ConnectionError is the base of every HTTP error the SDK raises; 4xx
+    # answers are ClientErrors and are not worth trying again.
+    try:
+      return super(PayPalGateway, self).call(func, *args, **kwargs)
+    except paypal_exceptions.ClientError as e:
+      raise PaymentDeclined(str(e))
+    except paypal_exceptions.ConnectionError as e:
+      raise PaymentError(str(e))
+
+  def create_payment(self, cart, summary, return_url, cancel_url):
+    payment = paypalrestsdk.Payment({
+      "intent": "sale",
+      "payer": {
+        "payment_method": "paypal"
+      },
+      "redirect_urls": {
+        "return_url": return_url,
+        "cancel_url": cancel_url,
+      },
+      "transactions": [{
+        "item_list": {
+          "items": [{
+            'name': line.book.title,
+            'sku': line.book.id,
+            'price': str(line.book.price),
+            'currency': 'USD',
+            'quantity': line.quantity,
+          } for line in summary.lines],
+        },
+        "amount": {
+          "total": str(summary.total),
+          "currency": "USD",
+        },
+        "description": "Myster Books order."
+      }],
+    }, api=self.api)
+    payment.request_id = cart_key('paypal-create', cart, summary)
+    if not self.call(payment.create):
+      raise PaymentError(payment.error)
+    for link in payment.links:
+      if link.method == "REDIRECT":
+        return payment.id, str(link.href)
+    raise PaymentError('PayPal returned no approval link for %s' % payment.id)
+
+  def execute_payment(self, payment_id, payer_id):
+    payment = paypalrestsdk.Payment({"id": payment_id}, api=self.api)
+    attributes = Resource({"payer_id": payer_id}, api=self.api)
+    attributes.request_id = idempotency_key('paypal-execute', payment_id)
+    if not self.call(payment.execute, attributes):
+      raise PaymentDeclined(payment.error.message)
+    return payment.id
+
+
+class PooledStripeClient(RequestsClient):
+  def __init__(self, gateway, **kwargs):
+    self.gateway = gateway
+    super(PooledStripeClient, self).__init__(**kwargs)
+
+  def request(self, method, url, headers, post_data=None):
+    try:
+      response = self.gateway.http_request(
+        method, url, headers=headers, data=post_data, verify=self._verify_ssl_certs)
+      return response.content, response.status_code, response.headers
+    except requests.exceptions.RequestException as e:
+      raise stripe.error.APIConnectionError('%s: %s' % (type(e).__name__, e))
+
+
+class StripeGateway(Gateway):
+  retryable = (stripe.error.APIConnectionError, stripe.error.APIError)
+
+  def __init__(self, api_key, **kwargs):
+    super(StripeGateway, self).__init__(**kwargs)
+    self.api_key = api_key
+    self.client = PooledStripeClient(self)
+
+  def charge(self, cart, summary, token):
+    requestor = APIRequestor(key=self.api_key, client=self.client)
+    params = {
+      'amount': int(summary.total * 100),
+      'currency': 'USD',
+      'source': token,
+      'metadata': {'order_id': cart.id},
+    }
+    headers = {'Idempotency-Key': idempotency_key('stripe-charge', cart.pk, token)}
+    try:
+      response, api_key = self.call(requestor.request, 'post', stripe.Charge.class_url(), params, headers)
+    except stripe.error.CardError as e:
+      raise PaymentDeclined(e.message)
+    except stripe.error.StripeError as e:
+      raise PaymentError(e.message)
+    return response['id']
+
+
+class FakeGateway(Gateway):
+  # Local stand-in for load tests and development: no network, and ids are
+  # derived from the idempotency keys, so repeated calls agree and a worker
+  # process accepts payments created by the web process. Tokens starting
+  # with 'tok_decline' fail; PayPal-style approval redirects straight back
+  # to return_url.
+  def __init__(self, latency=0, **kwargs):
+    super(FakeGateway, self).__init__(**kwargs)
+    self.latency = latency
+
+  def _respond(self, prefix, key):
+    if self.latency:
+      time.sleep(self.latency)
+    return '%s-%s' % (prefix, key[:16])
+
+  def create_payment(self, cart, summary, return_url, cancel_url):
+    payment_id = self._respond('PAY-FAKE', cart_key('paypal-create', cart, summary))
+    return payment_id, '%s?paymentId=%s&PayerID=FAKE' % (return_url, payment_id)
+
+  def execute_payment(self, payment_id, payer_id):
+    if self.latency:
+      time.sleep(self.latency)
+    if not payment_id.startswith('PAY-FAKE-'):
+      raise PaymentDeclined('Unknown payment %s' % payment_id)
+    return payment_id
+
+  def charge(self, cart, summary, token):
+    if token.startswith('tok_decline'):
+      raise PaymentDeclined('Your card was declined.')
+    return self._respond('ch_fake', idempotency_key('stripe-charge', cart.pk, token))
+
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+
+def get_gateway(processor):
+  if processor not in _gateways:
+    with _gateways_lock:
+      if processor not in _gateways:
+        config = settings.PAYMENT_GATEWAYS[processor]
+        gateway_class = import_string(config['BACKEND'])
+        _gateways[processor] = gateway_class(**config.get('OPTIONS', {}))
+  return _gateways[processor]
+
+
+@receiver(setting_changed)
+def reset_gateways(setting, **kwargs):
+  if setting == 'PAYMENT_GATEWAYS':
+    _gateways.clear()
+
+
+def warm():
+  for processor in settings.PAYMENT_GATEWAYS:
+    get_gateway(processor)
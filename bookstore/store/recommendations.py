@@ -0,0 +1,77 @@
+import heapq
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from .models import BookOrder, Cart, Recommendation
+
+# "Customers also bought": two books are related by the number of completed
+# orders containing both, and each book keeps its best few in
+# Recommendation, so book_details reads them with one lookup on
+# (book, rank). Pairs are counted in the database, by joining BookOrder to
+# itself on the cart for a chunk of books at a time. A new order can only
+# change the lists of the books in it, so update_recommendations recomputes
+# just those.
+
+CHUNK_SIZE = 500
+
+
+def co_purchases(book_ids):
+  # {book_id: {other_id: orders containing both}} for the given books.
+  # exclude() rather than filter(cart__active=False): an indexable test on
+  # the cart makes SQLite start from every completed cart instead of from
+  # the lines of these books.
+  counts = defaultdict(dict)
+  rows = BookOrder.objects.filter(book__in=book_ids).exclude(cart__active=True).values_list(
+    'book', 'cart__bookorder__book'
+  ).annotate(Count('id')).order_by()
+  for book_id, other_id, count in rows:
+    if book_id != other_id:
+      counts[book_id][other_id] = count
+  return counts
+
+
+def recommend(book_ids, limit=None):
+  # Recomputes the lists of book_ids from every completed order.
+  limit = limit or settings.RECOMMENDATIONS_PER_BOOK
+  book_ids = list(book_ids)
+  for i in range(0, len(book_ids), CHUNK_SIZE):
+    chunk = book_ids[i:i + CHUNK_SIZE]
+    counts = co_purchases(chunk)
+    with transaction.atomic():
+      Recommendation.objects.filter(book__in=chunk).delete()
+      Recommendation.objects.bulk_create([
+        Recommendation(book_id=book_id, recommended_id=other_id, rank=rank, score=count)
+        for book_id in chunk
+        for rank, (other_id, count) in enumerate(
+          heapq.nsmallest(limit, counts[book_id].items(), key=lambda item: (-item[1], item[0]))
+        )
+      ], batch_size=CHUNK_SIZE)
+
+
+def update_recommendations(batch_size=None, limit=None):
+  # Folds one batch of newly completed orders in. Returns the number of
+  # orders counted.
+  batch_size = batch_size or settings.RECOMMENDATIONS_BATCH_SIZE
+  carts = list(Cart.objects.filter(
+    active=False,
+    in_recommendations=False,
+  ).order_by('id').values_list('pk', flat=True)[:batch_size])
+  if not carts:
+    return 0
+  recommend(set(BookOrder.objects.filter(cart__in=carts).values_list('book', flat=True)), limit)
+  Cart.objects.filter(pk__in=carts).update(in_recommendations=True)
+  return len(carts)
+
+
+def rebuild_recommendations(limit=None):
+  # Recomputes every list from scratch. Returns the number of books with
+  # completed orders.
+  with transaction.atomic():
+    Cart.objects.filter(active=False, in_recommendations=False).update(in_recommendations=True)
+    Recommendation.objects.all().delete()
+    book_ids = list(BookOrder.objects.exclude(cart__active=True).order_by('book').values_list('book', flat=True).distinct())
+    recommend(book_ids, limit)
+  return len(book_ids)
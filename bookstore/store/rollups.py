@@ -0,0 +1,163 @@
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, Sum, Value, When
+from django.utils import timezone
+
+from .models import BookOrder, Cart, DailyBookSales, DailyPaymentSales
+
+# Sales figures are read from daily rollups instead of from BookOrder: a
+# completed cart adds its lines to DailyBookSales and DailyPaymentSales in
+# the transaction that takes its stock (see orders.close_cart), so each
+# order is counted once. Reports then read one row per book or payment
+# type per day, however many orders there were. rebuild_rollups recomputes
+# the tables from completed carts, for history and after repairs; it can
+# only price lines at today's prices, since orders do not keep theirs.
+
+CHUNK_SIZE = 500
+
+line_revenue = ExpressionWrapper(
+  F('quantity') * F('book__price'),
+  output_field=models.DecimalField(decimal_places=2, max_digits=12),
+)
+
+
+def order_day(cart):
+  # The date order_date is stored as, which may still be a datetime on an
+  # unsaved instance.
+  day = cart.order_date or timezone.now()
+  if isinstance(day, datetime.datetime):
+    if timezone.is_aware(day):
+      day = timezone.localtime(day)
+    day = day.date()
+  return day
+
+
+def _add(model, keys, **amounts):
+  # Adds amounts to the row for keys, creating it on first use. The unique
+  # constraint on keys turns a concurrent first insert into an update.
+  increments = dict((name, F(name) + amount) for name, amount in amounts.items())
+  rows = model.objects.filter(**keys)
+  if rows.update(**increments):
+    return
+  values = dict(keys, **amounts)
+  try:
+    with transaction.atomic():
+      model.objects.create(**values)
+  except IntegrityError:
+    rows.update(**increments)
+
+
+def _add_book_sales(day, sales):
+  # sales maps book ids to (units, revenue). Existing rows are updated with
+  # one CASE statement and the rest are inserted in bulk; a concurrent
+  # first insert makes the second pass update it instead.
+  rows = DailyBookSales.objects.filter(date=day)
+  for attempt in range(2):
+    try:
+      with transaction.atomic():
+        existing = set(rows.filter(book__in=sales).values_list('book_id', flat=True))
+        if existing:
+          rows.filter(book__in=existing).update(
+            units=F('units') + Case(
+              *[When(book=book_id, then=Value(sales[book_id][0])) for book_id in existing],
+              output_field=models.IntegerField()
+            ),
+            revenue=F('revenue') + Case(
+              *[When(book=book_id, then=Value(sales[book_id][1])) for book_id in existing],
+              output_field=models.DecimalField(decimal_places=2, max_digits=12)
+            ),
+          )
+        DailyBookSales.objects.bulk_create([
+          DailyBookSales(date=day, book_id=book_id, units=units, revenue=revenue)
+          for book_id, (units, revenue) in sales.items() if book_id not in existing
+        ])
+      return
+    except IntegrityError:
+      if attempt:
+        raise
+
+
+def record_sale(cart, lines):
+  # lines are the cart's summary lines, priced with line_total.
+  day = order_day(cart)
+  sales = defaultdict(lambda: (0, Decimal('0.00')))
+  for line in lines:
+    units, revenue = sales[line.book_id]
+    sales[line.book_id] = (units + line.quantity, revenue + line.line_total)
+  if sales:
+    _add_book_sales(day, dict(sales))
+  _add(DailyPaymentSales, {'date': day, 'payment_type': cart.payment_type or ''},
+    orders=1,
+    units=sum(units for units, _ in sales.values()),
+    revenue=sum((revenue for _, revenue in sales.values()), Decimal('0.00')))
+
+
+def rebuild_rollups(since=None):
+  # Recomputes every day from since (a date; all of history by default).
+  # Returns the number of completed carts counted.
+  carts = Cart.objects.filter(active=False, order_date__isnull=False)
+  if since is not None:
+    carts = carts.filter(order_date__gte=since)
+  lines = BookOrder.objects.filter(cart__in=carts).order_by()
+
+  with transaction.atomic():
+    book_sales = DailyBookSales.objects.all()
+    payment_sales = DailyPaymentSales.objects.all()
+    if since is not None:
+      book_sales = book_sales.filter(date__gte=since)
+      payment_sales = payment_sales.filter(date__gte=since)
+    book_sales.delete()
+    payment_sales.delete()
+
+    DailyBookSales.objects.bulk_create([
+      DailyBookSales(date=row['cart__order_date'], book_id=row['book'], units=row['units'], revenue=row['revenue'])
+      for row in lines.values('cart__order_date', 'book').annotate(
+        units=Sum('quantity'),
+        revenue=Sum(line_revenue),
+      ).iterator()
+    ], batch_size=CHUNK_SIZE)
+
+    payments = defaultdict(lambda: {'orders': 0, 'units': 0, 'revenue': Decimal('0.00')})
+    for row in carts.order_by().values('order_date', 'payment_type').annotate(orders=Count('id')):
+      payments[row['order_date'], row['payment_type'] or '']['orders'] += row['orders']
+    for row in lines.values('cart__order_date', 'cart__payment_type').annotate(
+      units=Sum('quantity'),
+      revenue=Sum(line_revenue),
+    ):
+      totals = payments[row['cart__order_date'], row['cart__payment_type'] or '']
+      totals['units'] += row['units']
+      totals['revenue'] += row['revenue']
+    DailyPaymentSales.objects.bulk_create([
+      DailyPaymentSales(date=day, payment_type=payment_type, **counts)
+      for (day, payment_type), counts in payments.items()
+    ], batch_size=CHUNK_SIZE)
+  return carts.count()
+
+
+def sales_report(start, end, top=10):
+  # Totals, per-day and per-payment-type figures and the best selling books
+  # between start and end inclusive, all read from the rollups.
+  totals = dict(
+    total_orders=Sum('orders'),
+    total_units=Sum('units'),
+    total_revenue=Sum('revenue'),
+  )
+  payment_sales = DailyPaymentSales.objects.filter(date__gte=start, date__lte=end).order_by()
+  book_sales = DailyBookSales.objects.filter(date__gte=start, date__lte=end).order_by()
+  overall = payment_sales.aggregate(**totals)
+  return {
+    'start': start,
+    'end': end,
+    'orders': overall['total_orders'] or 0,
+    'units': overall['total_units'] or 0,
+    'revenue': overall['total_revenue'] or Decimal('0.00'),
+    'days': payment_sales.values('date').annotate(**totals).order_by('-date'),
+    'payment_types': payment_sales.values('payment_type').annotate(**totals).order_by('-total_revenue'),
+    'books': book_sales.values('book', 'book__title', 'book__stock').annotate(
+      total_units=Sum('units'),
+      total_revenue=Sum('revenue'),
+    ).order_by('-total_revenue', 'book')[:top],
+  }
@@ -0,0 +1,73 @@
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.template.response import SimpleTemplateResponse
+
+# Reads of store models go to a replica from settings.DATABASE_REPLICAS
+# inside use_replicas() blocks: the views wrapped in replica_reads while they
+# answer GET and HEAD. Everything else, every write, and the auth and
+# session tables, uses the primary ('default'). So does anything read to
+# fill a cache entry keyed on store.versions (the storefront fragment, API
+# responses, book snapshots): the entry would hold a lagging replica's rows
+# under the new version. Once a request writes, the rest of it reads from
+# the primary too, so it sees its own changes; ReplicaMiddleware starts
+# each request unpinned.
+
+_state = threading.local()
+
+
+def reset():
+  _state.replicas = False
+  _state.pinned = False
+
+
+@contextmanager
+def use_replicas():
+  replicas = getattr(_state, 'replicas', False)
+  _state.replicas = True
+  try:
+    yield
+  finally:
+    _state.replicas = replicas
+
+
+def replica_reads(view):
+  @wraps(view)
+  def wrapper(request, *args, **kwargs):
+    if request.method not in ('GET', 'HEAD'):
+      return view(request, *args, **kwargs)
+    with use_replicas():
+      response = view(request, *args, **kwargs)
+      # Template responses query as they render, so that happens here.
+      if isinstance(response, SimpleTemplateResponse):
+        response.render()
+      return response
+  return wrapper
+
+
+class ReplicaMiddleware(object):
+  def process_request(self, request):
+    reset()
+
+  def process_response(self, request, response):
+    reset()
+    return response
+
+
+class PrimaryReplicaRouter(object):
+  def db_for_read(self, model, **hints):
+    if (model._meta.app_label == 'store' and settings.DATABASE_REPLICAS
+        and getattr(_state, 'replicas', False) and not getattr(_state, 'pinned', False)):
+      return random.choice(settings.DATABASE_REPLICAS)
+    return 'default'
+
+  def db_for_write(self, model, **hints):
+    _state.pinned = True
+    return 'default'
+
+  def allow_relation(self, obj1, obj2, **hints):
+    # Replicas hold the same rows as the primary.
+    return True
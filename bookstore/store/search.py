@@ -0,0 +1,174 @@
+import operator
+import re
+import unicodedata
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Q, Case, IntegerField, Max, Sum, Value, When
+from django.utils.encoding import force_text
+
+from .models import Book, SearchTerm
+
+# Catalog search over an inverted index (SearchTerm): one row per distinct
+# term per book, weighted by where the term appears. A query ANDs its
+# terms, treats the last one as a prefix while the user is still typing,
+# and ranks books by the summed weight of the rows that matched. Every
+# lookup is an index scan on (term, ...), whatever the backend.
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+STOPWORDS = frozenset(
+  'a an and are as at be but by for from has have in is it its of on or that the this to was with'.split()
+)
+MAX_TERM_LENGTH = 40
+MIN_PREFIX_LENGTH = 2
+# Past this many description mentions a term stops adding weight.
+MAX_DESCRIPTION_WEIGHT = 5
+TITLE_WEIGHT = 10
+AUTHOR_WEIGHT = 5
+CHUNK_SIZE = 500
+
+
+def normalize(text):
+  # Lowercased, with accents dropped so unaccented queries still match.
+  text = force_text(text)
+  try:
+    return text.encode('ascii').lower().decode('ascii')
+  except UnicodeEncodeError:
+    pass
+  text = unicodedata.normalize('NFKD', text)
+  return u''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+  return [
+    token[:MAX_TERM_LENGTH] for token in TOKEN.findall(normalize(text))
+    if len(token) > 1 and token not in STOPWORDS
+  ]
+
+
+def book_terms(title, description, author_names):
+  weights = Counter()
+  for term in set(tokenize(title)):
+    weights[term] += TITLE_WEIGHT
+  for term in set(tokenize(author_names)):
+    weights[term] += AUTHOR_WEIGHT
+  for term, count in Counter(tokenize(description)).items():
+    weights[term] += min(count, MAX_DESCRIPTION_WEIGHT)
+  return weights
+
+
+def _write_terms(rows):
+  # Plain executemany: building a model instance per row was most of the
+  # cost of a rebuild.
+  table = connection.ops.quote_name(SearchTerm._meta.db_table)
+  with connection.cursor() as cursor:
+    cursor.executemany(
+      'INSERT INTO %s (term, book_id, weight) VALUES (%%s, %%s, %%s)' % table, rows)
+
+
+def _term_rows(books):
+  # books are (pk, title, description, first_name, last_name) tuples.
+  for pk, title, description, first_name, last_name in books:
+    for term, weight in book_terms(title, description, u'%s %s' % (first_name, last_name)).items():
+      yield term, pk, weight
+
+
+def index_books(books):
+  # books should come with their authors; see Book.objects.select_related.
+  books = [
+    (book.pk, book.title, book.description, book.author.first_name, book.author.last_name)
+    for book in books
+  ]
+  with transaction.atomic():
+    SearchTerm.objects.filter(book__in=[book[0] for book in books]).delete()
+    _write_terms(list(_term_rows(books)))
+
+
+def rebuild_index():
+  # Returns the number of books indexed.
+  columns = ('pk', 'title', 'description', 'author__first_name', 'author__last_name')
+  with transaction.atomic():
+    SearchTerm.objects.all().delete()
+    ids = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(ids), CHUNK_SIZE):
+      books = Book.objects.filter(pk__in=ids[i:i + CHUNK_SIZE]).values_list(*columns)
+      _write_terms(list(_term_rows(books)))
+  return len(ids)
+
+
+def parse_query(query, autocomplete=False):
+  # Returns the exact terms and the prefix (or None). When autocompleting,
+  # the last word is a prefix unless the query ends in whitespace; stopwords
+  # are kept there since 'the' may be the start of 'theory'.
+  query = normalize(query)
+  words = [word[:MAX_TERM_LENGTH] for word in TOKEN.findall(query)]
+  prefix = None
+  if autocomplete and words and not query[-1:].isspace() and len(words[-1]) >= MIN_PREFIX_LENGTH:
+    prefix = words.pop()
+  exact = []
+  for word in words:
+    if len(word) > 1 and word not in STOPWORDS and word not in exact:
+      exact.append(word)
+  return exact, prefix
+
+
+def _prefix_q(prefix):
+  # A range rather than LIKE, so the (term, book) index is used on SQLite.
+  return Q(term__gte=prefix, term__lt=prefix + u'\uffff')
+
+
+def _page(rows, offset, limit):
+  if limit is not None:
+    rows = rows[offset:offset + limit]
+  return list(rows)
+
+
+def ranked_ids(query, offset=0, limit=None, autocomplete=False):
+  # Book ids matching every term of query, best first.
+  exact, prefix = parse_query(query, autocomplete)
+  conditions = [Q(term=term) for term in exact]
+  if prefix is not None:
+    conditions.append(_prefix_q(prefix))
+  if not conditions:
+    return []
+
+  if len(exact) == 1 and prefix is None:
+    # A single term has one row per book, so the best books can be read
+    # straight off the (term, weight, book) index with no aggregation.
+    rows = SearchTerm.objects.filter(term=exact[0]).order_by('-weight', '-book')
+    return _page(rows.values_list('book', flat=True), offset, limit)
+
+  rows = SearchTerm.objects.filter(reduce(operator.or_, conditions))
+  if len(conditions) > 1:
+    # Only books having the rarest term can match, so aggregate just those
+    # rather than every book a common term appears in.
+    rarest = min(conditions, key=lambda condition: SearchTerm.objects.filter(condition).count())
+    rows = rows.filter(book__in=SearchTerm.objects.filter(rarest).values('book'))
+
+  matched = dict(
+    ('matched_%d' % i, Max(Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField())))
+    for i, condition in enumerate(conditions)
+  )
+  rows = rows.values('book').annotate(
+    score=Sum('weight'), **matched
+  ).filter(**dict((name, 1) for name in matched)).order_by('-score', '-book')
+  return [row['book'] for row in _page(rows, offset, limit)]
+
+
+class SearchPage(object):
+  def __init__(self, query, page, page_size, autocomplete=False):
+    self.query = query
+    self.number = page
+    ids = ranked_ids(query, (page - 1) * page_size, page_size + 1, autocomplete)
+    self.has_next = len(ids) > page_size
+    ids = ids[:page_size]
+    books = Book.objects.select_related('author').in_bulk(ids)
+    self.object_list = [books[pk] for pk in ids if pk in books]
+
+  @property
+  def next_page_number(self):
+    return self.number + 1 if self.has_next else None
+
+
+def search(query, page=1, page_size=20, autocomplete=False):
+  return SearchPage(query, page, page_size, autocomplete)
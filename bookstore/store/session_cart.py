@@ -0,0 +1,117 @@
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.signing import BadSignature
+
+from .models import Book, Cart
+
+# Anonymous visitors keep their cart in a signed cookie of its own as
+# {book_id: quantity}, with string ids since it is serialized as JSON.
+# Sessions stay in the database; nothing is written there, or to the cart
+# tables, until the visitor logs in, when merge_into() adds the whole cookie
+# cart to their active Cart in one bulk operation. SessionCartMiddleware
+# puts the cart on request.session_cart and writes the cookie back.
+COOKIE_NAME = 'cart'
+COOKIE_SALT = 'store.session_cart'
+COOKIE_MAX_AGE = 60 * 60 * 24 * 14
+# Keeps the cookie well under the browsers' 4KB limit.
+MAX_LINES = 100
+
+
+class SessionLine(object):
+  def __init__(self, book, quantity):
+    self.book = book
+    self.quantity = quantity
+    self.line_total = book.price * quantity
+
+
+class SessionCartSummary(object):
+  # Same interface as CartSummary, for the cart template.
+  def __init__(self, items):
+    books = Book.objects.select_related('author').filter(pk__in=items).order_by('id')
+    self.lines = [SessionLine(book, items[str(book.pk)]) for book in books]
+    self.count = sum(line.quantity for line in self.lines)
+    self.total = sum((line.line_total for line in self.lines), Decimal('0.00'))
+
+
+class SessionCart(object):
+  def __init__(self, request):
+    self.request = request
+    self.changed = False
+    self._items = None
+
+  @property
+  def items(self):
+    if self._items is None:
+      self._items = self._load()
+    return self._items
+
+  def _load(self):
+    try:
+      value = self.request.get_signed_cookie(COOKIE_NAME, None, salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE)
+      items = json.loads(value) if value else {}
+    except (BadSignature, ValueError):
+      return {}
+    if not isinstance(items, dict) or len(items) > MAX_LINES:
+      return {}
+    return dict(
+      (key, quantity) for key, quantity in items.items()
+      if key.isdigit() and isinstance(quantity, int) and quantity > 0
+    )
+
+  def _save(self, items):
+    self._items = items
+    self.changed = True
+
+  def add(self, book_id):
+    items = dict(self.items)
+    key = str(book_id)
+    if key not in items and len(items) >= MAX_LINES:
+      return
+    items[key] = items.get(key, 0) + 1
+    self._save(items)
+
+  def remove(self, book_id):
+    items = dict(self.items)
+    key = str(book_id)
+    if items.get(key, 0) > 1:
+      items[key] -= 1
+    else:
+      items.pop(key, None)
+    self._save(items)
+
+  def summary(self):
+    return SessionCartSummary(self.items)
+
+  def merge_into(self, user):
+    items = self.items
+    if not items:
+      return None
+    cart, _ = Cart.objects.get_or_create(user=user, active=True)
+    if cart.payment_status == Cart.AUTHORIZED:
+      # Kept in the cookie until the payment is through.
+      return None
+    cart.add_quantities(items)
+    self._save({})
+    return cart
+
+  def write(self, response):
+    if not self.changed:
+      return
+    if self.items:
+      response.set_signed_cookie(
+        COOKIE_NAME, json.dumps(self.items), salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE,
+        secure=settings.SESSION_COOKIE_SECURE, httponly=True)
+    else:
+      response.delete_cookie(COOKIE_NAME)
+
+
+class SessionCartMiddleware(object):
+  def process_request(self, request):
+    request.session_cart = SessionCart(request)
+
+  def process_response(self, request, response):
+    if hasattr(request, 'session_cart'):
+      request.session_cart.write(response)
+    return response
@@ -1,35 +1,101 @@
-from django.db.models.signals import post_save
+import logging
+
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
-from .models import Cart, BookOrder
-from django.template import Context
-from django.template.loader import render_to_string
-from django.core.mail import EmailMultiAlternatives
-
-
-@receiver(post_save, sender=Cart)
-def adjust_stock(sender, instance, **kwargs):
-  if not instance.active:
-    #Decrement stock counts
-    orders = BookOrder.objects.filter(cart=instance)
-    for order in orders:
-      book=order.book
-      book.stock -= order.quantity
-      book.save()
-
-    #Send Thank You mail
-    subject = 'Thanks for shopping with Mystery Books!'
-    from_email= 'librarian@mysterybooks.com'
-    to_email= [instance.user.email]
-
-    email_context = Context({
-      'username': instance.user.username,
-      'orders': orders
-    })
-
-    text_email= render_to_string('email/purchase_email.txt', email_context)
-    html_email= render_to_string('email/purchase_email.html', email_context)
-
-    msg = EmailMultiAlternatives(subject, text_email, from_email, to_email)
-    msg.attach_alternative(html_email, 'text/html')
-    msg.content_subtype = 'html'
-    msg.send()
\ No newline at end of file
+from django.contrib.auth.signals import user_logged_in
+from .models import Author, Book, Review, ReviewerStats
+from .search import index_books
+from . import snapshots
+from .versions import bump_version
+from .thumbnails import has_derivatives, generate_derivatives
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Review)
+def count_new_review(sender, instance, created, **kwargs):
+  if created:
+    Book.objects.filter(pk=instance.book_id).update(review_count=F('review_count') + 1)
+    ReviewerStats.adjust(instance.user_id, 1)
+
+
+@receiver(post_delete, sender=Review)
+def count_deleted_review(sender, instance, **kwargs):
+  Book.objects.filter(pk=instance.book_id).update(review_count=F('review_count') - 1)
+  ReviewerStats.adjust(instance.user_id, -1)
+
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_reviews(sender, instance, **kwargs):
+  bump_version('review')
+  bump_version('review', instance.book_id)
+  # Books show their review_count.
+  bump_version('book')
+  bump_version('book', instance.book_id)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def refresh_book_detail(sender, instance, **kwargs):
+  snapshots.review_changed(instance.book_id)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_books(sender, instance, **kwargs):
+  bump_version('book')
+  bump_version('book', instance.pk)
+  bump_version('catalog')
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def invalidate_authors(sender, instance, **kwargs):
+  for book_id in instance.book_set.values_list('pk', flat=True):
+    bump_version('book', book_id)
+  bump_version('book')
+  bump_version('catalog')
+
+
+@receiver(post_init, sender=Book)
+def remember_cover(sender, instance, **kwargs):
+  # Absent when the cover is deferred; such a save leaves it alone.
+  cover = instance.__dict__.get('cover_image')
+  instance._saved_cover = getattr(cover, 'name', cover)
+
+
+@receiver(post_save, sender=Book)
+def make_cover_thumbnails(sender, instance, created, update_fields, **kwargs):
+  # Only a new or replaced cover is resized.
+  if update_fields is not None and 'cover_image' not in update_fields:
+    return
+  name = instance.cover_image.name
+  if not name or (not created and name == instance._saved_cover):
+    return
+  instance._saved_cover = name
+  if not has_derivatives(name):
+    try:
+      generate_derivatives(name)
+    except IOError:
+      logger.exception('Could not build thumbnails for %s', name)
+
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, **kwargs):
+  index_books([instance])
+
+
+@receiver(post_save, sender=Author)
+def index_author_books(sender, instance, **kwargs):
+  index_books(instance.book_set.select_related('author'))
+
+
+@receiver(user_logged_in)
+def merge_session_cart(sender, request, user, **kwargs):
+  # Absent for logins outside a request passing through the middleware.
+  session_cart = getattr(request, 'session_cart', None)
+  if session_cart is not None:
+    session_cart.merge_into(user)
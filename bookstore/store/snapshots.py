@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Full, Queue
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connection
+
+from .models import Book, Review
+from .versions import get_version
+
+logger = logging.getLogger(__name__)
+
+# The book page's read model: the book with its author and its latest
+# reviews with their usernames, read with two queries however many reviews
+# there are and kept in the cache as one entry. The entry records the
+# ('book', pk) and ('review', pk) versions it was built from. When either
+# has moved on, the old snapshot is still served for up to
+# BOOK_DETAIL_STALE_SECONDS while the refresher thread rebuilds it, so a
+# new review never makes a reader wait; past that, or with nothing cached,
+# the reader builds it. Review writes queue a rebuild too (see signals).
+#
+# The refresher reads over its own connection, so it only sees committed
+# rows; inside a transaction, snapshots are built inline instead.
+
+
+def _key(book_id):
+  return 'book_detail:%s' % book_id
+
+
+def versions(book_id):
+  return (get_version('book', book_id), get_version('review', book_id))
+
+
+def build(book_id):
+  # Returns the snapshot, or None if there is no such book. Reads go to the
+  # primary: a lagging replica's rows would be cached as current.
+  book = Book.objects.using(DEFAULT_DB_ALIAS).select_related('author').filter(pk=book_id).first()
+  if book is None:
+    return None
+  reviews = Review.objects.using(DEFAULT_DB_ALIAS).filter(book=book_id).order_by('-publish_date', '-id')
+  return {
+    'book': book,
+    'reviews': [
+      {'text': text, 'publish_date': publish_date, 'username': username}
+      for text, publish_date, username in reviews.values_list(
+        'text', 'publish_date', 'user__username')[:settings.BOOK_DETAIL_REVIEWS]
+    ],
+  }
+
+
+def refresh(book_id):
+  # The versions are read first: a write landing during the build bumps
+  # them again, so its snapshot is never taken as current.
+  current = versions(book_id)
+  snapshot = build(book_id)
+  if snapshot is not None:
+    snapshot['versions'] = current
+    cache.set(_key(book_id), snapshot, settings.BOOK_DETAIL_CACHE_TIMEOUT)
+  return snapshot
+
+
+def get(book_id):
+  snapshot = cache.get(_key(book_id))
+  if snapshot is None:
+    return refresh(book_id)
+  current = versions(book_id)
+  if snapshot['versions'] == current:
+    return snapshot
+  # Versions are the time of the change in milliseconds.
+  stale_for = time.time() - max(current) / 1000.0
+  if stale_for > settings.BOOK_DETAIL_STALE_SECONDS or connection.in_atomic_block:
+    return refresh(book_id)
+  refresher.schedule(book_id)
+  return snapshot
+
+
+class Refresher(object):
+  # One daemon thread per process rebuilding snapshots in the background.
+  # A book already waiting is not queued twice, and when the queue is full
+  # the rebuild is left to the next reader.
+  def __init__(self, max_size=1000):
+    self.queue = Queue(max_size)
+    self.waiting = set()
+    self.lock = threading.Lock()
+    self.thread = None
+
+  def schedule(self, book_id):
+    with self.lock:
+      if book_id in self.waiting:
+        return
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name='book-detail-refresher')
+        self.thread.daemon = True
+        self.thread.start()
+      try:
+        self.queue.put_nowait(book_id)
+      except Full:
+        return
+      self.waiting.add(book_id)
+
+  def run(self):
+    while True:
+      book_id = self.queue.get()
+      with self.lock:
+        self.waiting.discard(book_id)
+      try:
+        refresh(book_id)
+      except Exception:
+        logger.exception('Could not refresh the snapshot of book %s', book_id)
+      finally:
+        close_old_connections()
+
+
+refresher = Refresher()
+
+
+_local = threading.local()
+
+
+@contextmanager
+def refreshed_inline():
+  # For a request that refreshes the snapshot itself right after writing a
+  # review: the write does not queue a second, background rebuild.
+  _local.inline = True
+  try:
+    yield
+  finally:
+    _local.inline = False
+
+
+def review_changed(book_id):
+  # Called after a review is saved or deleted.
+  if not connection.in_atomic_block and not getattr(_local, 'inline', False):
+    refresher.schedule(book_id)
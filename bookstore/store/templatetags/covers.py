@@ -0,0 +1,37 @@
+from django import template
+from django.core.files.storage import default_storage
+
+from store.thumbnails import derivatives
+
+register = template.Library()
+
+
+def _url(name, size, extension):
+  # The derivative if there is one. Covers that fit a size have no
+  # derivative for it and fall back to the original.
+  found = derivatives(name).get((size, extension))
+  if found is None and extension == 'jpg':
+    found = name
+  return found and default_storage.url(found)
+
+
+@register.simple_tag
+def cover_url(book, size='medium', extension='jpg'):
+  return _url(book.cover_image.name, size, extension) or ''
+
+
+@register.inclusion_tag('store/cover_picture.html')
+def cover_picture(book, size='medium', retina_size='large', css_class=''):
+  name = book.cover_image.name
+  sources = {}
+  for extension in ('webp', 'jpg'):
+    urls = (_url(name, size, extension), _url(name, retina_size, extension))
+    # WebP is only offered when both resolutions were written.
+    if all(urls):
+      sources[extension] = urls
+  return {
+    'webp': sources.get('webp'),
+    'jpg': sources['jpg'],
+    'title': book.title,
+    'css_class': css_class,
+  }
@@ -0,0 +1,19 @@
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+  # The default cache is a file cache shared with every server on the host
+  # (see settings.CACHES), so the test run gets a private in-memory one that
+  # tests can clear and fill with version counters freely.
+  def setup_test_environment(self, **kwargs):
+    super(TestRunner, self).setup_test_environment(**kwargs)
+    self.cache_settings = override_settings(CACHES={'default': {
+      'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+      'LOCATION': 'tests',
+    }})
+    self.cache_settings.enable()
+
+  def teardown_test_environment(self, **kwargs):
+    self.cache_settings.disable()
+    super(TestRunner, self).teardown_test_environment(**kwargs)
@@ -1,8 +1,48 @@
-from django.test import TestCase
-from .models import Book, Author
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, connections, transaction, IntegrityError
+from django.core import mail, management
+from django.core.mail.backends.locmem import EmailBackend as LocmemBackend
+from django.utils import timezone
+from django.utils.http import http_date
+from django.core.cache import cache, caches
+from django.conf import settings
+from django.apps import apps as django_apps
+from .models import Book, Author, BookOrder, Cart, OutboundEmail, Review, ReviewerStats, OutOfStock, Recommendation, SearchTerm, DailyBookSales, DailyPaymentSales
+from .geo import LookupCache
+from .clusters import cell_for, cell_ranges, in_bbox
+from .thumbnails import available_formats, derivative_name, has_derivatives, SIZES
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template import Context, Template
+from PIL import Image
+import os
+import shutil
+from .outbox import send_queued
+from .payments import FakeGateway, PayPalGateway, PaymentDeclined, PaymentError, StripeGateway
+from .orders import authorize, capture_authorized, close_cart
+from .search import parse_query, ranked_ids, search
+from .recommendations import rebuild_recommendations, update_recommendations
+from .catalog import export_rows, import_rows, parse_row, read_csv, read_jsonl
+from .rollups import rebuild_rollups, sales_report
+from . import metrics, routers, snapshots
+from .pagination import encode_cursor
+from .versions import bump_version, get_version
+from requests.adapters import BaseAdapter
+import requests
 from django.contrib.auth.models import User
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import Resolver404, resolve, reverse
+from django.http import HttpResponse
 from decimal import Decimal
+from StringIO import StringIO
+import datetime
+from importlib import import_module
+import json
+import random
+import re
+import tempfile
+import threading
+import time
 
 class StoreViewsTestCase(TestCase):
   def setUp(self):
@@ -28,7 +68,8 @@ class StoreViewsTestCase(TestCase):
 
   def test_cart(self):
     resp = self.client.get('/store/cart/')
-    self.assertEqual(resp.status_code, 302)
+    self.assertEqual(resp.status_code, 200)
+    self.assertEqual(resp.context['count'], 0)
 
   def test_book_detail(self):
     resp = self.client.get('/store/book/1/')
@@ -47,3 +88,2033 @@ class StoreViewsTestCase(TestCase):
     self.assertEqual(resp.context['count'], 1)
     self.assertEqual(resp.context['cart'].count(), 1)
     self.assertEqual(resp.context['cart'].get().quantity, 1)
+
+
+class StorefrontListingTestCase(TestCase):
+  def setUp(self):
+    for i in range(12):
+      author = Author.objects.create(first_name='First%d' % i, last_name='Last%d' % i)
+      Book.objects.create(
+        title='Book %d' % i,
+        author=author,
+        description='Something',
+        publish_date=datetime.date(2018, 1, 1) + datetime.timedelta(days=i // 2),
+        price=10,
+        stock=1
+      )
+
+  def test_query_count_is_constant(self):
+    # A single joined query for the page, no per-book author lookups.
+    with self.assertNumQueries(1):
+      resp = self.client.get('/store/')
+    self.assertEqual(resp.status_code, 200)
+    self.assertContains(resp, 'Last11, First11')
+    self.assertContains(resp, 'Last0, First0')
+
+  @override_settings(STORE_PAGE_SIZE=5)
+  def test_keyset_pages_cover_catalog_once(self):
+    seen = []
+    cursor = None
+    while True:
+      url = '/store/' if cursor is None else '/store/?after=%s' % cursor
+      resp = self.client.get(url)
+      seen.extend(book.title for book in resp.context['books'])
+      cursor = resp.context['page'].next_cursor
+      if cursor is None:
+        break
+    self.assertEqual(len(seen), 12)
+    self.assertEqual(len(set(seen)), 12)
+    self.assertEqual(seen[0], 'Book 11')
+
+  @override_settings(STORE_PAGE_SIZE=6)
+  def test_full_page_is_one_query(self):
+    # The extra row read with the page tells whether there is a next one.
+    for url, has_next in (('/store/', True), ('/store/?after=%s' % encode_cursor(Book.objects.get(title='Book 6')), False)):
+      with self.assertNumQueries(1):
+        resp = self.client.get(url)
+      self.assertEqual(len(resp.context['books']), 6)
+      self.assertEqual(resp.context['page'].next_cursor is not None, has_next)
+
+  def test_invalid_cursor_shows_first_page(self):
+    resp = self.client.get('/store/?after=garbage')
+    self.assertEqual(resp.status_code, 200)
+    self.assertEqual(resp.context['books'][0].title, 'Book 11')
+
+  def test_cursor_spellings_share_a_cached_page(self):
+    cache.clear()
+    self.client.get('/store/')
+    for junk in ('garbage', '', '2018-13-01.1'):
+      with self.assertNumQueries(0):
+        self.client.get('/store/', {'after': junk})
+    book = Book.objects.get(title='Book 6')
+    self.client.get('/store/', {'after': encode_cursor(book)})
+    with self.assertNumQueries(0):
+      resp = self.client.get('/store/', {'after': '2018-1-4.0%d' % book.pk})
+    self.assertContains(resp, 'Book 5')
+    self.assertNotContains(resp, 'Book 6')
+
+
+class CartSummaryTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    self.books = []
+    for i in range(30):
+      author = Author.objects.create(first_name='First%d' % i, last_name='Last%d' % i)
+      self.books.append(Book.objects.create(
+        title='Book %d' % i,
+        author=author,
+        description='Something',
+        price=Decimal('19.99'),
+        stock=10
+      ))
+    self.cart = Cart.objects.create(user=self.user, payment_id='PAY-1')
+
+  def fill_cart(self, lines, start=0):
+    for book in self.books[start:lines]:
+      BookOrder.objects.create(book=book, cart=self.cart, quantity=3)
+
+  def count_queries(self, url):
+    with CaptureQueriesContext(connection) as queries:
+      resp = self.client.get(url)
+    self.assertEqual(resp.status_code, 200)
+    return len(queries)
+
+  def test_summary_is_single_query(self):
+    self.fill_cart(30)
+    with self.assertNumQueries(1):
+      summary = self.cart.summary()
+      for line in summary.lines:
+        line.book.author.last_name
+    self.assertEqual(summary.count, 90)
+    self.assertEqual(summary.total, Decimal('1799.10'))
+    self.assertEqual(summary.lines[0].line_total, Decimal('59.97'))
+
+  def test_empty_summary(self):
+    summary = Cart.objects.filter(user=self.user, active=True).summary()
+    self.assertEqual(summary.count, 0)
+    self.assertEqual(summary.total, Decimal('0.00'))
+
+  def test_cart_view_queries_do_not_grow_with_lines(self):
+    self.client.login(username='Adam', password='password')
+    self.fill_cart(1)
+    small = self.count_queries('/store/cart/')
+    self.fill_cart(30, start=1)
+    self.assertEqual(self.count_queries('/store/cart/'), small)
+
+  def test_process_order_queries_do_not_grow_with_lines(self):
+    self.client.login(username='Adam', password='password')
+    self.fill_cart(1)
+    small = self.count_queries('/store/process/paypal?paymentId=PAY-1')
+    self.fill_cart(30, start=1)
+    resp = self.client.get('/store/process/paypal?paymentId=PAY-1')
+    self.assertEqual(resp.context['total'], Decimal('1799.10'))
+    self.assertEqual(self.count_queries('/store/process/paypal?paymentId=PAY-1'), small)
+
+  def test_closed_cart_adjusts_stock_and_mails_receipt(self):
+    self.fill_cart(5)
+    self.assertTrue(close_cart(self.cart))
+    self.assertFalse(Cart.objects.get(pk=self.cart.pk).active)
+    self.assertEqual(Book.objects.get(pk=self.books[0].pk).stock, 7)
+    self.assertEqual(Book.objects.get(pk=self.books[5].pk).stock, 10)
+    self.assertEqual(len(mail.outbox), 0)
+    self.assertEqual(send_queued(), (1, 0))
+    self.assertEqual(len(mail.outbox), 1)
+    self.assertIn('3 x Book 4', mail.outbox[0].body)
+
+
+class LookupCacheTestCase(TestCase):
+  def setUp(self):
+    self.now = 1000
+    self.calls = []
+    def lookup(ip):
+      self.calls.append(ip)
+      return {'ip': ip}
+    self.cache = LookupCache(lookup, max_size=2, ttl=60, clock=lambda: self.now)
+
+  def test_hits_and_misses(self):
+    self.cache.get('1.1.1.1')
+    self.cache.get('1.1.1.1')
+    self.assertEqual(self.calls, ['1.1.1.1'])
+    self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+  def test_least_recently_used_is_evicted(self):
+    self.cache.get('1.1.1.1')
+    self.cache.get('2.2.2.2')
+    self.cache.get('1.1.1.1')
+    self.cache.get('3.3.3.3')
+    self.assertEqual(len(self.cache), 2)
+    self.cache.get('1.1.1.1')
+    self.cache.get('2.2.2.2')
+    self.assertEqual(self.calls, ['1.1.1.1', '2.2.2.2', '3.3.3.3', '2.2.2.2'])
+
+  def test_entries_expire(self):
+    self.cache.get('1.1.1.1')
+    self.now += 61
+    self.cache.get('1.1.1.1')
+    self.assertEqual(self.calls, ['1.1.1.1', '1.1.1.1'])
+
+  def test_empty_results_are_cached(self):
+    cache = LookupCache(lambda ip: self.calls.append(ip), max_size=2, ttl=60)
+    cache.get('127.0.0.1')
+    cache.get('127.0.0.1')
+    self.assertEqual(self.calls, ['127.0.0.1'])
+
+
+class CountingBackend(LocmemBackend):
+  opened = 0
+
+  def open(self):
+    CountingBackend.opened += 1
+
+
+class FailingBackend(LocmemBackend):
+  def send_messages(self, messages):
+    raise IOError('relay unavailable')
+
+
+class OutboxTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    author = Author.objects.create(first_name='Adam', last_name='JB')
+    self.book = Book.objects.create(
+      title='My Life',
+      author=author,
+      description='Something',
+      price=42,
+      stock=1
+    )
+
+  def queue(self, count):
+    for i in range(count):
+      OutboundEmail.objects.create(
+        subject='Subject %d' % i,
+        from_email='from@example.com',
+        to='to@example.com',
+        text_body='text',
+        html_body='<p>html</p>',
+      )
+
+  def test_review_queues_discount_instead_of_sending(self):
+    self.client.login(username='Adam', password='password')
+    self.client.post('/store/book/%d/' % self.book.pk, {'text': 'Great'})
+    self.assertEqual(Review.objects.count(), 1)
+    self.assertEqual(len(mail.outbox), 0)
+    queued = OutboundEmail.objects.get()
+    self.assertEqual(queued.to, 'email@email.com')
+    self.assertIn('Adam', queued.text_body)
+
+  @override_settings(EMAIL_BACKEND='store.tests.CountingBackend')
+  def test_worker_drains_batches_over_one_connection(self):
+    self.queue(5)
+    CountingBackend.opened = 0
+    management.call_command('send_queued_email', batch_size=2, stdout=StringIO())
+    self.assertEqual(len(mail.outbox), 5)
+    self.assertEqual(mail.outbox[0].alternatives, [('<p>html</p>', 'text/html')])
+    self.assertEqual(CountingBackend.opened, 1)
+    self.assertFalse(OutboundEmail.objects.exclude(status=OutboundEmail.SENT).exists())
+
+  @override_settings(EMAIL_BACKEND='store.tests.FailingBackend', EMAIL_OUTBOX_RETRY_DELAY=60)
+  def test_failures_back_off_then_give_up(self):
+    self.queue(1)
+    self.assertEqual(send_queued(max_attempts=3), (0, 1))
+    email = OutboundEmail.objects.get()
+    self.assertEqual(email.status, OutboundEmail.PENDING)
+    self.assertIn('relay unavailable', email.last_error)
+    first_delay = email.next_attempt - timezone.now()
+    self.assertEqual(send_queued(max_attempts=3), (0, 0))
+
+    OutboundEmail.objects.update(next_attempt=timezone.now())
+    send_queued(max_attempts=3)
+    email = OutboundEmail.objects.get()
+    self.assertGreater(email.next_attempt - timezone.now(), first_delay)
+
+    OutboundEmail.objects.update(next_attempt=timezone.now())
+    send_queued(max_attempts=3)
+    email = OutboundEmail.objects.get()
+    self.assertEqual(email.attempts, 3)
+    self.assertEqual(email.status, OutboundEmail.FAILED)
+
+
+class StockTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    author = Author.objects.create(first_name='Adam', last_name='JB')
+    self.books = [
+      Book.objects.create(title='Book %d' % i, author=author, description='Something', price=10, stock=5)
+      for i in range(3)
+    ]
+    self.cart = Cart.objects.create(user=self.user, payment_id='ch_1')
+    for book in self.books:
+      BookOrder.objects.create(book=book, cart=self.cart, quantity=2)
+
+  def stock(self):
+    return list(Book.objects.order_by('id').values_list('stock', flat=True))
+
+  def test_all_lines_are_taken_in_one_update(self):
+    with CaptureQueriesContext(connection) as queries:
+      self.assertTrue(self.cart.commit_stock())
+    updates = [q['sql'] for q in queries if 'UPDATE "store_book"' in q['sql']]
+    self.assertEqual(len(updates), 1)
+    self.assertEqual(self.stock(), [3, 3, 3])
+
+  def test_closing_a_cart_invalidates_its_books(self):
+    before = [get_version('book', book.pk) for book in self.books]
+    time.sleep(0.002)
+    self.assertTrue(close_cart(self.cart))
+    after = [get_version('book', book.pk) for book in self.books]
+    self.assertTrue(all(new > old for old, new in zip(before, after)), (before, after))
+
+  def test_closing_a_closed_cart_again_is_a_no_op(self):
+    self.assertTrue(close_cart(self.cart))
+    self.assertTrue(close_cart(self.cart))
+    self.assertTrue(close_cart(Cart.objects.get(pk=self.cart.pk)))
+    self.assertEqual(self.stock(), [3, 3, 3])
+    self.assertEqual(OutboundEmail.objects.count(), 1)
+
+  def test_saving_an_inactive_cart_takes_no_stock(self):
+    self.cart.active = False
+    self.cart.save()
+    self.assertEqual(self.stock(), [5, 5, 5])
+    self.assertEqual(OutboundEmail.objects.count(), 0)
+
+  def test_oversold_cart_stays_active(self):
+    Book.objects.filter(pk=self.books[1].pk).update(stock=1)
+    self.assertFalse(close_cart(self.cart))
+    self.assertTrue(self.cart.active)
+    self.assertTrue(Cart.objects.get(pk=self.cart.pk).active)
+    self.assertEqual(self.stock(), [5, 1, 5])
+
+  def test_oversold_cart_is_refused(self):
+    Book.objects.filter(pk=self.books[1].pk).update(stock=1)
+    self.assertRaises(OutOfStock, self.cart.commit_stock)
+    self.assertEqual(self.stock(), [5, 1, 5])
+    self.assertFalse(Cart.objects.get(pk=self.cart.pk).stock_committed)
+
+  @override_settings(PAYMENT_GATEWAYS={'stripe': {'BACKEND': 'store.payments.FakeGateway'}})
+  def test_complete_order_keeps_oversold_cart_active(self):
+    Book.objects.filter(pk=self.books[1].pk).update(stock=1)
+    Cart.objects.filter(pk=self.cart.pk).update(payment_token='tok_visa')
+    self.client.login(username='Adam', password='password')
+    self.client.get('/store/complete_order/stripe')
+    capture_authorized()
+    resp = self.client.get('/store/order_status/%d/' % self.cart.pk)
+    self.assertIn('no longer in stock', json.loads(resp.content)['message'])
+    self.assertTrue(Cart.objects.get(pk=self.cart.pk).active)
+    self.assertEqual(self.stock(), [5, 1, 5])
+    self.assertEqual(OutboundEmail.objects.count(), 0)
+
+
+class ConcurrentCheckoutTestCase(TransactionTestCase):
+  def test_parallel_checkouts_never_oversell(self):
+    author = Author.objects.create(first_name='Adam', last_name='JB')
+    book = Book.objects.create(title='Scarce', author=author, description='Something', price=10, stock=7)
+    carts = []
+    for i in range(10):
+      user = User.objects.create_user(username='user%d' % i, email='u%d@example.com' % i, password='password')
+      cart = Cart.objects.create(user=user)
+      BookOrder.objects.create(book=book, cart=cart, quantity=1)
+      carts.append(cart)
+
+    results = []
+    def checkout(cart):
+      try:
+        results.append(close_cart(cart))
+      finally:
+        connections.close_all()
+
+    threads = [threading.Thread(target=checkout, args=(cart,)) for cart in carts]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(results.count(True), 7)
+    self.assertEqual(results.count(False), 3)
+    self.assertEqual(Book.objects.get(pk=book.pk).stock, 0)
+    self.assertEqual(Cart.objects.filter(stock_committed=True).count(), 7)
+
+
+class ReviewCounterTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    author = Author.objects.create(first_name='Adam', last_name='JB')
+    self.book = Book.objects.create(
+      title='My Life',
+      author=author,
+      description='Something',
+      price=42,
+      stock=1
+    )
+
+  def review(self, user=None):
+    return Review.objects.create(book=self.book, user=user or self.user, text='Good')
+
+  def test_counters_follow_reviews(self):
+    other = User.objects.create_user(username='Other', email='o@example.com', password='password')
+    first = self.review()
+    self.review(other)
+    self.assertEqual(Book.objects.get(pk=self.book.pk).review_count, 2)
+    self.assertEqual(ReviewerStats.review_count_for(self.user), 1)
+    first.delete()
+    self.assertEqual(Book.objects.get(pk=self.book.pk).review_count, 1)
+    self.assertEqual(ReviewerStats.review_count_for(self.user), 0)
+    other.delete()
+    self.assertEqual(Book.objects.get(pk=self.book.pk).review_count, 0)
+
+  def test_detail_page_does_not_count_reviews(self):
+    for i in range(3):
+      self.review(User.objects.create_user(username='u%d' % i, email='u%d@example.com' % i, password='password'))
+    self.client.login(username='Adam', password='password')
+    with CaptureQueriesContext(connection) as queries:
+      resp = self.client.get('/store/book/%d/' % self.book.pk)
+    self.assertContains(resp, 'Reviews (3)')
+    self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+
+  def test_posting_review_updates_counters(self):
+    self.client.login(username='Adam', password='password')
+    resp = self.client.post('/store/book/%d/' % self.book.pk, {'text': 'Great'})
+    self.assertContains(resp, 'Reviews (1)')
+    self.assertEqual(ReviewerStats.review_count_for(self.user), 1)
+
+  def test_rebuild_command_repairs_drift(self):
+    self.review()
+    self.review()
+    Book.objects.update(review_count=42)
+    ReviewerStats.objects.all().delete()
+    management.call_command('rebuild_review_counts', stdout=StringIO())
+    self.assertEqual(Book.objects.get(pk=self.book.pk).review_count, 2)
+    self.assertEqual(ReviewerStats.review_count_for(self.user), 2)
+
+
+class ReviewClusterTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    author = Author.objects.create(first_name='Adam', last_name='JB')
+    self.book = Book.objects.create(title='My Life', author=author, description='Something', price=42)
+    other = Book.objects.create(title='Other', author=author, description='Something', price=42)
+    # Two tight groups, Portland and Boston, plus a review of another book.
+    for i in range(30):
+      Review.objects.create(book=self.book, user=self.user, text='', latitude=45.5 + i * 0.001, longitude=-122.6)
+    for i in range(20):
+      Review.objects.create(book=self.book, user=self.user, text='', latitude=42.3, longitude=-71.0 - i * 0.001)
+    Review.objects.create(book=other, user=self.user, text='', latitude=45.5, longitude=-122.6)
+    self.client.login(username='Adam', password='password')
+
+  def get_clusters(self, **params):
+    params.setdefault('format', 'json')
+    resp = self.client.get(reverse('api_review_clusters', kwargs={'api_name': 'v1', 'resource_name': 'review'}), params)
+    self.assertEqual(resp.status_code, 200)
+    return json.loads(resp.content)
+
+  def test_cell_codes_nest(self):
+    fine = cell_for(45.5, -122.6)
+    self.assertEqual(fine // 4 ** 10, cell_for(45.51, -122.61) // 4 ** 10)
+    self.assertNotEqual(fine // 4 ** 10, cell_for(42.3, -71.0) // 4 ** 10)
+
+  def test_clusters_carry_counts_and_centroids(self):
+    data = self.get_clusters(book=self.book.pk, zoom=4)
+    clusters = sorted(data['clusters'], key=lambda c: c['count'])
+    self.assertEqual([c['count'] for c in clusters], [20, 30])
+    self.assertAlmostEqual(clusters[1]['latitude'], 45.5145, places=3)
+    self.assertEqual(data['total'], 50)
+
+  def test_bbox_limits_clusters(self):
+    data = self.get_clusters(book=self.book.pk, zoom=6, bbox='40,-80,50,-60')
+    self.assertEqual([c['count'] for c in data['clusters']], [20])
+
+  def test_payload_tracks_clusters_not_reviews(self):
+    for i in range(200):
+      Review.objects.create(book=self.book, user=self.user, text='', latitude=45.5, longitude=-122.6 + i * 0.0001)
+    data = self.get_clusters(book=self.book.pk, zoom=3)
+    self.assertEqual(len(data['clusters']), 2)
+    self.assertEqual(data['total'], 250)
+
+  def test_cell_ranges_cover_the_box(self):
+    rng = random.Random(7)
+    for bbox in [(40, -80, 50, -60), (-10, 170, 10, -170), (45.51, -122.61, 45.52, -122.59), (-90, -180, 90, 180)]:
+      ranges = cell_ranges(bbox)
+      self.assertTrue(1 <= len(ranges) <= 32, ranges)
+      south, west, north, east = bbox
+      width = (east - west) % 360 or 360
+      for i in range(200):
+        latitude = rng.uniform(south, north)
+        longitude = (west + rng.uniform(0, width) + 180) % 360 - 180
+        cell = cell_for(latitude, longitude)
+        self.assertTrue(any(low <= cell <= high for low, high in ranges), (bbox, latitude, longitude))
+
+  def test_antimeridian_bbox(self):
+    Review.objects.create(book=self.book, user=self.user, text='', latitude=0, longitude=179.5)
+    Review.objects.create(book=self.book, user=self.user, text='', latitude=0, longitude=-179.5)
+    data = self.get_clusters(book=self.book.pk, zoom=10, bbox='-10,170,10,-170')
+    self.assertEqual(data['total'], 2)
+
+  def test_migration_indexes_existing_reviews(self):
+    index_reviews = import_module('store.migrations.0011_auto_20261018_2040').index_reviews
+    expected = sorted(Review.objects.values_list('pk', 'geo_cell'))
+    Review.objects.update(geo_cell=0)
+    index_reviews(django_apps, None)
+    self.assertEqual(sorted(Review.objects.values_list('pk', 'geo_cell')), expected)
+
+  def test_invalid_bbox_is_rejected(self):
+    resp = self.client.get('/api/v1/review/clusters/', {'bbox': 'nope', 'format': 'json'})
+    self.assertEqual(resp.status_code, 400)
+
+
+class ReviewApiTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    author = Author.objects.create(first_name='Adam', last_name='JB')
+    self.book = Book.objects.create(title='My Life', author=author, description='Something ' * 100, price=42)
+    self.client.login(username='Adam', password='password')
+
+  def add_reviews(self, count):
+    for i in range(count):
+      user = User.objects.create_user(username='reviewer%d' % Review.objects.count(), password='password')
+      Review.objects.create(book=self.book, user=user, text='Review text ' * 20)
+
+  def get(self, **params):
+    params.setdefault('format', 'json')
+    with CaptureQueriesContext(connection) as queries:
+      resp = self.client.get('/api/v1/review/', params)
+    self.assertEqual(resp.status_code, 200)
+    return resp, len(queries)
+
+  def test_queries_do_not_grow_with_page_size(self):
+    self.add_reviews(3)
+    small = self.get(limit=50)[1]
+    self.add_reviews(40)
+    resp, queries = self.get(limit=50)
+    self.assertEqual(queries, small)
+    self.assertEqual(len(json.loads(resp.content)['objects']), 43)
+
+  def test_cursor_walks_every_review_once(self):
+    self.add_reviews(25)
+    seen = []
+    resp = self.get(limit=10)[0]
+    while True:
+      data = json.loads(resp.content)
+      seen.extend(review['id'] for review in data['objects'])
+      if not data['meta']['next']:
+        break
+      resp = self.client.get(data['meta']['next'])
+    self.assertEqual(sorted(seen, reverse=True), seen)
+    self.assertEqual(len(set(seen)), 25)
+    self.assertNotIn('offset=', resp.request['QUERY_STRING'])
+
+  def test_sparse_fields_shrink_the_payload(self):
+    self.add_reviews(20)
+    full = self.get(limit=20)[0]
+    sparse = self.get(limit=20, fields='latitude,longitude,username')[0]
+    review = json.loads(sparse.content)['objects'][0]
+    self.assertEqual(sorted(review), ['latitude', 'longitude', 'username'])
+    self.assertTrue(review['username'].startswith('reviewer'))
+    self.assertLess(len(sparse.content) * 5, len(full.content))
+
+  def test_default_representation_is_unchanged(self):
+    self.add_reviews(1)
+    review = json.loads(self.get()[0].content)['objects'][0]
+    self.assertEqual(review['user']['username'], 'reviewer0')
+    self.assertIn('book', review)
+    self.assertNotIn('username', review)
+    self.assertNotIn('geo_cell', review)
+
+
+class ApiConditionalGetTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    author = Author.objects.create(first_name='Adam', last_name='JB')
+    self.book = Book.objects.create(title='My Life', author=author, description='Something', price=42)
+    self.other_book = Book.objects.create(title='Other', author=author, description='Something', price=42)
+    Review.objects.create(book=self.book, user=self.user, text='Good')
+    self.client.login(username='Adam', password='password')
+    self.url = '/api/v1/review/?format=json&book=%d' % self.book.pk
+
+  def store_queries(self, url, **headers):
+    with CaptureQueriesContext(connection) as queries:
+      resp = self.client.get(url, **headers)
+    return resp, [q['sql'] for q in queries if 'store_' in q['sql']]
+
+  def test_matching_etag_gets_304_without_touching_reviews(self):
+    first = self.client.get(self.url)
+    self.assertEqual(first.status_code, 200)
+    resp, queries = self.store_queries(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+    self.assertEqual(resp.status_code, 304)
+    self.assertEqual(queries, [])
+
+  def test_if_modified_since(self):
+    first = self.client.get(self.url)
+    resp = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+    self.assertEqual(resp.status_code, 304)
+    resp = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=http_date(0))
+    self.assertEqual(resp.status_code, 200)
+
+  def test_unchanged_list_is_served_from_cache(self):
+    first = self.client.get(self.url)
+    resp, queries = self.store_queries(self.url)
+    self.assertEqual(resp.status_code, 200)
+    self.assertEqual(queries, [])
+    self.assertEqual(resp.content, first.content)
+
+  def test_review_changes_invalidate(self):
+    first = self.client.get(self.url)
+    Review.objects.create(book=self.book, user=self.user, text='Again')
+    resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+    self.assertEqual(resp.status_code, 200)
+    self.assertEqual(len(json.loads(resp.content)['objects']), 2)
+
+    Review.objects.filter(book=self.book).first().delete()
+    self.assertEqual(len(json.loads(self.client.get(self.url).content)['objects']), 1)
+
+  def test_other_books_reviews_keep_etag(self):
+    first = self.client.get(self.url)
+    Review.objects.create(book=self.other_book, user=self.user, text='Elsewhere')
+    resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+    self.assertEqual(resp.status_code, 304)
+
+  def test_book_resource_tracks_book_saves(self):
+    url = '/api/v1/book/?format=json'
+    first = self.client.get(url)
+    self.assertEqual(first.status_code, 200)
+    self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+    self.book.price = 10
+    self.book.save()
+    resp = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+    self.assertEqual(resp.status_code, 200)
+    self.assertIn('"10.00"', resp.content)
+
+  def test_anonymous_requests_are_still_refused(self):
+    first = self.client.get(self.url)
+    self.client.logout()
+    resp = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+    self.assertEqual(resp.status_code, 401)
+
+
+class FragmentCacheTests(object):
+  def setUp(self):
+    self.assertEqual(type(caches['default']).__name__, self.backend)
+    cache.clear()
+    self.user = User.objects.create_user(
+      username='Adam',
+      email='email@email.com',
+      password='password',
+    )
+    User.objects.create_user(username='Bob', email='bob@example.com', password='password')
+    self.author = Author.objects.create(first_name='Terry', last_name='Pratchett')
+    self.book = Book.objects.create(title='My Life', author=self.author, description='Something', price=42)
+
+  def get(self, url):
+    with CaptureQueriesContext(connection) as queries:
+      resp = self.client.get(url)
+    self.assertEqual(resp.status_code, 200)
+    return resp, [q['sql'] for q in queries if 'store_' in q['sql']]
+
+  def test_storefront_grid_is_cached(self):
+    self.get('/store/')
+    resp, queries = self.get('/store/')
+    self.assertContains(resp, 'My Life')
+    self.assertEqual(queries, [])
+
+  def test_book_and_author_saves_invalidate(self):
+    self.get('/store/')
+    self.get('/store/book/%d/' % self.book.pk)
+    self.book.title = 'My Second Life'
+    self.book.save()
+    self.assertContains(self.get('/store/')[0], 'My Second Life')
+    self.assertContains(self.get('/store/book/%d/' % self.book.pk)[0], 'My Second Life')
+
+    self.author.last_name = 'Renamed'
+    self.author.save()
+    self.assertContains(self.get('/store/')[0], 'Renamed, Terry')
+    self.assertContains(self.get('/store/book/%d/' % self.book.pk)[0], 'Renamed, Terry')
+
+  def test_per_user_bits_are_not_cached(self):
+    self.client.login(username='Adam', password='password')
+    resp = self.get('/store/')[0]
+    self.assertContains(resp, 'Add To Cart')
+    self.client.login(username='Bob', password='password')
+    resp = self.get('/store/')[0]
+    self.assertContains(resp, 'Bob')
+    self.assertNotContains(resp, 'Adam')
+    self.client.logout()
+    resp = self.get('/store/')[0]
+    self.assertContains(resp, 'mystery person')
+    self.assertNotContains(resp, 'Bob')
+
+  def test_new_review_invalidates_detail(self):
+    url = '/store/book/%d/' % self.book.pk
+    self.client.login(username='Adam', password='password')
+    self.assertContains(self.get(url)[0], 'Post a review!')
+    self.get(url)
+    Review.objects.create(book=self.book, user=self.user, text='Loved it')
+    resp = self.get(url)[0]
+    self.assertContains(resp, 'Loved it')
+    self.assertContains(resp, 'Reviews (1)')
+    self.assertNotContains(resp, 'Post a review!')
+    self.client.login(username='Bob', password='password')
+    self.assertContains(self.get(url)[0], 'Post a review!')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class LocmemFragmentCacheTestCase(FragmentCacheTests, TestCase):
+  backend = 'LocMemCache'
+
+
+class FileFragmentCacheTestCase(FragmentCacheTests, TestCase):
+  backend = 'FileBasedCache'
+
+  @classmethod
+  def setUpClass(cls):
+    cls.cache_dir = tempfile.mkdtemp()
+    cls.cache_settings = override_settings(CACHES={'default': {
+      'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+      'LOCATION': cls.cache_dir,
+    }})
+    cls.cache_settings.enable()
+    super(FileFragmentCacheTestCase, cls).setUpClass()
+
+  @classmethod
+  def tearDownClass(cls):
+    super(FileFragmentCacheTestCase, cls).tearDownClass()
+    cls.cache_settings.disable()
+    shutil.rmtree(cls.cache_dir)
+
+
+class CoverThumbnailTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.media_root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.media_root, 'books'))
+    shutil.copy(os.path.join(settings.MEDIA_ROOT, 'books', 'empty_cover.jpg'), os.path.join(self.media_root, 'books'))
+    self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+    self.settings_override.enable()
+    self.author = Author.objects.create(first_name='Adam', last_name='JB')
+
+  def tearDown(self):
+    self.settings_override.disable()
+    shutil.rmtree(self.media_root)
+
+  def cover(self, name, size=(800, 1200)):
+    buf = StringIO()
+    Image.new('RGB', size, (200, 40, 40)).save(buf, 'JPEG')
+    return default_storage.save(name, ContentFile(buf.getvalue()))
+
+  def test_saving_a_book_builds_derivatives(self):
+    name = self.cover('books/7/cover.jpeg')
+    Book.objects.create(title='Big', author=self.author, description='', price=1, cover_image=name)
+    for size, box in SIZES:
+      image = Image.open(os.path.join(self.media_root, derivative_name(name, size)))
+      self.assertEqual(image.size, (box[0], box[0] * 3 // 2))
+    self.assertTrue(os.path.exists(os.path.join(self.media_root, 'books/7/cover.jpeg')))
+
+  def test_covers_that_fit_get_no_derivative(self):
+    name = self.cover('books/8/cover.jpeg', size=(150, 225))
+    book = Book.objects.create(title='Small', author=self.author, description='', price=1, cover_image=name)
+    self.assertTrue(os.path.exists(os.path.join(self.media_root, derivative_name(name, 'small'))))
+    for size in ('medium', 'large'):
+      for extension in ('jpg', 'webp'):
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, derivative_name(name, size, extension))))
+    self.assertTrue(has_derivatives(name))
+    html = Template("{% load covers %}{% cover_picture book 'medium' 'large' %}").render(Context({'book': book}))
+    self.assertIn('src="/media/books/8/cover.jpeg"', html)
+    self.assertNotIn('image/webp', html)
+
+  def test_has_derivatives_checks_every_format(self):
+    name = self.cover('books/10/cover.jpeg')
+    Book.objects.create(title='Big', author=self.author, description='', price=1, cover_image=name)
+    self.assertTrue(has_derivatives(name))
+    if 'webp' in [fmt[0] for fmt in available_formats()]:
+      default_storage.delete(derivative_name(name, 'small', 'webp'))
+      self.assertFalse(has_derivatives(name))
+    self.assertFalse(has_derivatives('books/10/missing.jpeg'))
+
+  def test_only_a_new_cover_is_resized(self):
+    name = self.cover('books/11/cover.jpeg')
+    book = Book.objects.create(title='Big', author=self.author, description='', price=1, cover_image=name)
+    small = os.path.join(self.media_root, derivative_name(name, 'small'))
+    os.remove(small)
+    book.title = 'Bigger'
+    book.save()
+    Book.objects.get(pk=book.pk).save()
+    Book.objects.only('title').get(pk=book.pk).save()
+    self.assertFalse(os.path.exists(small))
+    book.cover_image = self.cover('books/11/other.jpeg')
+    book.save()
+    self.assertTrue(os.path.exists(os.path.join(self.media_root, derivative_name(book.cover_image.name, 'small'))))
+
+  def test_backfill_command(self):
+    book = Book.objects.create(title='Old', author=self.author, description='', price=1)
+    name = self.cover('books/9/cover.jpeg')
+    Book.objects.filter(pk=book.pk).update(cover_image=name)
+    management.call_command('generate_cover_thumbnails', processes=2, stdout=StringIO())
+    for size, box in SIZES:
+      self.assertTrue(os.path.exists(os.path.join(self.media_root, derivative_name(name, size))))
+
+  def test_template_tag(self):
+    name = self.cover('books/12/cover.jpeg')
+    book = Book.objects.create(title='Tagged', author=self.author, description='', price=1, cover_image=name)
+    html = Template("{% load covers %}{% cover_picture book 'small' 'medium' %}").render(Context({'book': book}))
+    self.assertIn('src="/media/books/12/cover.small.jpg"', html)
+    self.assertIn('/media/books/12/cover.medium.jpg 2x', html)
+    if 'webp' in [fmt[0] for fmt in available_formats()]:
+      self.assertIn('/media/books/12/cover.small.webp 1x', html)
+
+  def test_template_tag_without_derivatives(self):
+    book = Book(title='Tagged', cover_image='books/empty_cover.jpg')
+    html = Template("{% load covers %}{% cover_picture book 'small' 'medium' %}").render(Context({'book': book}))
+    self.assertIn('src="/media/books/empty_cover.jpg"', html)
+    self.assertNotIn('image/webp', html)
+
+
+class AssetServingTestCase(TestCase):
+  def setUp(self):
+    self.media_root = tempfile.mkdtemp()
+    self.settings_override = override_settings(MEDIA_ROOT=self.media_root, HASHED_ASSET_URLS=True)
+    self.settings_override.enable()
+    self.name = default_storage.save('books/5/cover.jpeg', ContentFile(b'0123456789' * 100))
+
+  def tearDown(self):
+    self.settings_override.disable()
+    shutil.rmtree(self.media_root)
+
+  def test_url_carries_content_hash(self):
+    url = default_storage.url(self.name)
+    self.assertRegexpMatches(url, r'^/media/books/5/cover\.[0-9a-f]{12}\.jpeg$')
+    self.assertEqual(default_storage.url('books/5/missing.jpeg'), '/media/books/5/missing.jpeg')
+
+  def test_hashed_url_is_immutable(self):
+    response = self.client.get(default_storage.url(self.name))
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(b''.join(response.streaming_content), b'0123456789' * 100)
+    self.assertIn('immutable', response['Cache-Control'])
+    self.assertEqual(response['Content-Type'], 'image/jpeg')
+    self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    response = self.client.get(default_storage.url(self.name), HTTP_IF_NONE_MATCH=response['ETag'])
+    self.assertEqual(response.status_code, 304)
+
+  def test_plain_and_stale_urls_revalidate(self):
+    response = self.client.get('/media/books/5/cover.jpeg')
+    self.assertEqual(response.status_code, 200)
+    self.assertNotIn('immutable', response['Cache-Control'])
+    response = self.client.get('/media/books/5/cover.000000000000.jpeg')
+    self.assertEqual(response.status_code, 200)
+    self.assertNotIn('immutable', response['Cache-Control'])
+    self.assertEqual(self.client.get('/media/books/5/other.jpeg').status_code, 404)
+    self.assertEqual(self.client.get('/media/../settings.py').status_code, 404)
+
+  def test_range_requests(self):
+    url = default_storage.url(self.name)
+    response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+    self.assertEqual(response.status_code, 206)
+    self.assertEqual(response['Content-Range'], 'bytes 10-19/1000')
+    self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    response = self.client.get(url, HTTP_RANGE='bytes=-5')
+    self.assertEqual(b''.join(response.streaming_content), b'56789')
+
+    self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=2000-').status_code, 416)
+    self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"old"').status_code, 200)
+
+  @override_settings(SENDFILE_HEADER='X-Sendfile')
+  def test_sendfile(self):
+    response = self.client.get(default_storage.url(self.name))
+    self.assertEqual(response['X-Sendfile'], os.path.join(self.media_root, 'books/5/cover.jpeg'))
+    self.assertEqual(response.content, b'')
+
+  @override_settings(SENDFILE_HEADER='X-Accel-Redirect', SENDFILE_PREFIX='/protected/media/')
+  def test_x_accel_redirect(self):
+    response = self.client.get(default_storage.url(self.name))
+    self.assertEqual(response['X-Accel-Redirect'], '/protected/media/books/5/cover.jpeg')
+    self.assertEqual(response.content, b'')
+
+  def test_static_files_are_not_routed_without_debug(self):
+    with self.assertRaises(Resolver404):
+      resolve(settings.STATIC_URL + 'css/site.css')
+
+
+class QueryPlanTestCase(TestCase):
+  # Fails if a hot lookup stops using an index and scans a whole table.
+  def setUp(self):
+    self.user = User.objects.create_user('planner', 'planner@example.com', 'secret')
+    author = Author.objects.create(first_name='Terry', last_name='Pratchett')
+    self.book = Book.objects.create(title='Mort', author=author, description='', price=1)
+    self.cart = Cart.objects.create(user=self.user, payment_id='PAY-1')
+
+  def assertUsesIndexes(self, queryset):
+    if connection.vendor != 'sqlite':
+      self.skipTest('EXPLAIN QUERY PLAN is SQLite-specific')
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+      cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+      plan = [row[-1] for row in cursor.fetchall()]
+    scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+    self.assertFalse(scans, 'Full table scan in %r for %s' % (plan, sql))
+    return plan
+
+  def test_active_cart(self):
+    self.assertUsesIndexes(Cart.objects.filter(user=self.user, active=True))
+
+  def test_cart_by_payment_id(self):
+    self.assertUsesIndexes(Cart.objects.filter(payment_id='PAY-1'))
+
+  def test_cart_line(self):
+    self.assertUsesIndexes(BookOrder.objects.filter(book=self.book, cart=self.cart))
+
+  def test_reviews_by_user_and_book(self):
+    self.assertUsesIndexes(Review.objects.filter(user=self.user, book=self.book))
+
+  def test_single_term_search(self):
+    plan = self.assertUsesIndexes(
+      SearchTerm.objects.filter(term='mort').order_by('-weight', '-book').values_list('book', flat=True))
+    self.assertFalse([step for step in plan if 'TEMP B-TREE' in step], plan)
+
+  def test_prefix_search(self):
+    self.assertUsesIndexes(SearchTerm.objects.filter(term__gte='mo', term__lt=u'mo\uffff'))
+
+  def test_recommendations(self):
+    self.assertUsesIndexes(Recommendation.objects.filter(book=self.book).order_by('rank'))
+
+  def test_new_orders(self):
+    self.assertUsesIndexes(Cart.objects.filter(active=False, in_recommendations=False))
+
+  def test_reviews_in_bbox(self):
+    bbox = (40.0, -80.0, 50.0, -60.0)
+    self.assertUsesIndexes(in_bbox(Review.objects.all(), bbox))
+    plan = self.assertUsesIndexes(in_bbox(Review.objects.all(), bbox, book=self.book))
+    self.assertTrue(all('geo_cell' in step for step in plan if step.startswith('SEARCH')), plan)
+
+  def test_active_cart_index_survives_migrations(self):
+    if connection.vendor not in ('sqlite', 'postgresql'):
+      self.skipTest('Partial indexes are not supported')
+    if connection.vendor == 'sqlite':
+      sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s"
+    else:
+      sql = 'SELECT indexname FROM pg_indexes WHERE tablename = %s'
+    with connection.cursor() as cursor:
+      cursor.execute(sql, [Cart._meta.db_table])
+      indexes = [row[0] for row in cursor.fetchall()]
+    self.assertIn('store_cart_one_active_per_user', indexes)
+
+  def test_one_active_cart_per_user(self):
+    if connection.vendor not in ('sqlite', 'postgresql'):
+      self.skipTest('Partial indexes are not supported')
+    Cart.objects.create(user=self.user, active=False)
+    with self.assertRaises(IntegrityError), transaction.atomic():
+      Cart.objects.create(user=self.user)
+
+  def test_duplicate_carts_merge_into_the_paid_one(self):
+    if connection.vendor not in ('sqlite', 'postgresql'):
+      self.skipTest('Partial indexes are not supported')
+    merge_duplicates = import_module('store.migrations.0012_auto_20261018_2052').merge_duplicates
+    other = Book.objects.create(title='Guards! Guards!', author=self.book.author, description='', price=1)
+    with connection.cursor() as cursor:
+      cursor.execute('DROP INDEX store_cart_one_active_per_user')
+    newer = Cart.objects.create(user=self.user)
+    BookOrder.objects.create(book=self.book, cart=self.cart, quantity=1)
+    BookOrder.objects.create(book=other, cart=newer, quantity=2)
+    merge_duplicates(django_apps, None)
+    self.assertEqual(list(Cart.objects.filter(user=self.user, active=True)), [self.cart])
+    self.assertEqual(
+      sorted(BookOrder.objects.filter(cart=self.cart).values_list('book', 'quantity')),
+      [(self.book.pk, 1), (other.pk, 2)])
+
+  def test_one_line_per_book(self):
+    BookOrder.objects.create(book=self.book, cart=self.cart, quantity=1)
+    with self.assertRaises(IntegrityError), transaction.atomic():
+      BookOrder.objects.create(book=self.book, cart=self.cart, quantity=1)
+
+
+class CartMutationTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+    author = Author.objects.create(first_name='Terry', last_name='Pratchett')
+    self.books = [
+      Book.objects.create(title='Book %d' % i, author=author, description='', price=5, stock=10)
+      for i in range(3)
+    ]
+    self.cart = Cart.objects.create(user=self.user)
+
+  def quantities(self):
+    return dict(BookOrder.objects.filter(cart=self.cart).values_list('book_id', 'quantity'))
+
+  def test_increment_is_one_query(self):
+    self.cart.add_to_cart(self.books[0].pk)
+    with self.assertNumQueries(1):
+      self.cart.add_to_cart(self.books[0].pk)
+    self.assertEqual(self.quantities(), {self.books[0].pk: 2})
+
+  def test_decrement_then_delete(self):
+    self.cart.set_quantities({self.books[0].pk: 2})
+    with self.assertNumQueries(1):
+      self.cart.remove_from_cart(self.books[0].pk)
+    self.assertEqual(self.quantities(), {self.books[0].pk: 1})
+    self.cart.remove_from_cart(self.books[0].pk)
+    self.assertEqual(self.quantities(), {})
+    self.cart.remove_from_cart(self.books[0].pk)
+
+  def test_unknown_book(self):
+    with self.assertRaises(Book.DoesNotExist):
+      self.cart.add_to_cart(9999)
+    self.assertEqual(self.quantities(), {})
+
+  def test_set_quantities(self):
+    a, b, c = [book.pk for book in self.books]
+    self.cart.set_quantities({a: 1, b: 4})
+    self.cart.set_quantities({str(a): 3, b: 0, c: 2, 9999: 1})
+    self.assertEqual(self.quantities(), {a: 3, c: 2})
+
+  def test_views(self):
+    self.client.login(username='shopper', password='password')
+    self.client.get('/store/add/%d/' % self.books[0].pk)
+    self.client.get('/store/add/%d/' % self.books[0].pk)
+    self.client.get('/store/add/9999/')
+    self.client.get('/store/remove/%d/' % self.books[0].pk)
+    self.assertEqual(self.quantities(), {self.books[0].pk: 1})
+    self.assertEqual(Cart.objects.filter(user=self.user, active=True).count(), 1)
+
+
+class ConcurrentCartTestCase(TransactionTestCase):
+  def test_parallel_adds_are_all_counted(self):
+    user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+    author = Author.objects.create(first_name='Terry', last_name='Pratchett')
+    book = Book.objects.create(title='Popular', author=author, description='', price=5, stock=10)
+    cart = Cart.objects.create(user=user)
+
+    errors = []
+    def add():
+      try:
+        for i in range(5):
+          Cart.objects.get(pk=cart.pk).add_to_cart(book.pk)
+      except Exception as e:
+        errors.append(e)
+      finally:
+        connections.close_all()
+
+    threads = [threading.Thread(target=add) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(errors, [])
+    self.assertEqual(BookOrder.objects.get(cart=cart, book=book).quantity, 40)
+
+
+class SessionCartTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+    author = Author.objects.create(first_name='Terry', last_name='Pratchett')
+    self.books = [
+      Book.objects.create(title='Book %d' % i, author=author, description='', price=5, stock=10)
+      for i in range(2)
+    ]
+
+  def test_anonymous_cart_writes_nothing(self):
+    a, b = [book.pk for book in self.books]
+    with CaptureQueriesContext(connection) as queries:
+      self.client.get('/store/add/%d/' % a)
+      self.client.get('/store/add/%d/' % a)
+      self.client.get('/store/add/%d/' % b)
+      self.client.get('/store/remove/%d/' % b)
+      self.client.get('/store/add/9999/')
+    writes = [q['sql'] for q in queries.captured_queries if re.search(r'\b(INSERT|UPDATE|DELETE)\b', q['sql'])]
+    self.assertEqual(writes, [])
+    self.assertEqual(Cart.objects.count(), 0)
+
+    resp = self.client.get('/store/cart/')
+    self.assertEqual(resp.context['count'], 2)
+    self.assertEqual(resp.context['total'], Decimal('10.00'))
+    self.assertEqual([line.book.pk for line in resp.context['cart']], [a])
+
+  def test_login_merges_into_active_cart(self):
+    a, b = [book.pk for book in self.books]
+    cart = Cart.objects.create(user=self.user)
+    BookOrder.objects.create(cart=cart, book=self.books[0], quantity=2)
+    self.client.get('/store/add/%d/' % a)
+    self.client.get('/store/add/%d/' % b)
+    self.client.post('/accounts/login/', {'username': 'shopper', 'password': 'password'})
+
+    self.assertEqual(dict(cart.bookorder_set.values_list('book_id', 'quantity')), {a: 3, b: 1})
+    self.assertEqual(Cart.objects.filter(user=self.user).count(), 1)
+    self.assertEqual(self.client.cookies['cart'].value, '')
+    self.assertEqual(self.client.get('/store/cart/').context['count'], 4)
+
+  def test_cart_cookie_is_signed_and_sessions_stay_server_side(self):
+    a = self.books[0].pk
+    self.client.get('/store/add/%d/' % a)
+    self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+    self.assertTrue(self.client.cookies['cart']['httponly'])
+    self.client.cookies['cart'] = json.dumps({str(a): 50})
+    self.assertEqual(self.client.get('/store/cart/').context['count'], 0)
+    self.client.get('/store/add/%d/' % a)
+    self.assertEqual(self.client.get('/store/cart/').context['count'], 1)
+
+  def test_checkout_requires_login(self):
+    resp = self.client.get('/store/checkout/paypal')
+    self.assertRedirects(resp, '/accounts/login/?next=/store/cart/', fetch_redirect_response=False)
+
+
+FAKE_GATEWAYS = {
+  'paypal': {'BACKEND': 'store.payments.FakeGateway'},
+  'stripe': {'BACKEND': 'store.payments.FakeGateway'},
+}
+
+
+class CannedAdapter(BaseAdapter):
+  # Answers every request from a list of (status, body) pairs, recording
+  # the requests it saw.
+  def __init__(self, answers):
+    super(CannedAdapter, self).__init__()
+    self.answers = list(answers)
+    self.requests = []
+
+  def send(self, request, **kwargs):
+    self.requests.append((request, kwargs))
+    status, body = self.answers.pop(0)
+    if status is None:
+      raise requests.exceptions.ConnectionError('connection reset')
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(body)
+    response.headers['Content-Type'] = 'application/json'
+    response.request = request
+    response.url = request.url
+    return response
+
+  def close(self):
+    pass
+
+
+class PaymentGatewayTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('payer', 'payer@example.com', 'password')
+    author = Author.objects.create(first_name='Terry', last_name='Pratchett')
+    self.book = Book.objects.create(title='Guards! Guards!', author=author, description='', price=12, stock=5)
+    self.cart = Cart.objects.create(user=self.user)
+    self.cart.add_to_cart(self.book.pk)
+
+  def stripe_gateway(self, answers, **options):
+    gateway = StripeGateway(api_key='sk_test', backoff=0, **options)
+    adapter = CannedAdapter(answers)
+    gateway.session.mount('https://', adapter)
+    return gateway, adapter
+
+  def test_stripe_retries_with_the_same_idempotency_key(self):
+    gateway, adapter = self.stripe_gateway([(None, None), (500, {'error': {'message': 'oops'}}), (200, {'id': 'ch_1'})])
+    self.assertEqual(gateway.charge(self.cart, self.cart.summary(), 'tok_visa'), 'ch_1')
+    keys = set(request.headers['Idempotency-Key'] for request, kwargs in adapter.requests)
+    self.assertEqual(len(adapter.requests), 3)
+    self.assertEqual(len(keys), 1)
+    self.assertTrue(all(0 < kwargs['timeout'] <= 10 for request, kwargs in adapter.requests))
+
+  def test_stripe_gives_up_after_retries(self):
+    gateway, adapter = self.stripe_gateway([(None, None)] * 3, retries=1)
+    with self.assertRaises(PaymentError):
+      gateway.charge(self.cart, self.cart.summary(), 'tok_visa')
+    self.assertEqual(len(adapter.requests), 2)
+
+  def test_stripe_decline_is_not_retried(self):
+    gateway, adapter = self.stripe_gateway([(402, {'error': {'type': 'card_error', 'message': 'Declined'}})])
+    with self.assertRaises(PaymentDeclined):
+      gateway.charge(self.cart, self.cart.summary(), 'tok_visa')
+    self.assertEqual(len(adapter.requests), 1)
+
+  def test_paypal_client_error_is_declined(self):
+    gateway = PayPalGateway(client_id='id', client_secret='secret', backoff=0)
+    adapter = CannedAdapter([
+      (200, {'access_token': 'token', 'token_type': 'Bearer', 'expires_in': 3600}),
+      (404, {'name': 'INVALID_RESOURCE_ID'}),
+    ])
+    gateway.session.mount('https://', adapter)
+    with self.assertRaises(PaymentDeclined):
+      gateway.execute_payment('PAY-MISSING', 'PAYER')
+    self.assertEqual(len(adapter.requests), 2)
+
+  def test_unsupported_operation(self):
+    gateway = StripeGateway(api_key='sk_test')
+    with self.assertRaisesRegexp(PaymentError, 'StripeGateway does not support create_payment'):
+      gateway.create_payment(self.cart, self.cart.summary(), 'http://testserver/back', 'http://testserver/')
+
+  def test_deadline(self):
+    gateway = FakeGateway(timeout=0.05, backoff=0.01)
+    calls = []
+    def slow():
+      calls.append(1)
+      time.sleep(0.03)
+      gateway.remaining()
+      raise IOError
+    gateway.retryable = (IOError,)
+    with self.assertRaises(PaymentError):
+      gateway.call(slow)
+    self.assertEqual(len(calls), 2)
+
+  def test_fake_gateway_is_idempotent(self):
+    gateway = FakeGateway()
+    summary = self.cart.summary()
+    first = gateway.create_payment(self.cart, summary, 'http://testserver/back', 'http://testserver/')
+    self.assertEqual(gateway.create_payment(self.cart, summary, 'http://testserver/back', 'http://testserver/'), first)
+    self.cart.add_to_cart(self.book.pk)
+    self.assertNotEqual(gateway.create_payment(self.cart, self.cart.summary(), 'http://testserver/back', 'http://testserver/'), first)
+    self.assertEqual(gateway.charge(self.cart, summary, 'tok_a'), gateway.charge(self.cart, summary, 'tok_a'))
+    with self.assertRaises(PaymentDeclined):
+      gateway.charge(self.cart, summary, 'tok_declined')
+
+  @override_settings(PAYMENT_GATEWAYS=FAKE_GATEWAYS)
+  def test_stripe_checkout_flow(self):
+    self.client.login(username='payer', password='password')
+    resp = self.client.post('/store/checkout/stripe', {'stripeToken': 'tok_visa'})
+    self.assertRedirects(resp, '/store/process/stripe', fetch_redirect_response=False)
+    resp = self.client.get('/store/complete_order/stripe')
+    self.assertContains(resp, 'being processed')
+    status_url = '/store/order_status/%d/' % self.cart.pk
+    self.assertEqual(json.loads(self.client.get(status_url).content)['status'], 'authorized')
+
+    management.call_command('reconcile_payments', stdout=StringIO())
+    status = json.loads(self.client.get(status_url).content)
+    self.assertEqual(status['status'], 'captured')
+    self.assertIn('Success!', status['message'])
+    self.assertTrue(Cart.objects.get(pk=self.cart.pk).payment_id.startswith('ch_fake'))
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 4)
+
+  @override_settings(PAYMENT_GATEWAYS=FAKE_GATEWAYS)
+  def test_paypal_checkout_flow(self):
+    self.client.login(username='payer', password='password')
+    resp = self.client.get('/store/checkout/paypal')
+    payment_id = Cart.objects.get(pk=self.cart.pk).payment_id
+    self.assertEqual(resp['Location'], 'http://testserver/store/process/paypal?paymentId=%s&PayerID=FAKE' % payment_id)
+    resp = self.client.get('/store/process/paypal', {'paymentId': payment_id, 'PayerID': 'FAKE'})
+    self.assertEqual(resp.context['total'], Decimal('12.00'))
+    self.client.get('/store/complete_order/paypal')
+    self.assertEqual(capture_authorized(), (1, 0))
+    cart = Cart.objects.get(pk=self.cart.pk)
+    self.assertFalse(cart.active)
+    self.assertEqual(cart.payment_status, Cart.CAPTURED)
+    self.assertEqual(cart.payment_token, 'FAKE')
+
+
+class FlakyGateway(FakeGateway):
+  failures = 0
+
+  def charge(self, cart, summary, token):
+    if FlakyGateway.failures:
+      FlakyGateway.failures -= 1
+      raise PaymentError('gateway unavailable')
+    return super(FlakyGateway, self).charge(cart, summary, token)
+
+
+@override_settings(
+  PAYMENT_GATEWAYS={'stripe': {'BACKEND': 'store.tests.FlakyGateway'}},
+  PAYMENT_RETRY_DELAY=0,
+  PAYMENT_MAX_ATTEMPTS=2,
+)
+class PaymentReconcileTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user('payer', 'payer@example.com', 'password')
+    author = Author.objects.create(first_name='Terry', last_name='Pratchett')
+    self.book = Book.objects.create(title='Guards! Guards!', author=author, description='', price=12, stock=1)
+    self.cart = Cart.objects.create(user=self.user)
+    self.cart.add_to_cart(self.book.pk)
+
+  def tearDown(self):
+    FlakyGateway.failures = 0
+
+  def authorize(self, token='tok_visa'):
+    authorize(self.cart, 'Stripe', token)
+
+  def test_decline_fails_at_once(self):
+    self.authorize('tok_declined')
+    self.assertEqual(capture_authorized(), (0, 1))
+    cart = Cart.objects.get(pk=self.cart.pk)
+    self.assertEqual(cart.payment_status, Cart.FAILED)
+    self.assertIn('declined', cart.payment_error)
+    self.assertTrue(cart.active)
+    # The stock taken before the charge is given back.
+    self.assertFalse(cart.stock_committed)
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 1)
+
+  def test_stock_is_held_while_retrying(self):
+    FlakyGateway.failures = 1
+    self.authorize()
+    capture_authorized()
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 0)
+    self.assertEqual(capture_authorized(), (1, 0))
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 0)
+
+  def test_authorizing_again_is_a_no_op(self):
+    self.authorize()
+    Cart.objects.filter(pk=self.cart.pk).update(payment_attempts=2)
+    self.assertFalse(authorize(Cart.objects.get(pk=self.cart.pk), 'Stripe', 'tok_other'))
+    cart = Cart.objects.get(pk=self.cart.pk)
+    self.assertEqual((cart.payment_attempts, cart.payment_token), (2, 'tok_visa'))
+
+    Cart.objects.filter(pk=self.cart.pk).update(payment_status=Cart.FAILED)
+    self.assertTrue(authorize(Cart.objects.get(pk=self.cart.pk), 'Stripe', 'tok_other'))
+    self.assertEqual(Cart.objects.get(pk=self.cart.pk).payment_attempts, 0)
+
+  def test_changed_cart_is_not_charged(self):
+    self.book.stock = 5
+    self.book.save()
+    self.authorize()
+    self.assertEqual(Cart.objects.get(pk=self.cart.pk).payment_amount, Decimal('12.00'))
+    self.cart.add_to_cart(self.book.pk)
+    self.assertEqual(capture_authorized(), (0, 1))
+    cart = Cart.objects.get(pk=self.cart.pk)
+    self.assertEqual(cart.payment_status, Cart.FAILED)
+    self.assertIn('changed', cart.payment_error)
+    self.assertIsNone(cart.payment_id)
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 5)
+
+  def test_authorized_cart_is_frozen(self):
+    other = Book.objects.create(title='Mort', author=self.book.author, description='', price=8, stock=5)
+    self.authorize()
+    self.client.login(username='payer', password='password')
+    self.client.get('/store/add/%d/' % other.pk)
+    self.client.get('/store/remove/%d/' % self.book.pk)
+    self.assertEqual(list(self.cart.bookorder_set.values_list('book', 'quantity')), [(self.book.pk, 1)])
+    self.assertRedirects(self.client.post('/store/checkout/stripe', {'stripeToken': 'tok_visa'}),
+      '/store/cart/', fetch_redirect_response=False)
+    self.assertEqual(capture_authorized(), (1, 0))
+
+  def test_complete_order_without_a_cart(self):
+    Cart.objects.filter(pk=self.cart.pk).update(active=False)
+    self.client.login(username='payer', password='password')
+    self.assertEqual(self.client.get('/store/complete_order/stripe').status_code, 404)
+
+  def test_transient_errors_are_retried(self):
+    FlakyGateway.failures = 1
+    self.authorize()
+    self.assertEqual(capture_authorized(), (0, 1))
+    self.assertEqual(Cart.objects.get(pk=self.cart.pk).payment_status, Cart.AUTHORIZED)
+    self.assertEqual(capture_authorized(), (1, 0))
+    self.assertEqual(Cart.objects.get(pk=self.cart.pk).payment_status, Cart.CAPTURED)
+
+  def test_gives_up_after_max_attempts(self):
+    FlakyGateway.failures = 5
+    self.authorize()
+    capture_authorized()
+    capture_authorized()
+    self.assertEqual(capture_authorized(), (0, 0))
+    self.assertEqual(Cart.objects.get(pk=self.cart.pk).payment_status, Cart.FAILED)
+
+  def test_unexpected_errors_do_not_stop_the_batch(self):
+    # An unknown processor raises KeyError from capture().
+    self.authorize()
+    Cart.objects.filter(pk=self.cart.pk).update(payment_type='Bitcoin')
+    other = Cart.objects.create(user=User.objects.create_user('other', 'other@example.com', 'password'))
+    other.add_to_cart(Book.objects.create(title='Mort', author=self.book.author, description='', price=8, stock=5).pk)
+    authorize(other, 'Stripe', 'tok_visa')
+    self.assertEqual(capture_authorized(), (1, 1))
+    self.assertEqual(Cart.objects.get(pk=self.cart.pk).payment_status, Cart.AUTHORIZED)
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 0)
+    self.assertEqual(capture_authorized(), (0, 1))
+    cart = Cart.objects.get(pk=self.cart.pk)
+    self.assertEqual(cart.payment_status, Cart.FAILED)
+    self.assertFalse(cart.stock_committed)
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 1)
+
+  def test_out_of_stock(self):
+    self.cart.add_to_cart(self.book.pk)
+    self.authorize()
+    self.assertEqual(capture_authorized(), (0, 1))
+    cart = Cart.objects.get(pk=self.cart.pk)
+    self.assertEqual(cart.payment_status, Cart.FAILED)
+    # Refused before the card is charged.
+    self.assertIsNone(cart.payment_id)
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 1)
+
+  def test_status_is_private(self):
+    User.objects.create_user('other', 'other@example.com', 'password')
+    self.client.login(username='other', password='password')
+    self.assertEqual(self.client.get('/store/order_status/%d/' % self.cart.pk).status_code, 404)
+
+class SearchTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.christie = Author.objects.create(first_name='Agatha', last_name='Christie')
+    self.doyle = Author.objects.create(first_name='Arthur', last_name='Conan Doyle')
+    self.orient = Book.objects.create(
+      title='Murder on the Orient Express', author=self.christie, price=10,
+      description='A detective is stranded on a train in the snow.')
+    self.hound = Book.objects.create(
+      title='The Hound of the Baskervilles', author=self.doyle, price=10,
+      description='A murder on the moors, and a detective from Baker Street.')
+    self.study = Book.objects.create(
+      title='A Study in Scarlet', author=self.doyle, price=10,
+      description=u'Holmes meets Watson, a doctor back from Afghanistan, in a caf\xe9.')
+
+  def test_parse_query(self):
+    self.assertEqual(parse_query('The Murder of'), (['murder'], None))
+    self.assertEqual(parse_query('The Murder of', autocomplete=True), (['murder'], 'of'))
+    self.assertEqual(parse_query('murder det ', autocomplete=True), (['murder', 'det'], None))
+
+  def test_title_outranks_description(self):
+    self.assertEqual(ranked_ids('murder'), [self.orient.pk, self.hound.pk])
+
+  def test_all_terms_must_match(self):
+    self.assertEqual(ranked_ids('murder train'), [self.orient.pk])
+    self.assertEqual(ranked_ids('murder scarlet'), [])
+    self.assertEqual(ranked_ids('the of'), [])
+
+  def test_author_names(self):
+    self.assertEqual(ranked_ids('christie'), [self.orient.pk])
+    self.assertEqual(sorted(ranked_ids('doyle')), [self.hound.pk, self.study.pk])
+
+  def test_prefix(self):
+    self.assertEqual(ranked_ids('bask', autocomplete=True), [self.hound.pk])
+    self.assertEqual(ranked_ids('bask'), [])
+    self.assertEqual(ranked_ids('detective ba', autocomplete=True), [self.hound.pk])
+
+  def test_accents(self):
+    self.assertEqual(ranked_ids('cafe'), [self.study.pk])
+    self.assertEqual(ranked_ids(u'caf\xe9'), [self.study.pk])
+
+  def test_pagination(self):
+    first = search('doyle', page=1, page_size=1)
+    second = search('doyle', page=2, page_size=1)
+    self.assertTrue(first.has_next)
+    self.assertEqual(first.next_page_number, 2)
+    self.assertFalse(second.has_next)
+    self.assertEqual(len(first.object_list + second.object_list), 2)
+    self.assertNotEqual(first.object_list, second.object_list)
+
+  def test_index_follows_edits(self):
+    self.study.title = 'The Sign of the Four'
+    self.study.save()
+    self.assertEqual(ranked_ids('scarlet'), [])
+    self.assertEqual(ranked_ids('sign four'), [self.study.pk])
+
+    self.doyle.last_name = 'Bell'
+    self.doyle.save()
+    self.assertEqual(ranked_ids('doyle'), [])
+    self.assertEqual(sorted(ranked_ids('bell')), [self.hound.pk, self.study.pk])
+
+    self.hound.delete()
+    self.assertFalse(SearchTerm.objects.filter(book=self.hound.pk).exists())
+
+  def test_view(self):
+    response = self.client.get('/store/search/', {'q': 'murder'})
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.context['books'], [self.orient, self.hound])
+    self.assertContains(response, 'Orient Express')
+    self.assertNotContains(response, 'Scarlet')
+    self.assertEqual(self.client.get('/store/search/', {'q': 'murder', 'page': 'x'}).status_code, 200)
+
+  def test_api(self):
+    response = self.client.get('/api/v1/book/search/', {'q': 'hou', 'format': 'json'})
+    self.assertEqual(response.status_code, 200)
+    data = json.loads(response.content)
+    self.assertEqual([book['id'] for book in data['objects']], [self.hound.pk])
+    self.assertEqual(data['objects'][0]['author'], 'Conan Doyle, Arthur')
+    self.assertIsNone(data['meta']['next'])
+    self.assertEqual(self.client.get('/api/v1/book/search/', {'q': 'x', 'limit': 'x'}).status_code, 400)
+
+  def test_rebuild_command(self):
+    SearchTerm.objects.all().delete()
+    out = StringIO()
+    management.call_command('rebuild_search_index', stdout=out)
+    self.assertIn('3 books', out.getvalue())
+    self.assertEqual(ranked_ids('murder'), [self.orient.pk, self.hound.pk])
+
+
+
+class RecommendationTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+    author = Author.objects.create(first_name='Dorothy', last_name='Sayers')
+    self.books = [
+      Book.objects.create(title='Book %d' % i, author=author, description='', price=1)
+      for i in range(5)
+    ]
+    self.user = User.objects.create_user('buyer', 'buyer@example.com', 'password')
+
+  def order(self, *books, **kwargs):
+    # Completes a cart without going through checkout.
+    cart = Cart.objects.create(user=self.user)
+    for book in books:
+      BookOrder.objects.create(cart=cart, book=book, quantity=1)
+    if kwargs.get('completed', True):
+      Cart.objects.filter(pk=cart.pk).update(active=False)
+    return cart
+
+  def recommended(self, book):
+    return list(Recommendation.objects.filter(book=book).order_by('rank').values_list('recommended', 'score'))
+
+  def test_ranked_by_orders_in_common(self):
+    a, b, c, d, e = self.books
+    self.order(a, b, c)
+    self.order(a, b)
+    self.order(a, d)
+    self.order(e)
+    self.assertEqual(update_recommendations(), 4)
+    self.assertEqual(self.recommended(a), [(b.pk, 2), (c.pk, 1), (d.pk, 1)])
+    self.assertEqual(self.recommended(b), [(a.pk, 2), (c.pk, 1)])
+    self.assertEqual(self.recommended(e), [])
+
+  def test_only_completed_orders(self):
+    a, b = self.books[:2]
+    self.order(a, b, completed=False)
+    self.assertEqual(update_recommendations(), 0)
+    self.assertEqual(self.recommended(a), [])
+
+  @override_settings(RECOMMENDATIONS_PER_BOOK=2)
+  def test_keeps_top_k(self):
+    self.order(*self.books)
+    update_recommendations()
+    self.assertEqual(len(self.recommended(self.books[0])), 2)
+
+  def test_incremental(self):
+    a, b, c, d, e = self.books
+    self.order(a, b)
+    update_recommendations()
+    self.assertEqual(update_recommendations(), 0)
+
+    # Only the books in new orders are recomputed.
+    Recommendation.objects.filter(book=a).update(score=99)
+    self.order(c, d)
+    self.assertEqual(update_recommendations(), 1)
+    self.assertEqual(self.recommended(a), [(b.pk, 99)])
+    self.assertEqual(self.recommended(c), [(d.pk, 1)])
+
+    self.order(a, c)
+    update_recommendations()
+    self.assertEqual(self.recommended(a), [(b.pk, 1), (c.pk, 1)])
+    self.assertEqual(self.recommended(c), [(a.pk, 1), (d.pk, 1)])
+
+  def test_rebuild(self):
+    a, b = self.books[:2]
+    self.order(a, b)
+    Recommendation.objects.create(book=a, recommended=self.books[4], rank=0, score=99)
+    self.assertEqual(rebuild_recommendations(), 2)
+    self.assertEqual(self.recommended(a), [(b.pk, 1)])
+    self.assertEqual(update_recommendations(), 0)
+
+  def test_command(self):
+    self.order(*self.books[:2])
+    out = StringIO()
+    management.call_command('build_recommendations', stdout=out)
+    self.assertIn('Counted 1 orders', out.getvalue())
+    management.call_command('build_recommendations', rebuild=True, stdout=out)
+    self.assertIn('rebuilt for 2 books', out.getvalue())
+
+  def test_book_details(self):
+    a, b = self.books[:2]
+    self.order(a, b)
+    update_recommendations()
+    response = self.client.get(reverse('book_details', args=(a.pk,)))
+    self.assertContains(response, 'also bought')
+    self.assertContains(response, reverse('book_details', args=(b.pk,)))
+    self.assertNotContains(self.client.get(reverse('book_details', args=(self.books[2].pk,))), 'also bought')
+
+
+class CatalogImportTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.author = Author.objects.create(first_name='Ngaio', last_name='Marsh')
+    self.book = Book.objects.create(title='Artists in Crime', author=self.author, description='', price=5, stock=1)
+    self.tmp = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def write(self, name, content):
+    path = os.path.join(self.tmp, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def test_csv(self):
+    rows = read_csv(StringIO(
+      'id,title,author_first_name,author_last_name,price,stock\n'
+      ',Overture to Death,Ngaio,Marsh,7.5,3\n'
+      ',The Nine Tailors,Dorothy,Sayers,8,\n'
+      '%d,,,,,9\n' % self.book.pk
+    ))
+    stats = import_rows(rows)
+    self.assertEqual((stats.created, stats.updated, stats.skipped), (2, 1, 0))
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 9)
+    self.assertEqual(Book.objects.get(pk=self.book.pk).title, 'Artists in Crime')
+    overture = Book.objects.get(title='Overture to Death')
+    self.assertEqual((overture.author, overture.price, overture.stock), (self.author, Decimal('7.50'), 3))
+    self.assertEqual(Book.objects.get(title='The Nine Tailors').author.last_name, 'Sayers')
+    self.assertEqual(Author.objects.count(), 2)
+    self.assertEqual(ranked_ids('tailors'), [Book.objects.get(title='The Nine Tailors').pk])
+
+  def test_jsonl(self):
+    rows = read_jsonl(StringIO(
+      '{"id": %d, "title": "Death in Ecstasy", "author_first_name": "Dorothy", "author_last_name": "Sayers"}\n'
+      '\n'
+      '{"title": "Surfeit of Lampreys", "author_first_name": "Ngaio", "author_last_name": "Marsh", "price": "6.00", "publish_date": "1941-01-01"}\n'
+      % self.book.pk
+    ))
+    stats = import_rows(rows)
+    self.assertEqual((stats.created, stats.updated, stats.skipped), (1, 1, 0))
+    book = Book.objects.get(pk=self.book.pk)
+    self.assertEqual((book.title, book.author.last_name, book.stock), ('Death in Ecstasy', 'Sayers', 1))
+    self.assertEqual(ranked_ids('ecstasy sayers'), [book.pk])
+    self.assertEqual(ranked_ids('artists'), [])
+    self.assertEqual(Book.objects.get(title='Surfeit of Lampreys').publish_date, datetime.date(1941, 1, 1))
+
+  def test_bad_rows_are_skipped(self):
+    rows = read_jsonl(StringIO(
+      '{"id": 999999, "stock": 1}\n'
+      '{"id": %d, "stock": -1}\n'
+      '{"id": %d, "price": "cheap"}\n'
+      '{"title": "No Author", "price": 1}\n'
+      'not json\n'
+      '{"id": %d, "stock": [4]}\n'
+      '{"id": %d, "title": {"en": "Title"}}\n'
+      '{"id": %d, "stock": 4}\n' % ((self.book.pk,) * 5)
+    ))
+    stats = import_rows(rows, batch_size=2)
+    self.assertEqual((stats.created, stats.updated, stats.skipped), (0, 1, 7))
+    self.assertIn('line 1: no book with id 999999', stats.errors)
+    self.assertIn('line 5: not a JSON object', stats.errors)
+    self.assertIn('line 6: stock must not be a list or object', stats.errors)
+    self.assertIn('line 7: title must not be a list or object', stats.errors)
+    with self.assertRaises(ValueError):
+      parse_row({'id': self.book.pk, 'stock': None})
+    self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 4)
+
+  def test_bad_values_are_skipped(self):
+    rows = list(read_jsonl(StringIO(
+      '{"id": %d, "price": "NaN"}\n'
+      '{"id": %d, "price": Infinity}\n'
+      '{"id": %d, "stock": 1.7}\n' % ((self.book.pk,) * 3)
+    )))
+    rows += list(read_csv(StringIO('id,title,stock\n%d,Caf\xe9,2\n%d,,3\n' % ((self.book.pk,) * 2))))
+    stats = import_rows(rows)
+    self.assertEqual((stats.updated, stats.skipped), (1, 4))
+    self.assertIn("line 1: invalid price u'NaN'", stats.errors)
+    self.assertIn('line 3: stock must be a whole number, not 1.7', stats.errors)
+    self.assertIn('line 2: title is not valid UTF-8', stats.errors)
+    book = Book.objects.get(pk=self.book.pk)
+    self.assertEqual((book.title, book.price, book.stock), ('Artists in Crime', Decimal('5.00'), 3))
+
+  def test_batches(self):
+    rows = read_csv(StringIO('title,author_first_name,author_last_name,price\n' + 'Book,Ngaio,Marsh,1\n' * 25))
+    reports = []
+    with CaptureQueriesContext(connection) as queries:
+      stats = import_rows(rows, batch_size=10, report=lambda stats: reports.append(stats.rows))
+    self.assertEqual(stats.created, 25)
+    self.assertEqual(reports, [10, 20, 25])
+    self.assertEqual(len([q for q in queries if 'INSERT INTO "store_book"' in q['sql']]), 3)
+
+  def test_bulk_update_batches(self):
+    Book.objects.bulk_create([
+      Book(title='Book %d' % i, author=self.author, description='', price=1) for i in range(1200)
+    ])
+    rows = [(i, {'id': pk, 'stock': i, 'price': '2'}) for i, pk in enumerate(Book.objects.values_list('pk', flat=True))]
+    with CaptureQueriesContext(connection) as queries:
+      stats = import_rows(rows, batch_size=2000)
+    self.assertEqual(stats.updated, 1201)
+    self.assertEqual(Book.objects.filter(price=2).count(), 1201)
+    self.assertLess(len([q for q in queries if q['sql'].startswith('UPDATE') or 'UPDATE "store_book"' in q['sql']]), 10)
+
+  def test_export_round_trip(self):
+    Book.objects.create(title=u'Caf\xe9 Noir', author=self.author, description='a, "quoted"\nline', price='3.25')
+    for file_format in ('csv', 'jsonl'):
+      path = os.path.join(self.tmp, 'catalog.' + file_format)
+      management.call_command('export_catalog', output=path, batch_size=1)
+      before = list(export_rows())
+      out = StringIO()
+      management.call_command('import_catalog', path, stdout=out)
+      self.assertIn('2 rows: 0 created, 2 updated, 0 skipped', out.getvalue())
+      self.assertEqual(list(export_rows()), before)
+    self.assertEqual(Book.objects.count(), 2)
+
+  def test_export_to_stdout(self):
+    out = StringIO()
+    management.call_command('export_catalog', format='jsonl', stdout=out)
+    row = json.loads(out.getvalue())
+    self.assertEqual((row['id'], row['title'], row['price']), (self.book.pk, 'Artists in Crime', '5.00'))
+
+  def test_command_errors(self):
+    err = StringIO()
+    path = self.write('stock.csv', 'id,stock\n999999,1\n')
+    management.call_command('import_catalog', path, stdout=StringIO(), stderr=err)
+    self.assertIn('line 2: no book with id 999999', err.getvalue())
+    with self.assertRaises(management.CommandError):
+      management.call_command('import_catalog', self.write('stock.xml', ''))
+
+
+class SalesRollupTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.user = User.objects.create_superuser('manager', 'manager@example.com', 'password')
+    author = Author.objects.create(first_name='Josephine', last_name='Tey')
+    self.cheap = Book.objects.create(title='Brat Farrar', author=author, description='', price='5.00', stock=20)
+    self.dear = Book.objects.create(title='The Franchise Affair', author=author, description='', price='12.50', stock=20)
+    self.day = datetime.date(2020, 3, 1)
+
+  def checkout(self, lines, payment_type='Stripe', day=None):
+    cart = Cart.objects.create(user=self.user)
+    for book, quantity in lines:
+      BookOrder.objects.create(cart=cart, book=book, quantity=quantity)
+    cart.payment_type = payment_type
+    cart.order_date = day or self.day
+    self.assertTrue(close_cart(cart))
+    return cart
+
+  def rollups(self):
+    return (
+      sorted(DailyBookSales.objects.values_list('date', 'book', 'units', 'revenue')),
+      sorted(DailyPaymentSales.objects.values_list('date', 'payment_type', 'orders', 'units', 'revenue')),
+    )
+
+  def test_completed_carts_are_rolled_up(self):
+    self.checkout([(self.cheap, 2), (self.dear, 1)])
+    cart = self.checkout([(self.cheap, 1)], payment_type='PayPal')
+    close_cart(cart)
+    self.assertEqual(self.rollups(), (
+      [(self.day, self.cheap.pk, 3, Decimal('15.00')), (self.day, self.dear.pk, 1, Decimal('12.50'))],
+      [(self.day, 'PayPal', 1, 1, Decimal('5.00')), (self.day, 'Stripe', 1, 3, Decimal('22.50'))],
+    ))
+
+  def test_sale_is_recorded_in_a_fixed_number_of_queries(self):
+    books = [
+      Book.objects.create(title='Book %d' % i, author=self.cheap.author, description='', price='2.00', stock=5)
+      for i in range(10)
+    ]
+    self.checkout([(book, 1) for book in books[:5]])
+    with CaptureQueriesContext(connection) as queries:
+      self.checkout([(book, 2) for book in books])
+    self.assertEqual(len([q for q in queries if 'store_dailybooksales' in q['sql']]), 3)
+    self.assertEqual(
+      sorted(DailyBookSales.objects.filter(book__in=books).values_list('units', flat=True)),
+      [2] * 5 + [3] * 5)
+    self.assertEqual(DailyPaymentSales.objects.get().revenue, Decimal('50.00'))
+
+  def test_out_of_stock_orders_are_not_counted(self):
+    Book.objects.filter(pk=self.cheap.pk).update(stock=0)
+    cart = Cart.objects.create(user=self.user, payment_type='Stripe')
+    BookOrder.objects.create(cart=cart, book=self.cheap, quantity=1)
+    self.assertFalse(close_cart(cart))
+    self.assertEqual(self.rollups(), ([], []))
+
+  def test_rebuild_matches_incremental(self):
+    self.checkout([(self.cheap, 2), (self.dear, 1)])
+    self.checkout([(self.dear, 3)], payment_type='PayPal')
+    self.checkout([(self.cheap, 1)], day=self.day + datetime.timedelta(days=1))
+    Cart.objects.create(user=User.objects.create_user('browser', 'b@example.com', 'password'))
+    expected = self.rollups()
+    DailyBookSales.objects.filter(book=self.cheap).update(units=99)
+    self.assertEqual(rebuild_rollups(), 3)
+    self.assertEqual(self.rollups(), expected)
+
+    DailyPaymentSales.objects.all().update(orders=99)
+    rebuild_rollups(since=self.day + datetime.timedelta(days=1))
+    self.assertEqual(DailyPaymentSales.objects.get(date=self.day, payment_type='PayPal').orders, 99)
+    self.assertEqual(DailyPaymentSales.objects.get(date=self.day + datetime.timedelta(days=1)).orders, 1)
+
+  def test_report(self):
+    self.checkout([(self.cheap, 2), (self.dear, 1)])
+    self.checkout([(self.dear, 2)], payment_type='PayPal', day=self.day + datetime.timedelta(days=1))
+    self.checkout([(self.cheap, 5)], day=self.day - datetime.timedelta(days=1))
+    report = sales_report(self.day, self.day + datetime.timedelta(days=1))
+    self.assertEqual((report['orders'], report['units'], report['revenue']), (2, 5, Decimal('47.50')))
+    self.assertEqual([row['date'] for row in report['days']], [self.day + datetime.timedelta(days=1), self.day])
+    self.assertEqual([row['payment_type'] for row in report['payment_types']], ['PayPal', 'Stripe'])
+    self.assertEqual(
+      [(row['book'], row['total_units'], row['book__stock']) for row in report['books']],
+      [(self.dear.pk, 3, 17), (self.cheap.pk, 2, 13)],
+    )
+
+  def test_dashboard_reads_only_rollups(self):
+    for i in range(5):
+      self.checkout([(self.cheap, 1)], day=self.day - datetime.timedelta(days=i))
+    self.client.login(username='manager', password='password')
+    url = reverse('admin:store_sales_dashboard')
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url, {'start': '2020-02-01', 'end': '2020-03-31'})
+    self.assertContains(response, '5 orders, 5 books, $25.00')
+    self.assertContains(response, 'Brat Farrar')
+    self.assertFalse([q for q in queries if 'store_bookorder' in q['sql'] or 'store_cart' in q['sql']])
+
+    self.assertContains(self.client.get(url, {'start': '2020-03-31', 'end': '2020-02-01'}), 'must not be after')
+    self.assertContains(self.client.get(reverse('admin:store_dailybooksales_changelist')), url)
+
+  def test_rollups_are_read_only_in_the_admin(self):
+    self.checkout([(self.cheap, 1)])
+    row = DailyBookSales.objects.get()
+    self.client.login(username='manager', password='password')
+    self.client.post(reverse('admin:store_dailybooksales_change', args=[row.pk]), {'units': 99, 'revenue': '0'})
+    self.assertEqual(DailyBookSales.objects.get().units, 1)
+    self.assertEqual(self.client.get(reverse('admin:store_dailybooksales_delete', args=[row.pk])).status_code, 403)
+
+    clerk = User.objects.create_user('clerk', 'clerk@example.com', 'password')
+    clerk.is_staff = True
+    clerk.save()
+    self.client.login(username='clerk', password='password')
+    self.assertEqual(self.client.get(reverse('admin:store_sales_dashboard')).status_code, 403)
+
+  def test_command(self):
+    self.checkout([(self.cheap, 1)])
+    DailyBookSales.objects.all().delete()
+    out = StringIO()
+    management.call_command('rebuild_sales_rollups', stdout=out)
+    self.assertIn('from 1 orders', out.getvalue())
+    self.assertEqual(DailyBookSales.objects.get().units, 1)
+    with self.assertRaises(management.CommandError):
+      management.call_command('rebuild_sales_rollups', since='March')
+
+class MetricsTestCase(TestCase):
+  def setUp(self):
+    author = Author.objects.create(first_name='Josephine', last_name='Tey')
+    self.book = Book.objects.create(title='Brat Farrar', author=author, description='', price=10, stock=5)
+    for metric in metrics.REGISTRY:
+      metric.clear()
+
+  def test_request_metrics(self):
+    self.client.get('/store/')
+    self.client.get('/store/')
+    self.assertEqual(metrics.REQUEST_SECONDS.count('index'), 2)
+    self.assertEqual(metrics.REQUEST_QUERIES.count('index'), 2)
+    self.assertGreater(metrics.REQUEST_QUERIES._series[('index',)][0], 0)
+    self.assertGreater(metrics.TEMPLATE_SECONDS._series[('index',)][0], 0)
+    self.assertEqual(metrics.QUERY_LIMIT_EXCEEDED.value('index'), 0)
+    self.client.get('/no/such/page/')
+    self.assertEqual(metrics.REQUEST_SECONDS.count('<unresolved>'), 1)
+
+  def test_external_calls(self):
+    middleware = metrics.MetricsMiddleware()
+    request = RequestFactory().get('/')
+    middleware.process_request(request)
+    with metrics.timed('payment'):
+      time.sleep(0.002)
+    middleware.process_response(request, HttpResponse())
+    self.assertEqual(metrics.EXTERNAL_SECONDS.count('<unresolved>', 'payment'), 1)
+    self.assertGreater(metrics.EXTERNAL_SECONDS._series[('<unresolved>', 'payment')][0], 0.002)
+    # Outside a request nothing is recorded.
+    with metrics.timed('payment'):
+      pass
+    self.assertEqual(metrics.EXTERNAL_SECONDS.count('<unresolved>', 'payment'), 1)
+
+  @override_settings(METRICS_QUERY_LIMIT=0)
+  def test_query_limit(self):
+    self.client.get('/store/book/%d/' % self.book.pk)
+    self.assertEqual(metrics.QUERY_LIMIT_EXCEEDED.value('book_details'), 1)
+
+  def test_endpoint(self):
+    self.client.get('/store/')
+    response = self.client.get('/metrics/')
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+    self.assertIn('# TYPE store_request_seconds histogram', response.content)
+    self.assertIn('store_request_seconds_bucket{view="index",le="+Inf"} 1\n', response.content)
+    self.assertIn('store_request_seconds_count{view="index"} 1\n', response.content)
+    self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+class StoreBenchmarkTestCase(TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.baseline = os.path.join(self.directory, 'baseline.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def benchmark(self, **options):
+    out = StringIO()
+    management.call_command('benchmark_store', scale=0.01, requests=5, warmup=1, stdout=out, **options)
+    return out.getvalue()
+
+  def test_baseline(self):
+    out = self.benchmark(save_baseline=self.baseline)
+    for flow in ('storefront', 'book_detail', 'add_remove', 'cart', 'checkout', 'review_api'):
+      self.assertIn('%-12s: p50' % flow, out)
+    self.assertFalse(Book.objects.exists())
+    self.assertFalse(User.objects.exists())
+
+    with open(self.baseline) as f:
+      run = json.load(f)
+    self.assertEqual(run['flows']['storefront']['requests'], 5)
+    self.assertEqual(run['flows']['add_remove']['requests'], 10)
+    # Query counts do not depend on the machine, so a subset of the flows
+    # matches the full run. Five timings are too few to compare, so
+    # latency is given all the slack it needs here.
+    run['flows']['cart']['p50'] = run['flows']['cart']['p95'] = 1000
+    with open(self.baseline, 'w') as f:
+      json.dump(run, f)
+    self.assertIn('No regressions', self.benchmark(baseline=self.baseline, flow=['cart', 'book_detail'], tolerance=100))
+
+    run['flows']['book_detail']['queries'] -= 1
+    with open(self.baseline, 'w') as f:
+      json.dump(run, f)
+    with self.assertRaisesRegexp(management.CommandError, 'book_detail queries per request'):
+      self.benchmark(baseline=self.baseline, flow=['book_detail'])
+    with self.assertRaisesRegexp(management.CommandError, 'recorded with --scale'):
+      self.benchmark(baseline=self.baseline, seed=1)
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTestCase(TestCase):
+  # 'replica' is a separate SQLite file that nothing replicates to, so a
+  # read shows which database it went to.
+  multi_db = True
+
+  def setUp(self):
+    User.objects.create_user(username='reader', email='reader@example.com', password='password')
+    self.author = Author.objects.create(first_name='Josephine', last_name='Tey')
+    self.book = Book.objects.create(title='Brat Farrar', author=self.author, description='', price=10, stock=5)
+
+  def replicate(self):
+    self.author.save(using='replica')
+    self.book.save(using='replica')
+
+  def test_search_reads_from_replica(self):
+    url = reverse('search')
+    self.assertEqual(list(self.client.get(url, {'q': 'farrar'}).context['books']), [])
+    self.replicate()
+    for term in SearchTerm.objects.all():
+      term.save(using='replica')
+    self.assertEqual([book.pk for book in self.client.get(url, {'q': 'farrar'}).context['books']], [self.book.pk])
+
+  def test_cached_reads_use_primary(self):
+    # The storefront fragment, API responses and book page snapshots are
+    # cached under the current versions, so they are built from the primary.
+    self.replicate()
+    Book.objects.using('replica').filter(pk=self.book.pk).update(title='Stale')
+    self.assertContains(self.client.get(reverse('index')), 'Brat Farrar')
+    self.assertContains(self.client.get(reverse('book_details', args=[self.book.pk])), 'Brat Farrar')
+    self.client.login(username='reader', password='password')
+    response = self.client.get('/api/v1/book/', {'format': 'json'})
+    self.assertEqual([book['title'] for book in json.loads(response.content)['objects']], ['Brat Farrar'])
+
+  def test_cart_uses_primary(self):
+    self.client.login(username='reader', password='password')
+    self.client.get(reverse('add_to_cart', args=[self.book.pk]))
+    self.assertEqual(self.client.get(reverse('cart')).context['count'], 1)
+    self.assertFalse(Cart.objects.using('replica').exists())
+
+  def test_writes_pin_reads_to_primary(self):
+    routers.reset()
+    with routers.use_replicas():
+      self.assertEqual(Book.objects.count(), 0)
+      Author.objects.create(first_name='Ngaio', last_name='Marsh')
+      self.assertEqual(Book.objects.count(), 1)
+    routers.reset()
+    with routers.use_replicas():
+      self.assertEqual(Author.objects.count(), 0)
+    self.assertEqual(Author.objects.count(), 2)
+
+  @override_settings(DATABASE_REPLICAS=[])
+  def test_without_replicas(self):
+    with routers.use_replicas():
+      self.assertEqual(Book.objects.count(), 1)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'snapshots'}})
+class BookSnapshotTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+    author = Author.objects.create(first_name='Josephine', last_name='Tey')
+    self.book = Book.objects.create(title='Brat Farrar', author=author, description='', price=10)
+    self.url = reverse('book_details', args=[self.book.pk])
+
+  def add_reviews(self, count):
+    for i in range(count):
+      user = User.objects.create(username='reader%d' % Review.objects.count())
+      Review.objects.create(book=self.book, user=user, text='Review %d' % i)
+
+  def queries(self):
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(self.url)
+    self.assertEqual(response.status_code, 200)
+    return [q['sql'] for q in queries if 'store_' in q['sql']]
+
+  def test_queries_do_not_grow_with_reviews(self):
+    self.add_reviews(1)
+    few = self.queries()
+    self.add_reviews(20)
+    self.assertEqual(len(self.queries()), len(few))
+    self.assertFalse([sql for sql in self.queries() if 'store_review' in sql])
+
+  @override_settings(BOOK_DETAIL_REVIEWS=3)
+  def test_latest_reviews(self):
+    self.add_reviews(5)
+    response = self.client.get(self.url)
+    self.assertEqual([review['text'] for review in response.context['reviews']], ['Review 4', 'Review 3', 'Review 2'])
+    self.assertContains(response, 'reader4 on')
+    self.assertContains(response, 'Reviews (5)')
+
+  def test_missing_book(self):
+    self.assertEqual(self.client.get(reverse('book_details', args=[self.book.pk + 1])).status_code, 404)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'snapshots'}})
+class BookSnapshotRefreshTestCase(TransactionTestCase):
+  def setUp(self):
+    cache.clear()
+    self.user = User.objects.create(username='reader')
+    author = Author.objects.create(first_name='Josephine', last_name='Tey')
+    self.book = Book.objects.create(title='Brat Farrar', author=author, description='', price=10)
+    self.review = Review.objects.create(book=self.book, user=self.user, text='Gripping')
+
+  def wait_for(self, text):
+    for _ in range(200):
+      snapshot = cache.get('book_detail:%d' % self.book.pk)
+      if snapshot and text in [review['text'] for review in snapshot['reviews']]:
+        return snapshot
+      time.sleep(0.01)
+    self.fail('The snapshot never showed %r' % text)
+
+  def test_stale_snapshot_is_served_while_refreshing(self):
+    self.wait_for('Gripping')
+    self.assertEqual(snapshots.get(self.book.pk)['reviews'][0]['text'], 'Gripping')
+    # A change that did not come through the signals.
+    Review.objects.filter(pk=self.review.pk).update(text='Edited')
+    bump_version('review', self.book.pk)
+    self.assertEqual(snapshots.get(self.book.pk)['reviews'][0]['text'], 'Gripping')
+    self.wait_for('Edited')
+    self.assertEqual(snapshots.get(self.book.pk)['versions'], snapshots.versions(self.book.pk))
+
+  def test_too_stale_snapshot_is_rebuilt(self):
+    snapshots.get(self.book.pk)
+    Review.objects.filter(pk=self.review.pk).update(text='Edited')
+    bump_version('review', self.book.pk)
+    with override_settings(BOOK_DETAIL_STALE_SECONDS=-1):
+      self.assertEqual(snapshots.get(self.book.pk)['reviews'][0]['text'], 'Edited')
+
+  def test_new_review_refreshes_in_background(self):
+    snapshots.get(self.book.pk)
+    Review.objects.create(book=self.book, user=User.objects.create(username='other'), text='Baffling')
+    snapshot = self.wait_for('Baffling')
+    self.assertEqual(snapshot['book'].review_count, 2)
+
+  def test_posted_review_is_refreshed_once(self):
+    User.objects.create_user('poster', 'poster@example.com', 'password')
+    self.client.login(username='poster', password='password')
+    scheduled = []
+    schedule, snapshots.refresher.schedule = snapshots.refresher.schedule, scheduled.append
+    try:
+      response = self.client.post(reverse('book_details', args=[self.book.pk]), {'text': 'Baffling'})
+    finally:
+      snapshots.refresher.schedule = schedule
+    self.assertEqual(response.context['reviews'][0]['text'], 'Baffling')
+    self.assertEqual(scheduled, [])
@@ -0,0 +1,102 @@
+import hashlib
+import os
+from io import BytesIO
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+# Fixed-size derivatives of each cover, written next to the original:
+# books/1/hitchhiker.jpeg -> books/1/hitchhiker.small.jpg, .small.webp, ...
+# Sizes are bounding boxes; covers are never scaled up, and no derivative is
+# written for a size the original already fits, which is served as it is.
+SIZES = (
+  ('small', (100, 150)),
+  ('medium', (200, 300)),
+  ('large', (400, 600)),
+)
+FORMATS = (
+  ('jpg', 'JPEG', {'quality': 85}),
+  ('webp', 'WEBP', {'quality': 80}),
+)
+
+
+def available_formats():
+  return [fmt for fmt in FORMATS if fmt[1] in Image.SAVE]
+
+
+def derivative_name(name, size, extension='jpg'):
+  root, _ = os.path.splitext(name)
+  return '%s.%s.%s' % (root, size, extension)
+
+
+def _fits(image_size, box):
+  return image_size[0] <= box[0] and image_size[1] <= box[1]
+
+
+def has_derivatives(name, storage=default_storage):
+  # Whether every derivative the original needs is on disk, in every format
+  # this Pillow can write. Only the original's header is read.
+  Image.init()
+  try:
+    with storage.open(name) as original:
+      image_size = Image.open(original).size
+  except IOError:
+    return False
+  return all(
+    storage.exists(derivative_name(name, size, extension))
+    for size, box in SIZES if not _fits(image_size, box)
+    for extension, _, _ in available_formats()
+  )
+
+
+def _derivatives_key(name):
+  return 'covers:%s' % hashlib.md5(name.encode('utf-8')).hexdigest()
+
+
+def derivatives(name, storage=default_storage):
+  # {(size, extension): name} for the derivatives of a cover that are on
+  # disk, cached until generate_derivatives writes new ones.
+  key = _derivatives_key(name)
+  found = cache.get(key)
+  if found is None:
+    found = {}
+    for size, _ in SIZES:
+      for extension, _, _ in FORMATS:
+        target = derivative_name(name, size, extension)
+        if storage.exists(target):
+          found[(size, extension)] = target
+    cache.set(key, found)
+  return found
+
+
+def generate_derivatives(name, storage=default_storage):
+  # Returns the names written. Existing derivatives are replaced, and those
+  # of sizes the original now fits are removed.
+  Image.init()
+  with storage.open(name) as original:
+    image = Image.open(original)
+    image.load()
+  if image.mode not in ('RGB', 'L'):
+    image = image.convert('RGB')
+
+  written = []
+  for size, box in SIZES:
+    if _fits(image.size, box):
+      for extension, _, _ in FORMATS:
+        target = derivative_name(name, size, extension)
+        if storage.exists(target):
+          storage.delete(target)
+      continue
+    resized = image.copy()
+    resized.thumbnail(box, Image.ANTIALIAS)
+    for extension, pil_format, options in available_formats():
+      buf = BytesIO()
+      resized.save(buf, pil_format, **options)
+      target = derivative_name(name, size, extension)
+      if storage.exists(target):
+        storage.delete(target)
+      written.append(storage.save(target, ContentFile(buf.getvalue())))
+  cache.delete(_derivatives_key(name))
+  return written
@@ -4,6 +4,7 @@ from . import views
 urlpatterns = [
     url(r'^$', views.store, name='index'),
     url(r'^book/(\d+)', views.book_details, name='book_details'),
+    url(r'^search/', views.search, name='search'),
     url(r'^add/(\d+)', views.add_to_cart, name='add_to_cart'),
     url(r'^remove/(\d+)', views.remove_from_cart, name='remove_from_cart'),
     url(r'^cart/', views.cart, name='cart'),
@@ -11,4 +12,5 @@ urlpatterns = [
     url(r'^process/(\w+)', views.process_order, name='process_order'),
     url(r'^order_error/', views.order_error, name='order_error'),
     url(r'^complete_order/(\w+)', views.complete_order, name='complete_order'),
+    url(r'^order_status/(\d+)', views.order_status, name='order_status'),
 ]
@@ -0,0 +1,42 @@
+import datetime
+import time
+
+from django.core.cache import cache
+from django.utils import timezone
+
+# Cache version counters. Anything derived from a scope ('review',
+# ('review', book_id), 'book', ...) is keyed on the scope's current
+# version, and signal receivers bump the version when the underlying rows
+# change, so stale entries are never read again and simply age out.
+#
+# A version is the time of the last change in milliseconds, which makes it
+# usable as a Last-Modified date too. If the counter is evicted it comes
+# back as "now", which is still newer than anything cached before.
+
+
+def _key(scope):
+  return 'version:%s' % ':'.join(str(part) for part in scope)
+
+
+def _now():
+  return int(time.time() * 1000)
+
+
+def get_version(*scope):
+  key = _key(scope)
+  version = cache.get(key)
+  if version is None:
+    cache.add(key, _now(), None)
+    version = cache.get(key)
+  return version
+
+
+def bump_version(*scope):
+  key = _key(scope)
+  version = max(_now(), (cache.get(key) or 0) + 1)
+  cache.set(key, version, None)
+  return version
+
+
+def last_modified(version):
+  return datetime.datetime.fromtimestamp(version / 1000.0, timezone.utc)
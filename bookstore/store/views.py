@@ -1,60 +1,100 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
-from django.utils import timezone
-from django.http import JsonResponse
-from django.core.mail import EmailMultiAlternatives
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, JsonResponse
 from django.template import Context
-from django.template.loader import render_to_string
-from django.contrib.gis.geoip import GeoIP
+from django.conf import settings
 import config
 
 import string, random
 
-import paypalrestsdk, stripe
-
-from .models import Book, BookOrder, Cart, Review
+from .models import Book, Cart, Review, ReviewerStats
 from .forms import ReviewForm
+from .pagination import keyset_page
+from .routers import replica_reads
+from .payments import get_gateway, PaymentError
+from . import orders
+from .search import search as search_books
+from . import snapshots
+from .outbox import queue_email
+from .versions import get_version
+from . import geo
 
 def index(request):
   return render(request, 'template.html')
 
 
+# Not on a replica: the listing is only read to fill the storefront
+# fragment, which is cached under the current catalog version.
 def store(request):
-  books = Book.objects.all()
+  listing = Book.objects.select_related('author').only(
+    'id', 'title', 'publish_date', 'cover_image', 'author',
+    'author__first_name', 'author__last_name',
+  )
+  page = keyset_page(listing, request.GET.get('after'), settings.STORE_PAGE_SIZE)
   context = {
-    'books': books,
+    'books': page,
+    'page': page,
+    'catalog_version': get_version('catalog'),
     'GOOGLE_API_KEY': config.GOOGLE_API_KEY,
   }
 
   return render(request, 'base.html', context)
 
 
+@replica_reads
+def search(request):
+  query = request.GET.get('q', '')
+  try:
+    page = max(int(request.GET.get('page', 1)), 1)
+  except ValueError:
+    page = 1
+  results = search_books(query, page, settings.STORE_PAGE_SIZE)
+  context = {
+    'query': query,
+    'page': results,
+    'books': results.object_list,
+  }
+  return render(request, 'store/search.html', context)
+
+
+@replica_reads
 def book_details(request, book_id):
-  book = get_object_or_404(Book, id=book_id)
+  snapshot = snapshots.get(int(book_id))
+  if snapshot is None:
+    raise Http404
+  book = snapshot['book']
   context = {
     'book': book,
+    'recommendations': book.recommendations.select_related('recommended').order_by('rank'),
+    # The fragments are keyed on what the snapshot was built from, which
+    # may be a little behind while it is refreshed.
+    'book_version': snapshot['versions'][0],
+    'reviews_version': snapshot['versions'][1],
   }
 
-  geo_info = GeoIP().city(request.META.get('REMOTE_ADDR'))
-  if not geo_info:
-    geo_info = GeoIP().city('66.241.90.200')
+  geo_info = geo.city(request.META.get('REMOTE_ADDR'))
   context['geo_info'] = geo_info
 
   if request.user.is_authenticated():
     if request.method == 'POST':
       form = ReviewForm(request.POST)
       if form.is_valid():
-        new_review = Review.objects.create(
-          user=request.user,
-          book=context['book'],
-          text=form.cleaned_data.get('text'),
-          latitude=geo_info['latitude'],
-          longitude=geo_info['longitude'],
-        )
-        new_review.save()
-
-        if Review.objects.filter(user=request.user).count() < 6:
+        with snapshots.refreshed_inline():
+          Review.objects.create(
+            user=request.user,
+            book=book,
+            text=form.cleaned_data.get('text'),
+            latitude=geo_info['latitude'],
+            longitude=geo_info['longitude'],
+          )
+        # The reviewer sees their review straight away.
+        snapshot = snapshots.refresh(book.pk)
+        context['book'] = snapshot['book']
+        context['book_version'], context['reviews_version'] = snapshot['versions']
+
+        if ReviewerStats.review_count_for(request.user) < 6:
           subject = 'Discount Code'
           from_email = 'discounts@mysterybooks.com'
           to_email = [request.user.email]
@@ -65,169 +105,101 @@ def book_details(request, book_id):
             'discount': 10
           })
 
-          text_email = render_to_string('email/review_email.txt', email_context)
-          html_email = render_to_string('email/review_email.html', email_context)
-
-          msg = EmailMultiAlternatives(subject, text_email, from_email, to_email)
-          msg.attach_alternative(html_email, 'text/html')
-          msg.content_subtype = 'html'
-          msg.send()
+          queue_email(subject, 'email/review_email', email_context, from_email, to_email)
     else:
-      if Review.objects.filter(user=request.user, book=context['book']).count() == 0:
+      if not Review.objects.filter(user=request.user, book=book).exists():
         form = ReviewForm()
         context['form'] = form
 
-  context['reviews'] = book.review_set.all()
+  context['reviews'] = snapshot['reviews']
   return render(request, 'store/detail.html', context)
 
 
 def add_to_cart(request, book_id):
+  # An authorized cart is left as it is until its payment is captured or
+  # fails.
   if request.user.is_authenticated():
+    cart, _ = Cart.objects.get_or_create(user=request.user, active=True)
     try:
-      book = Book.objects.get(pk=book_id)
+      if cart.payment_status != Cart.AUTHORIZED:
+        cart.add_to_cart(book_id)
     except ObjectDoesNotExist:
       pass
-    else:
-      try:
-        cart = Cart.objects.get(user=request.user, active=True)
-        cart.add_to_cart(book_id)
-      except ObjectDoesNotExist:
-        cart = Cart.objects.create(user=request.user)
-        cart.save()
-        cart.add_to_cart(book_id)
-      return redirect('cart')
-  else:
-    return redirect('index')
+  elif Book.objects.filter(pk=book_id).exists():
+    request.session_cart.add(book_id)
+  return redirect('cart')
 
 
 def remove_from_cart(request, book_id):
   if request.user.is_authenticated():
-    try:
-      book = Book.objects.get(pk=book_id)
-    except ObjectDoesNotExist:
-      pass
-    else:
-      cart = Cart.objects.get(user=request.user, active=True)
+    cart = Cart.objects.filter(user=request.user, active=True).exclude(payment_status=Cart.AUTHORIZED).first()
+    if cart is not None:
       cart.remove_from_cart(book_id)
-    return redirect('cart')
   else:
-    return redirect('index')
+    request.session_cart.remove(book_id)
+  return redirect('cart')
 
 
 def cart(request):
   if request.user.is_authenticated():
-    cart = Cart.objects.filter(user=request.user.id, active=True)
-    orders = BookOrder.objects.filter(cart=cart)
-    total = 0
-    count = 0
-    for order in orders:
-      total += (order.book.price * order.quantity)
-      count += order.quantity
-    context = {
-      'cart': orders,
-      'total': total,
-      'count': count,
-      'STRIPE_TEST_PUBLISHABLE_KEY': config.STRIPE_TEST_PUBLISHABLE_KEY,
-    }
-    return render(request, 'store/cart.html', context)
+    summary = Cart.objects.filter(user=request.user.id, active=True).summary()
   else:
-    return redirect('index');
+    summary = request.session_cart.summary()
+  context = {
+    'cart': summary.lines,
+    'total': summary.total,
+    'count': summary.count,
+    'STRIPE_TEST_PUBLISHABLE_KEY': config.STRIPE_TEST_PUBLISHABLE_KEY,
+  }
+  return render(request, 'store/cart.html', context)
 
 
 def checkout(request, processor):
   if request.user.is_authenticated():
-    cart = Cart.objects.filter(user=request.user.id, active=True)
-    orders = BookOrder.objects.filter(cart=cart)
+    cart = Cart.objects.filter(user=request.user.id, active=True).exclude(payment_status=Cart.AUTHORIZED)
+    if not cart.exists():
+      return redirect('cart')
+    summary = cart.summary()
     if processor == 'paypal':
-      redirect_url = checkout_paypal(request, cart, orders)
+      redirect_url = checkout_paypal(request, cart, summary)
       return redirect(redirect_url)
     elif processor == 'stripe':
       token = request.POST['stripeToken']
-      status = checkout_stripe(cart, orders, token)
+      status = checkout_stripe(cart, summary, token)
       if status:
         return redirect(reverse('process_order', args=['stripe']))
       else:
         return redirect('order_error', context={"message": "There was an error processing your payment with Stripe."})
     else:
       return redirect('index')
+  else:
+    # Logging in moves the session cart into the database.
+    return redirect_to_login(reverse('cart'))
 
 
-def checkout_paypal(request, cart, orders):
+def checkout_paypal(request, cart, summary):
   if request.user.is_authenticated():
-    items = []
-    total = 0
-    for order in orders:
-      total += (order.book.price * order.quantity)
-      book = order.book
-      item = {
-        'name': book.title,
-        'sku': book.id,
-        'price': str(book.price),
-        'currency': 'USD',
-        'quantity': order.quantity,
-      }
-      items.append(item)
-
-    paypalrestsdk.configure({
-      "mode": "sandbox",
-      "client_id": config.PAYPAL_SANDBOX_CLIENT_ID,
-      "client_secret": config.PAYPAL_SANDBOX_SECRET,
-    })
-
-    payment = paypalrestsdk.Payment({
-      "intent": "sale",
-      "payer": {
-        "payment_method": "paypal"
-      },
-      "redirect_urls": {
-        "return_url": "http://localhost:8000/store/process/paypal",
-        "cancel_url": "http://localhost:8000/store",
-      },
-      "transactions": [{
-        "item_list": {
-          "items": items,
-        },
-        "amount": {
-          "total": str(total),
-          "currency": "USD",
-        },
-        "description": "Myster Books order."
-      }],
-    })
-
-    if payment.create():
-      cart_instance = cart.get()
-      cart_instance.payment_id = payment.id
-      cart_instance.save()
-      for link in payment.links:
-        if link.method == "REDIRECT":
-          redirect_url = str(link.href)
-          return redirect_url
-    else:
+    cart_instance = cart.get()
+    try:
+      payment_id, redirect_url = get_gateway('paypal').create_payment(
+        cart_instance,
+        summary,
+        return_url=request.build_absolute_uri(reverse('process_order', args=['paypal'])),
+        cancel_url=request.build_absolute_uri(reverse('index')),
+      )
+    except PaymentError:
       return reverse('order_error')
+    cart_instance.payment_id = payment_id
+    cart_instance.payment_status = Cart.PENDING
+    cart_instance.payment_amount = summary.total
+    cart_instance.save()
+    return redirect_url
   else:
     return redirect('index')
 
-def checkout_stripe(cart, orders, token):
-  stripe.api_key = config.STRIPE_TEST_SECRET_KEY
-  total = 0
-  total = 0
-  for order in orders:
-    total += (order.book.price * order.quantity)
-  status = True
-  try:
-    cart_instance = cart.get()
-    charge = stripe.Charge.create(
-      amount=int(total*100),
-      currency='USD',
-      source=token,
-      metadata={'order_id': cart_instance.id}
-    )
-    cart_instance.payment_id = charge.id
-    cart_instance.save()
-  except stripe.error.CardError, e:
-    status = False
-  return status
+def checkout_stripe(cart, summary, token):
+  # The card is charged by the reconcile_payments worker.
+  return cart.update(payment_token=token, payment_status=Cart.PENDING, payment_amount=summary.total) > 0
 
 def order_error(request):
   if request.user.is_authenticated():
@@ -240,14 +212,13 @@ def process_order(request, processor):
   if request.user.is_authenticated():
     if processor == 'paypal':
       payment_id = request.GET.get('paymentId')
-      cart = Cart.objects.get(payment_id=payment_id)
-      orders = BookOrder.objects.filter(cart=cart)
-      total = 0
-      for order in orders:
-        total += (order.book.price * order.quantity)
+      cart = get_object_or_404(Cart, payment_id=payment_id, user=request.user, active=True)
+      cart.payment_token = request.GET.get('PayerID', '')
+      cart.save(update_fields=['payment_token'])
+      summary = cart.summary()
       context = {
-        'cart': orders,
-        'total': total,
+        'cart': summary.lines,
+        'total': summary.total,
       }
       return render(request, 'store/process_order.html', context)
     elif processor == 'stripe':
@@ -257,29 +228,36 @@ def process_order(request, processor):
 
 
 def complete_order(request, processor):
+  # Only records the buyer's approval; the reconcile_payments worker
+  # captures the payment and the page polls order_status for the outcome.
   if request.user.is_authenticated():
-    cart = Cart.objects.get(user=request.user, active=True)
+    cart = get_object_or_404(Cart, user=request.user, active=True)
     if processor == 'paypal':
-      payment = paypalrestsdk.Payment.find(cart.payment_id)
-      if payment.execute({"payer_id": payment.payer.payer_info.payer_id}):
-        message = 'Success! Your order has been completed and is being processed. Payment ID: %s' % payment.id
-        cart.active = False
-        cart.payment_type = 'PayPal'
-        cart.order_date = timezone.now()
-        cart.save()
-      else:
-        message = "There was a problem with the transaction. Error: %s" % payment.error.message
-      context = {
-        "message": message
-      }
-      return render(request, 'store/order_complete.html', context)
+      orders.authorize(cart, 'PayPal', cart.payment_token)
     elif processor == 'stripe':
-      cart.active = False
-      cart.payment_type = 'Stripe'
-      cart.order_date = timezone.now()
-      cart.save()
-      message = 'Success! Your order has been completed and is being processed. Payment ID: %s' % cart.payment_id
-      context = {"message": message}
-      return render(request, 'store/order_complete.html', context)
+      orders.authorize(cart, 'Stripe', cart.payment_token)
+    else:
+      return redirect('index')
+    context = {
+      'cart': cart,
+      'message': orders.PROCESSING_MESSAGE,
+    }
+    return render(request, 'store/order_complete.html', context)
   else:
-    return redirect('index')
\ No newline at end of file
+    return redirect('index')
+
+
+def order_status(request, cart_id):
+  if request.user.is_authenticated():
+    cart = Cart.objects.filter(pk=cart_id, user=request.user).values(
+      'payment_status', 'payment_id', 'payment_error').first()
+    if cart is None:
+      raise Http404
+    response = JsonResponse({
+      'status': cart['payment_status'],
+      'message': orders.status_message(cart['payment_status'], cart['payment_id'], cart['payment_error']),
+    })
+    response['Cache-Control'] = 'no-cache'
+    return response
+  else:
+    return redirect('index')